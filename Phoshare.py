@@ -16,19 +16,31 @@
 #   limitations under the License.
 
 import datetime
+import hashlib
 import macostools
 import os
 import re
 import sys
 import shutil
+import sqlite3
+import threading
 import time
 import unicodedata
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from string import Template  # IGNORE:W0402
 
+import appledata.applexml as applexml
 import appledata.iphotodata as iphotodata
+import tilutil.derivativecache as derivativecache
 import tilutil.exiftool as exiftool
+import tilutil.exportmanifest as exportmanifest
+import tilutil.exportplan as exportplan
+import tilutil.filecopy as filecopy
+import tilutil.fileindex as fileindex
+import tilutil.fingerprint as fingerprint
+import tilutil.imagemetadata as imagemetadata
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
 import phoshare_ui
@@ -50,6 +62,23 @@ _IGNORE_LIST = ("pspbrwse.jbf", "thumbs.db", "desktop.ini",
 # (fails on 64-bit MacOS)
 _supports_macostools = True
 
+# Extensions of files with IPTC data that get_iptc_updates() looks at.
+_IPTC_EXTENSIONS = ("jpg", "tif", "tiff", "png")
+
+# Number of threads that stat library files before an export.
+_STAT_THREADS = 8
+
+# Folder of the resized image cache, in the --cachedir folder.
+_RESIZE_CACHE_FOLDER = "Resized"
+
+# Seconds between progress reports while an export plan runs.
+_PROGRESS_INTERVAL = 10
+
+_MB = 1024.0 * 1024.0
+
+# Serializes the planning of Originals folders by parallel threads.
+_folder_lock = threading.Lock()
+
 def is_ignore(file_name):
     """returns True if the file name is in a list of names to ignore."""
     if file_name.startswith("."):
@@ -94,24 +123,27 @@ def compare_keywords(new_keywords, old_keywords):
     """compares two lists of keywords, and returns True if they are the same."""
     if len(new_keywords) != len(old_keywords):
         return False
+    old_keyword_set = set([old_keyword.strip() for old_keyword in old_keywords])
     for keyword in new_keywords:
-        found_it = False
-        for old_keyword in old_keywords:
-            if old_keyword.strip() == keyword:
-                found_it = True
-                break
-        if not found_it:
+        if not keyword.strip() in old_keyword_set:
             return False
     return True
 
 
-def delete_album_file(album_file, albumdirectory, msg, options):
+def _check_album_file(album_file, albumdirectory):
     """sanity check - only delete from album directory."""
     if not album_file.startswith(albumdirectory):
         print >> sys.stderr, (
             "Internal error - attempting to delete file "
             "that is not in album directory:\n    %s") % (su.fsenc(album_file))
         return False
+    return True
+
+
+def plan_delete(plan, album_file, albumdirectory, msg, options):
+    """Adds the deletion of album_file to plan, if options.delete is set."""
+    if not _check_album_file(album_file, albumdirectory):
+        return False
     if msg:
         print "%s: %s" % (msg, su.fsenc(album_file))
 
@@ -119,15 +151,22 @@ def delete_album_file(album_file, albumdirectory, msg, options):
         if not options.dryrun:
             print "Invoke phoshare with the -d option to delete this file."
         return False
-    if options.dryrun:
-        return True
+    plan.add(exportplan.Operation(exportplan.DELETE, album_file,
+                                  data=albumdirectory))
+    return True
+
 
+def delete_album_file(album_file, albumdirectory):
+    """Deletes a file or folder, with all its content, from the album
+    directory."""
+    if not _check_album_file(album_file, albumdirectory):
+        return False
     try:
         if os.path.isdir(album_file):
             file_list = os.listdir(album_file)
             for subfile in file_list:
                 delete_album_file(os.path.join(album_file, subfile),
-                                  albumdirectory, msg, options)
+                                  albumdirectory)
             os.rmdir(album_file)
         else:
             os.remove(album_file)
@@ -138,46 +177,103 @@ def delete_album_file(album_file, albumdirectory, msg, options):
     return False
 
 
-def copy_or_link_file(source, target, options):
-    """copies, links, or converts an image file."""
-    # looks at options.link and options.update
+def _buffered_copy(source, target):
+    """Copies a file with macostools.copy() if it works, else with
+    shutil.copy2()."""
     global _supports_macostools
-    try:
-        if options.size:
-            mode = " (convert)"
-        elif options.link:
-            mode = " (link)"
-        else:
-            mode = " (copy)"
-        if os.path.exists(target):
-            if not options.update:
-                print "Needs update: %s." % (su.fsenc(target))
-                print "Use the -u option to update this file."
-                return
-            print "Updating: " + su.fsenc(target) + mode
-            if not options.dryrun:
-                os.remove(target)
-        else:
-            print "New file: " + su.fsenc(target) + mode
-        if options.dryrun:
+    if _supports_macostools:
+        try:
+            macostools.copy(source, target)
             return
-        if options.link:
-            os.link(source, target)
-        elif options.size:
-            result = imageutils.resize_image(source, target, options.size)
-            if result:
-                print >> sys.stderr, "%s: %s" % (su.fsenc(source), result)
+        except AttributeError:
+            print >> sys.stderr, ("no macostools.copy() on this "
+                                  "system, reverting to shutil.copy2()")
+            _supports_macostools = False
+    shutil.copy2(source, target)
+
+
+def _get_temp_file(target):
+    """Returns the temporary file that copy_or_link_file() writes before
+    renaming it to target. Its name starts with a ".", so folder scans ignore
+    it."""
+    (folder, name) = os.path.split(target)
+    return os.path.join(folder, ".phoshare-tmp-" + name)
+
+
+def _fsync(path):
+    """Flushes a file or folder to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _get_size(path, source_stats):
+    """Returns the size of a library file from source_stats, or 0 if it
+    can't be read; the error is reported when the file gets exported."""
+    try:
+        return source_stats.getsize(path)
+    except OSError:
+        return 0
+
+
+def plan_write(source, target, target_exists, options, source_stats):
+    """Returns the exportplan.Operation that copies, links, or converts
+    source to target, or None if target exists, and options.update is not
+    set."""
+    # looks at options.link, options.size, and options.update
+    if options.size:
+        kind = exportplan.RESIZE
+        mode = " (convert)"
+    elif options.link:
+        kind = exportplan.LINK
+        mode = " (link)"
+    else:
+        kind = exportplan.COPY
+        mode = " (copy)"
+    if target_exists:
+        if not options.update:
+            print "Needs update: %s." % (su.fsenc(target))
+            print "Use the -u option to update this file."
+            return None
+        print "Updating: " + su.fsenc(target) + mode
+    else:
+        print "New file: " + su.fsenc(target) + mode
+    size = 0
+    if kind != exportplan.LINK:
+        size = _get_size(source, source_stats)
+    return exportplan.Operation(kind, target, source, size, options.size)
+
+
+def copy_or_link_file(operation, options, manifest=None, resize_pool=None,
+                      resize_cache=None, source_stats=None):
+    """copies, links, or converts an image file, as planned by operation.
+    The file is written under a temporary name, and then renamed to the
+    target, so an interrupted export never leaves a partial target file. The
+    write is recorded in the journal of manifest, if set. Images are
+    converted by resize_pool, an imageutils.ResizePool, if set, unless
+    resize_cache, a derivativecache.DerivativeCache, has them already.
+    source_stats is the fileindex.StatCache for library files, if set."""
+    # looks at options.copy_mode and options.fsync
+    source = operation.source
+    target = operation.path
+    temp_file = None
+    try:
+        temp_file = _get_temp_file(target)
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        if manifest:
+            manifest.begin(target, temp_file)
+        if operation.kind == exportplan.LINK:
+            os.link(source, temp_file)
+        elif operation.kind == exportplan.RESIZE:
+            if not _resize_image(source, temp_file, operation.data,
+                                 resize_pool, resize_cache, source_stats):
                 return False
         else:
-            if _supports_macostools:
-                try:
-                    macostools.copy(source, target)
-                except AttributeError:
-                    print >> sys.stderr, ("no macostools.copy() on this "
-                                          "system, reverting to shutil.copy2()")
-                    _supports_macostools = False
-            if not _supports_macostools:
-                shutil.copy2(source, target)
+            filecopy.copy_file(source, temp_file, options.copy_mode,
+                               _buffered_copy)
             # result = su.execandcombine([ 'cp', '-fp', source, target ])
             # if result:
             #    print >> sys.stderr, "%s: %s" % (su.fsenc(source), result)
@@ -185,13 +281,225 @@ def copy_or_link_file(source, target, options):
             # reference libraries. macostools.copy() can handle file aliases,
             # but doesn't work on 64-bit Python installations.
             # macostools.copy(source, target)
+        if options.fsync:
+            _fsync(temp_file)
+        os.rename(temp_file, target)
+        if options.fsync:
+            _fsync(os.path.dirname(target))
         return True
     except OSError, ose:
         print >> sys.stderr, "%s: %s" % (su.fsenc(source), ose)
     except IOError, ioe:
         print >> sys.stderr, "%s: %s" % (su.fsenc(source), ioe)
+    finally:
+        # rename() leaves both names if they already linked to the same file.
+        if temp_file and os.path.exists(temp_file):
+            os.remove(temp_file)
     return False
 
+
+def _resize_image(source, target, height_width_max, resize_pool,
+                  resize_cache, source_stats=None):
+    """Converts source to target, or takes target from resize_cache, if set,
+    and adds new conversions to it. The cache key is made from the stat of
+    source in source_stats, if set. Returns False if source could not be
+    converted."""
+    key = None
+    if resize_cache:
+        if source_stats:
+            source_stat = source_stats.stat(source)
+        else:
+            source_stat = os.stat(source)
+        key = derivativecache.get_key(source_stat, height_width_max)
+        if resize_cache.fetch(key, target):
+            return True
+    if resize_pool:
+        result = resize_pool.resize_image(source, target, height_width_max)
+    else:
+        result = imageutils.resize_image(source, target, height_width_max)
+    if result:
+        print >> sys.stderr, "%s: %s" % (su.fsenc(source), result)
+        return False
+    if key:
+        try:
+            resize_cache.store(key, target)
+        except (IOError, OSError), ex:
+            print >> sys.stderr, "Could not cache %s: %s" % (su.fsenc(source),
+                                                            ex)
+    return True
+
+
+def _get_fingerprint(path, manifest):
+    """Returns the content fingerprint of a file, or None if it can't be
+    computed. Fingerprints are cached in manifest, if set."""
+    if manifest:
+        result = manifest.get_fingerprint(path)
+        if result is not None:
+            return result
+    state = exportmanifest.get_file_state(path)
+    try:
+        result = fingerprint.get_fingerprint(path)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Could not fingerprint %s: %s" % (su.fsenc(path),
+                                                              e)
+        return None
+    if manifest and result is not None:
+        manifest.set_fingerprint(path, state, result)
+    return result
+
+
+def _get_file_info(path, existing_files):
+    """Returns the fileindex.FileInfo of an exported file, from
+    existing_files if the export folder has been scanned, else from the file
+    system. Returns None if the file does not exist."""
+    if existing_files is not None:
+        return existing_files.get(path)
+    try:
+        return fileindex.FileInfo(os.stat(path))
+    except OSError:
+        return None
+
+
+def _flush_iptc_batch(iptc_batch, manifest):
+    """Writes the pending IPTC updates of iptc_batch, and records the updated
+    files as verified in manifest, if set."""
+    results = iptc_batch.flush()
+    if manifest:
+        manifest.updates_done(results)
+
+
+def _region_matches(region1, region2):
+    if len(region1) != len(region2):
+        print "len %d %d" % (len(region1), len(region2))
+        return False
+    for i in xrange(len(region1)):
+        if abs(region1[i] - region2[i]) > 0.0000001:
+            print "value %d %f %f %f" % (i, region1[i], region2[i],
+                                         region1[i] - region2[i])
+            return False
+    return True
+
+
+def get_iptc_updates(export_file, expected, iptc_cache=None):
+    """Tests if a file has the proper keywords and caption in the meta data.
+       expected is the data returned by ExportFile.get_expected_iptc_data().
+       Returns the new caption, keywords, date, rating, GPS location,
+       rectangles, and persons to pass to exiftool.update_iptcdata(), as a
+       tuple, or None if the file is up to date."""
+    new_caption = expected["caption"]
+    # JPEG and TIFF files are read directly, exiftool (and with it the
+    # batch read of iptc_cache) is only needed for other formats, or if
+    # the file could not be parsed.
+    iptc_data = imagemetadata.read_iptc_data(export_file)
+    if iptc_data is None:
+        if iptc_cache:
+            iptc_data = iptc_cache.get_iptc_data(export_file)
+        else:
+            iptc_data = exiftool.get_iptc_data(export_file)
+    (file_keywords, file_caption, date_time_original, rating, gps,
+        region_rectangles, region_names) = iptc_data
+    if not su.equalscontent(file_caption, new_caption):
+        print ('Updating IPTC for %s because it has Caption "%s" instead '
+               'of "%s".') % (su.fsenc(export_file), su.fsenc(file_caption),
+                         su.fsenc(new_caption))
+    else:
+        new_caption = None
+
+    new_keywords = expected["keywords"]
+    if not compare_keywords(new_keywords, file_keywords):
+        print ("Updating IPTC for %s because of keywords (%s instead of "
+               "%s)") % (
+            su.fsenc(export_file), su.fsenc(",".join(file_keywords)),
+            su.fsenc(",".join(new_keywords)))
+    else:
+        new_keywords = None
+
+    new_date = None
+    if date_time_original != expected["date"]:
+        print "Updating IPTC for %s because of date (%s instead of %s)" % (
+            su.fsenc(export_file), date_time_original, expected["date"])
+        new_date = expected["date"]
+
+    new_rating = -1
+    if rating != expected["rating"]:
+        print ("Updating IPTC for %s because of rating (%d instead of "
+               "%d)") % (
+            su.fsenc(export_file), rating, expected["rating"])
+        new_rating = expected["rating"]
+
+    new_gps = None
+    photo_gps = expected["gps"]
+    if photo_gps:
+        if (not gps or photo_gps[0] != gps[0] or
+            photo_gps[1] != gps[1]):
+            if gps:
+                old_gps = gps
+            else:
+                old_gps = ("", "")
+            print ("Updating IPTC for %s because of GPS (%s, %s) vs "
+                   "(%s, %s)") % (
+                su.fsenc(export_file), old_gps[0], old_gps[1],
+                photo_gps[0], photo_gps[1])
+            new_gps = photo_gps
+
+    new_rectangles = None
+    new_persons = None
+    persons_diff = False
+    photo_rectangles = expected["rectangles"]
+    photo_faces = expected["persons"]
+    combined_region_names = ','.join(region_names)
+    combined_photo_faces = ','.join(photo_faces)
+    if combined_region_names != combined_photo_faces:
+        print ('Updating IPTC for %s because of persons (%s instead '
+               'of %s)') % (
+            su.fsenc(export_file), su.fsenc(combined_region_names),
+            su.fsenc(combined_photo_faces))
+        persons_diff = True
+    else:
+        for p in xrange(len(region_rectangles)):
+            if not _region_matches(region_rectangles[p],
+                                   photo_rectangles[p]):
+                print ('Updating IPTC for %s because of region for %s '
+                       '(%s vs %s)') % (
+                    su.fsenc(export_file),
+                    region_names[p], ','.join(str(c) for c in
+                                              region_rectangles[p]),
+                    ','.join(str(c) for c in photo_rectangles[p]))
+                persons_diff = True
+                break
+
+    if persons_diff:
+        new_rectangles = photo_rectangles
+        new_persons = photo_faces
+
+    if (new_caption or new_keywords != None or new_date or new_gps or
+        new_rating != -1 or persons_diff):
+        return (new_caption, new_keywords, new_date, new_rating, new_gps,
+                new_rectangles, new_persons)
+    return None
+
+
+def update_iptc_data(export_file, updates, iptc_batch=None, manifest=None,
+                     iptc_hash=None):
+    """Writes updates, as returned by get_iptc_updates(), into the meta data
+       of export_file. Updates are added to iptc_batch if set, else they are
+       written right away. If manifest is set, the file is recorded as
+       verified for iptc_hash once the update is written."""
+    if iptc_batch:
+        if manifest:
+            manifest.set_pending(export_file, iptc_hash)
+        results = iptc_batch.update_iptcdata(export_file, *updates)
+        if manifest:
+            manifest.updates_done(results)
+    else:
+        if manifest:
+            manifest.begin(export_file)
+        if exiftool.update_iptcdata(export_file, *updates) and manifest:
+            manifest.set_verified(export_file, iptc_hash)
+        if manifest:
+            manifest.end(export_file)
+
+
 class ExportFile(object):
     """Describes an exported image."""
 
@@ -223,83 +531,227 @@ class ExportFile(object):
         """Gets the associated iPhotoImage."""
         return self.photo
 
-    def generate(self, options):
-        """makes sure all files exist in other album, and generates if
-           necessary."""
+    def get_metadata_hash(self, options):
+        """Returns a hash of the image data and options that determine the
+        exported file and its meta data."""
+        photo = self.photo
+        data = (photo.comment, photo.keywords, photo.getfaces(),
+                photo.face_rectangles, photo.placenames, photo.rating,
+                photo.date, photo.gps, options.size, options.link,
+                options.faces, options.face_keywords, options.gps)
+        return hashlib.sha1(repr(data)).hexdigest()
+
+    def get_iptc_hash(self, options, is_original):
+        """Returns a hash of the image data and options that get_iptc_updates()
+        compares with the meta data of a file."""
+        photo = self.photo
+        data = (photo.comment, photo.keywords, photo.getfaces(),
+                photo.face_rectangles, photo.placenames, photo.rating,
+                photo.date, photo.gps, options.faces, options.face_keywords,
+                options.gps, is_original)
+        return hashlib.sha1(repr(data)).hexdigest()
+
+    def _check_manifest(self, manifest, export_info, source_file,
+                        export_file, mod_date, metadata_hash):
+        """Checks the manifest record for export_file, whose
+        fileindex.FileInfo is export_info, or None if it does not exist.
+        Returns a tuple of (current, metadata_changed): current is True if
+        export_file exists, did not change since it was exported, and was
+        exported from the current source_file and iPhoto data;
+        metadata_changed is True if only the iPhoto meta data changed since."""
+        if manifest is None or export_info is None:
+            return (False, False)
+        if manifest.is_current(export_file, source_file, mod_date,
+                               metadata_hash, export_info):
+            return (True, False)
+        entry = manifest.get(export_file)
+        return (False, entry is not None and
+                entry.metadata_hash != metadata_hash)
+
+    def get_iptc_files(self, options, existing_files):
+        """Returns the existing files that get_iptc_updates() reads for this
+        image if options.iptc is 2."""
+        if options.link:
+            files = [self.photo.getimagepath()]
+            original_file = self.photo.originalpath
+        else:
+            files = [self.export_file]
+            original_file = self.original_export_file
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            files.append(original_file)
+        if not options.link and existing_files is not None:
+            files = [f for f in files if f in existing_files]
+        return [f for f in files if su.getfileextension(f) in _IPTC_EXTENSIONS]
+
+    def _content_changed(self, source_file, export_file, options, manifest):
+        """Compares the content fingerprints of source_file and export_file
+        if options.fingerprint is set. Returns True if the content differs,
+        False if it is the same, or None if fingerprints can't be used."""
+        if not options.fingerprint or options.size or options.link:
+            return None
+        source_fingerprint = _get_fingerprint(source_file, manifest)
+        if source_fingerprint is None:
+            return None
+        export_fingerprint = _get_fingerprint(export_file, manifest)
+        if export_fingerprint is None:
+            return None
+        if source_fingerprint == export_fingerprint:
+            return False
+        print 'Changed:  %s: content differs from %s' % (
+            su.fsenc(export_file), su.fsenc(source_file))
+        return True
+
+    def get_source_files(self, options):
+        """Returns the library files that generate() exports."""
+        files = [self.photo.getimagepath()]
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            files.append(self.photo.originalpath)
+        return files
+
+    def plan_export(self, options, plan, manifest=None, existing_files=None,
+                    iptc_cache=None, source_stats=None):
+        """Decides which files have to be written or updated to bring the
+           export of this image up to date, and returns the
+           exportplan.Operations for it, in the order in which they have to
+           run. New folders are added to plan. Only reads files. manifest is
+           the ExportManifest of the export folder, if any. existing_files
+           maps the files, and the Originals folder, found in the export
+           folder to their fileindex.FileInfo, if it has been scanned.
+           iptc_cache is an exiftool.IptcDataCache with prefetched IPTC data,
+           if any. source_stats is the fileindex.StatCache for the library
+           files, if any."""
+        if source_stats is None:
+            source_stats = fileindex.StatCache()
+        operations = []
         # check albumFile
         source_file = self.photo.getimagepath()
         do_export = False
         do_original_export = False
+        mod_date = None
+        metadata_hash = None
+        if not options.nomanifest:
+            mod_date = applexml.getappletimestamp(self.photo.mod_date)
+            metadata_hash = self.get_metadata_hash(options)
 
         try:
-            if os.path.exists(self.export_file):
-                if (os.path.getmtime(self.export_file) <
-                    os.path.getmtime(source_file)):
+            export_info = _get_file_info(self.export_file, existing_files)
+            (current, metadata_changed) = self._check_manifest(
+                manifest, export_info, source_file, self.export_file,
+                mod_date, metadata_hash)
+            if current:
+                pass  # the manifest shows that the export is up to date
+            elif export_info:
+                content_changed = self._content_changed(
+                    source_file, self.export_file, options, manifest)
+                source_mtime = source_stats.getmtime(source_file)
+                if content_changed is not None:
+                    do_export = content_changed
+                elif export_info.mtime < source_mtime:
                     print ('Changed:  %s: newer version is '
                            'available: %s vs. %s' %
                            (su.fsenc(self.export_file),
-                            time.ctime(os.path.getmtime(self.export_file)),
-                            time.ctime(os.path.getmtime(source_file))))
+                            time.ctime(export_info.mtime),
+                            time.ctime(source_mtime)))
                     do_export = True
                 elif not options.size:
                     # With creative renaming in iPhoto it is possible to get
                     # stale files if titles get swapped between images. Double
                     # check the size, allowing for some difference for meta data
                     # changes made in the exported copy
-                    source_size = os.path.getsize(source_file)
-                    export_size = os.path.getsize(self.export_file)
+                    source_size = source_stats.getsize(source_file)
+                    export_size = export_info.size
                     diff = abs(source_size - export_size)
                     if diff > _MAX_FILE_DIFF or (diff > 32 and options.link):
                         print ('Changed:  %s: file size: %d vs. %d'
                                % (su.fsenc(self.export_file),
                                   export_size, source_size))
                         do_export = True
-                elif datetime.datetime.fromtimestamp(os.path.getmtime(
-                    self.export_file)) < self.photo.mod_date:
+                elif datetime.datetime.fromtimestamp(
+                    export_info.mtime) < self.photo.mod_date:
                     print ('Changed:  %s: modified in iPhoto: %s vs. %s ' % (
                             su.fsenc(self.export_file),
-                            time.ctime(os.path.getmtime(self.export_file)),
+                            time.ctime(export_info.mtime),
                             time.ctime(self.photo.mod_date)))
                     do_export = True
             else:
                 do_export = True
 
-            # if we use links, we update the IPTC data in the original file
-            do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
+            # if we use links, we update the IPTC data in the original file,
+            # and link it again
+            do_iptc = ((options.iptc == 1 and (do_export or metadata_changed))
+                       or options.iptc == 2)
+            source_size = _get_size(source_file, source_stats)
             if do_iptc and options.link:
-                if self.check_iptc_data(source_file, options):
+                operation = self._plan_iptc_update(source_file, options, False,
+                                                   False, source_size,
+                                                   iptc_cache=iptc_cache)
+                if operation:
+                    operations.append(operation)
                     do_export = True
 
-            exists = True  # True if the file exists or was updated.
+            exists = True  # True if the file exists or gets updated.
             if do_export:
-                exists = copy_or_link_file(source_file, self.export_file, options)
+                if iptc_cache:
+                    iptc_cache.discard(self.export_file)
+                operation = plan_write(source_file, self.export_file,
+                                       export_info is not None, options,
+                                       source_stats)
+                if operation:
+                    operations.append(operation)
+                exists = operation is not None
 
             # if we copy, we update the IPTC data in the copied file
             if exists and do_iptc and not options.link:
-                self.check_iptc_data(self.export_file, options)
+                operation = self._plan_iptc_update(
+                    self.export_file, options, False, do_export, source_size,
+                    iptc_cache=iptc_cache, manifest=manifest)
+                if operation:
+                    operations.append(operation)
+
+            if not options.nomanifest and exists and not current:
+                operations.append(exportplan.Operation(
+                    exportplan.RECORD, self.export_file, source_file,
+                    data=(mod_date, metadata_hash)))
 
             if (options.originals and self.photo.originalpath and
                 not self.photo.rotation_is_only_edit):
                 export_dir = os.path.split(self.original_export_file)[0]
-                if not os.path.exists(export_dir):
-                    print "Creating folder " + su.fsenc(export_dir)
-                    if not options.dryrun:
-                        os.mkdir(export_dir)
+                original_info = _get_file_info(self.original_export_file,
+                                               existing_files)
+                _folder_lock.acquire()
+                try:
+                    if (not original_info and
+                        not _get_file_info(export_dir, existing_files) and
+                        plan.add_folder(export_dir)):
+                        print "Creating folder " + su.fsenc(export_dir)
+                finally:
+                    _folder_lock.release()
                 original_source_file = self.photo.originalpath
-                if os.path.exists(self.original_export_file):
-                    if (os.path.getmtime(self.original_export_file) <
-                        os.path.getmtime(original_source_file)):
+                (current, metadata_changed) = self._check_manifest(
+                    manifest, original_info, original_source_file,
+                    self.original_export_file, mod_date, metadata_hash)
+                if current:
+                    pass  # the manifest shows that the export is up to date
+                elif original_info:
+                    content_changed = self._content_changed(
+                        original_source_file, self.original_export_file,
+                        options, manifest)
+                    source_mtime = source_stats.getmtime(original_source_file)
+                    if content_changed is not None:
+                        do_original_export = content_changed
+                    elif original_info.mtime < source_mtime:
                         print ('Changed:  %s: newer version is '
                                'available: %s vs. %s' %
                                (su.fsenc(self.original_export_file),
-                                time.ctime(os.path.getmtime(
-                                    self.original_export_file)),
-                                time.ctime(os.path.getmtime(
-                                    original_source_file))))
+                                time.ctime(original_info.mtime),
+                                time.ctime(source_mtime)))
                         do_original_export = True
                     elif not options.size:
-                        source_size = os.path.getsize(original_source_file)
-                        export_size = os.path.getsize(self.original_export_file)
+                        source_size = source_stats.getsize(
+                            original_source_file)
+                        export_size = original_info.size
                         diff = abs(source_size - export_size)
                         if diff > _MAX_FILE_DIFF or (diff > 0 and options.link):
                             print ('Changed:  %s: file size: %d vs. %d' %
@@ -309,23 +761,42 @@ class ExportFile(object):
                 else:
                     do_original_export = True
 
-                do_iptc = (options.iptc == 1 and
-                           do_original_export) or options.iptc == 2
+                do_iptc = (options.iptc == 1 and (
+                    do_original_export or metadata_changed)) or options.iptc == 2
+                source_size = _get_size(original_source_file, source_stats)
                 if do_iptc and options.link:
-                    self.check_iptc_data(original_source_file, options,
-                                         is_original=True)
-                exists = True  # True if the file exists or was updated.
+                    operation = self._plan_iptc_update(
+                        original_source_file, options, True, False,
+                        source_size, iptc_cache=iptc_cache)
+                    if operation:
+                        operations.append(operation)
+                exists = True  # True if the file exists or gets updated.
                 if do_original_export:
-                    exists = copy_or_link_file(original_source_file,
-                                               self.original_export_file,
-                                               options)
+                    if iptc_cache:
+                        iptc_cache.discard(self.original_export_file)
+                    operation = plan_write(original_source_file,
+                                           self.original_export_file,
+                                           original_info is not None,
+                                           options, source_stats)
+                    if operation:
+                        operations.append(operation)
+                    exists = operation is not None
                 if exists and do_iptc and not options.link:
-                    self.check_iptc_data(self.original_export_file, options,
-                                         is_original=True)
+                    operation = self._plan_iptc_update(
+                        self.original_export_file, options, True,
+                        do_original_export, source_size,
+                        iptc_cache=iptc_cache, manifest=manifest)
+                    if operation:
+                        operations.append(operation)
+                if not options.nomanifest and exists and not current:
+                    operations.append(exportplan.Operation(
+                        exportplan.RECORD, self.original_export_file,
+                        original_source_file, data=(mod_date, metadata_hash)))
 
         except OSError, ose:
             print >> sys.stderr, "Failed to export %s: %s" % (
                 su.fsenc(source_file), ose)
+        return operations
 
     def get_photo_rectangles(self):
         photo_rectangles = self.photo.face_rectangles
@@ -338,125 +809,70 @@ class ExportFile(object):
                            photo_rectangle[3]))
         return result
 
-    def region_matches(self, region1, region2):
-        if len(region1) != len(region2):
-            print "len %d %d" % (len(region1), len(region2))
-            return False
-        for i in xrange(len(region1)):
-            if abs(region1[i] - region2[i]) > 0.0000001:
-                print "value %d %f %f %f" % (i, region1[i], region2[i],
-                                             region1[i] - region2[i])
-                return False
-        return True
-
-    def check_iptc_data(self, export_file, options, is_original=False):
-        """Tests if a file has the proper keywords and caption in the meta
-           data."""
-        if not su.getfileextension(export_file) in ("jpg", "tif", "tiff", "png"):
-            return False
-
-        new_caption = self.photo.comment
-        if new_caption is None:
-            new_caption = ""
-        else:
-            new_caption = new_caption.strip()
-        (file_keywords, file_caption, date_time_original, rating, gps,
-            region_rectangles, region_names) = exiftool.get_iptc_data(
-            export_file)
-        if not su.equalscontent(file_caption, new_caption):
-            print ('Updating IPTC for %s because it has Caption "%s" instead '
-                   'of "%s".') % (su.fsenc(export_file), su.fsenc(file_caption),
-                             su.fsenc(new_caption))
+    def get_expected_iptc_data(self, options, is_original):
+        """Returns the meta data that get_iptc_updates() expects in an
+        exported file, as a dict."""
+        caption = self.photo.comment
+        if caption is None:
+            caption = ""
         else:
-            new_caption = None
+            caption = caption.strip()
 
-        new_keywords = self.photo.keywords[:]
+        keywords = list(self.photo.keywords)
         if options.face_keywords:
             for keyword in self.photo.getfaces():
-                if not keyword in new_keywords:
-                    new_keywords.append(keyword)
+                if not keyword in keywords:
+                    keywords.append(keyword)
         for keyword in self.photo.placenames:
-            if not keyword in new_keywords:
-                new_keywords.append(keyword)
-        if not compare_keywords(new_keywords, file_keywords):
-            print ("Updating IPTC for %s because of keywords (%s instead of "
-                   "%s)") % (
-                su.fsenc(export_file), su.fsenc(",".join(file_keywords)),
-                su.fsenc(",".join(new_keywords)))
-        else:
-            new_keywords = None
-
-        new_date = None
-        if date_time_original != self.photo.date:
-            print "Updating IPTC for %s because of date (%s instead of %s)" % (
-                su.fsenc(export_file), date_time_original, self.photo.date)
-            new_date = self.photo.date
-
-        new_rating = -1
-        if rating != self.photo.rating:
-            print ("Updating IPTC for %s because of rating (%d instead of "
-                   "%d)") % (
-                su.fsenc(export_file), rating, self.photo.rating)
-            new_rating = self.photo.rating
-
-        new_gps = None
-        if options.gps and self.photo.gps:
-            if (not gps or self.photo.gps[0] != gps[0] or
-                self.photo.gps[1] != gps[1]):
-                if gps:
-                    old_gps = gps
-                else:
-                    old_gps = ("", "")
-                print ("Updating IPTC for %s because of GPS (%s, %s) vs "
-                       "(%s, %s)") % (
-                    su.fsenc(export_file), old_gps[0], old_gps[1],
-                    self.photo.gps[0], self.photo.gps[1])
-                new_gps = self.photo.gps
-
-        new_rectangles = None
-        new_persons = None
-        persons_diff = False
+            if not keyword in keywords:
+                keywords.append(keyword)
+
+        gps = None
+        if options.gps:
+            gps = self.photo.gps
+
         if is_original or not options.faces:
             # Don't export the faces into the original file (could have been
             # cropped).
-            photo_rectangles = []
-            photo_faces = []
-        else:
-            photo_rectangles = self.get_photo_rectangles()
-            photo_faces = self.photo.faces
-        combined_region_names = ','.join(region_names)
-        combined_photo_faces = ','.join(photo_faces)
-        if combined_region_names != combined_photo_faces:
-            print ('Updating IPTC for %s because of persons (%s instead '
-                   'of %s)') % (
-                su.fsenc(export_file), su.fsenc(combined_region_names),
-                su.fsenc(combined_photo_faces))
-            persons_diff = True
+            rectangles = []
+            persons = []
         else:
-            for p in xrange(len(region_rectangles)):
-                if not self.region_matches(region_rectangles[p],
-                                           photo_rectangles[p]):
-                    print ('Updating IPTC for %s because of region for %s '
-                           '(%s vs %s)') % (
-                        su.fsenc(export_file),
-                        region_names[p], ','.join(str(c) for c in
-                                                  region_rectangles[p]),
-                        ','.join(str(c) for c in photo_rectangles[p]))
-                    persons_diff = True
-                    break
-
-        if persons_diff:
-            new_rectangles = photo_rectangles
-            new_persons = photo_faces
-
-        if (new_caption or new_keywords != None or new_date or new_gps or
-            new_rating != -1 or persons_diff):
-            if not options.dryrun:
-                exiftool.update_iptcdata(export_file, new_caption, new_keywords,
-                                         new_date, new_rating, new_gps,
-                                         new_rectangles, new_persons)
-            return True
-        return False
+            rectangles = self.get_photo_rectangles()
+            persons = list(self.photo.faces)
+        return {"caption": caption, "keywords": keywords,
+                "date": self.photo.date, "rating": self.photo.rating,
+                "gps": gps, "rectangles": rectangles, "persons": persons}
+
+    def _plan_iptc_update(self, export_file, options, is_original, written,
+                          size, iptc_cache=None, manifest=None):
+        """Returns the exportplan.Operation that updates the keywords and
+           caption in the meta data of export_file, or None if they are
+           correct. If written is set, export_file gets written by the plan,
+           and is checked when the plan runs, else it is checked now. If
+           manifest is set, files it has recorded as verified for the
+           current data are not read again, and a file that is found to be
+           correct now gets a VERIFY operation instead."""
+        if not su.getfileextension(export_file) in _IPTC_EXTENSIONS:
+            return None
+        iptc_hash = None
+        if not options.nomanifest and not options.link:
+            iptc_hash = self.get_iptc_hash(options, is_original)
+            if (manifest and not written and
+                manifest.is_verified(export_file, iptc_hash)):
+                return None
+        expected = self.get_expected_iptc_data(options, is_original)
+        updates = None
+        if not written:
+            updates = get_iptc_updates(export_file, expected, iptc_cache)
+            if updates is None:
+                if manifest and iptc_hash:
+                    return exportplan.Operation(exportplan.VERIFY, export_file,
+                                                data=iptc_hash)
+                return None
+        return exportplan.Operation(
+            exportplan.METADATA, export_file, size=size,
+            data={"expected": expected, "updates": updates,
+                  "hash": iptc_hash, "batch": not options.link})
 
     def is_part_of(self, file_name):
         """Checks if <file> is part of this image."""
@@ -470,6 +886,9 @@ class ExportDirectory(object):
         self.iphoto_container = iphoto_container
         self.albumdirectory = albumdirectory
         self.files = {}
+        # Files found in the album directory by load_album(), mapped to their
+        # fileindex.FileInfo.
+        self.existing_files = None
 
     def add_iphoto_images(self, images, options):
         """Works through an image folder tree, and builds data for exporting."""
@@ -515,35 +934,36 @@ class ExportDirectory(object):
             index += 1
         return album_basename
 
-    def load_album(self, options):
-        """walks the album directory tree, and scans it for existing files."""
-        if not os.path.exists(self.albumdirectory):
-            print "Creating folder " + su.fsenc(self.albumdirectory)
-            if not options.dryrun:
-                os.makedirs(self.albumdirectory)
-            else:
-                return
-        file_list = os.listdir(self.albumdirectory)
-        if file_list is None:
+    def load_album(self, options, file_index, plan):
+        """walks the album directory tree, and scans it for existing files.
+        file_index is the fileindex.FileIndex of the export folder. The
+        album directory, if it is missing, and the deletion of obsolete files
+        are added to plan."""
+        self.existing_files = {}
+        if not file_index.exists(self.albumdirectory):
+            if plan.add_folder(self.albumdirectory):
+                print "Creating folder " + su.fsenc(self.albumdirectory)
             return
+        file_list = file_index.listdir(self.albumdirectory)
 
         for f in file_list:
             # we won't touch some files
             if is_ignore(f):
                 continue
 
-            album_file = unicodedata.normalize("NFC",
-                                               os.path.join(self.albumdirectory,
-                                                            f))
-            if os.path.isdir(album_file):
+            album_file = os.path.join(self.albumdirectory, f)
+            file_info = file_index.get(album_file)
+            if file_info.is_dir:
                 if (options.originals and
                     (f == "Originals" or (options.picasa and
                                           f == ".picasaoriginals"))):
-                    self.scan_originals(album_file, options)
+                    self.existing_files[album_file] = file_info
+                    self.scan_originals(album_file, options, file_index,
+                                        plan)
                     continue
                 else:
-                    delete_album_file(album_file, self.albumdirectory,
-                                      "Obsolete export directory", options)
+                    plan_delete(plan, album_file, self.albumdirectory,
+                                "Obsolete export directory", options)
                     continue
 
             base_name = unicodedata.normalize("NFC",
@@ -552,25 +972,24 @@ class ExportDirectory(object):
 
             # everything else must have a master, or will have to go
             if master_file is None or not master_file.is_part_of(album_file):
-                delete_album_file(album_file, self.albumdirectory,
-                                  "Obsolete exported file", options)
-
-    def scan_originals(self, folder, options):
-        """Scan a folder of Original images, and delete obsolete ones."""
-        file_list = os.listdir(folder)
-        if not file_list:
-            return
+                plan_delete(plan, album_file, self.albumdirectory,
+                            "Obsolete exported file", options)
+            else:
+                self.existing_files[album_file] = file_info
 
-        for f in file_list:
+    def scan_originals(self, folder, options, file_index, plan):
+        """Scan a folder of Original images, and plan the deletion of
+        obsolete ones."""
+        for f in file_index.listdir(folder):
             # We won't touch some files.
             if is_ignore(f):
                 continue
 
             originalfile = os.path.join(folder, f)
-            if os.path.isdir(originalfile):
-                delete_album_file(originalfile, self.albumdirectory,
-                                  "Obsolete export Originals directory",
-                                  options)
+            file_info = file_index.get(originalfile)
+            if file_info.is_dir:
+                plan_delete(plan, originalfile, self.albumdirectory,
+                            "Obsolete export Originals directory", options)
                 continue
 
             base_name = unicodedata.normalize("NFC",
@@ -581,19 +1000,43 @@ class ExportDirectory(object):
             if (not master_file or
                 originalfile != master_file.original_export_file or
                 master_file.photo.rotation_is_only_edit):
-                delete_album_file(originalfile, originalfile,
-                                  "Obsolete Original", options)
+                plan_delete(plan, originalfile, originalfile,
+                            "Obsolete Original", options)
+            else:
+                self.existing_files[originalfile] = file_info
+
+    def get_iptc_cache(self, options):
+        """Returns an exiftool.IptcDataCache that reads the IPTC data of the
+        files in this folder that imagemetadata can't read with one exiftool
+        command, once the data of one of them is needed. Returns None if not
+        all files get checked, or there are no such files."""
+        if options.iptc != 2:
+            return None
+        image_files = []
+        for export_file in self.files.values():
+            for image_file in export_file.get_iptc_files(options,
+                                                         self.existing_files):
+                if not imagemetadata.can_read(image_file):
+                    image_files.append(image_file)
+        if not image_files:
+            return None
+        return exiftool.IptcDataCache(image_files)
+
+    def get_source_files(self, options):
+        """Returns the library files that this folder exports."""
+        result = []
+        for export_file in self.files.values():
+            result.extend(export_file.get_source_files(options))
+        return result
 
-    def generate_files(self, options):
-        """Generates the files in the export location."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
-        sorted_files = []
-        for f in self.files:
-            sorted_files.append(f)
-        sorted_files.sort()
-        for f in sorted_files:
-            self.files[f].generate(options)
+    def get_export_files(self):
+        """Returns the paths of all files that this folder exports."""
+        result = []
+        for export_file in self.files.values():
+            result.append(export_file.export_file)
+            if export_file.original_export_file:
+                result.append(export_file.original_export_file)
+        return result
 
 
 class IPhotoFace(iphotodata.IPhotoContainer):
@@ -613,6 +1056,7 @@ class ExportLibrary(object):
     def __init__(self, albumdirectory):
         self.albumdirectory = albumdirectory
         self.named_folders = {}
+        self.plan = exportplan.ExportPlan(albumdirectory)
         self._abort = False
 
     def abort(self):
@@ -708,30 +1152,56 @@ class ExportLibrary(object):
             os.makedirs(self.albumdirectory)
 
         album_directories = {}
+        for folder in self.named_folders.values():
+            album_directories[folder.albumdirectory] = True
+        # One pass over the export folder answers all questions about
+        # existing files and folders below.
+        file_index = fileindex.FileIndex(
+            self.albumdirectory,
+            lambda folder: self._skip_folder(folder, album_directories,
+                                             options))
+
         for folder in self.named_folders.values():
             if self._check_abort():
                 return
-            album_directories[folder.albumdirectory] = True
-            folder.load_album(options)
+            folder.load_album(options, file_index, self.plan)
 
         self.check_directories(self.albumdirectory, "", album_directories,
-                               options)
+                               options, file_index)
+
+    def _is_ignored_folder(self, directory, options):
+        """Tests if check_directories() leaves directory alone."""
+        if not options.ignore:
+            return False
+        exclude_pattern = re.compile(su.fsdec(options.ignore))
+        return exclude_pattern.match(os.path.split(directory)[1]) is not None
+
+    def _skip_folder(self, directory, album_directories, options):
+        """Tests if the content of directory can be left out of the index of
+        the export folder: it is not looked at, and holds no albums."""
+        if (os.path.split(directory)[1] != "iPod Photo Cache" and
+            not self._is_ignored_folder(directory, options)):
+            return False
+        prefix = directory + os.sep
+        for album_directory in album_directories:
+            if album_directory.startswith(prefix):
+                return False
+        return True
 
     def check_directories(self, directory, rel_path, album_directories,
-                          options):
-        """Checks an export directory for obsolete files."""
-        if options.ignore:
-            exclude_pattern = re.compile(su.fsdec(options.ignore))
-            if exclude_pattern.match(os.path.split(directory)[1]):
-                return True
-        if not os.path.exists(directory):
+                          options, file_index):
+        """Checks an export directory for obsolete files, and plans their
+        deletion."""
+        if self._is_ignored_folder(directory, options):
+            return True
+        if not file_index.exists(directory):
             return True
         contains_albums = False
-        for f in su.os_listdir_unicode(directory):
+        for f in file_index.listdir(directory):
             if self._check_abort():
                 return
             album_file = os.path.join(directory, f)
-            if os.path.isdir(album_file):
+            if file_index.isdir(album_file):
                 if f == "iPod Photo Cache":
                     print "Skipping " + su.fsenc(album_file)
                     continue
@@ -739,25 +1209,382 @@ class ExportLibrary(object):
                 if album_file in album_directories:
                     contains_albums = True
                 elif not self.check_directories(album_file, rel_path_file,
-                                                album_directories, options):
-                    delete_album_file(album_file, directory,
-                                      "Obsolete directory", options)
+                                                album_directories, options,
+                                                file_index):
+                    plan_delete(self.plan, album_file, directory,
+                                "Obsolete directory", options)
             else:
                 # we won't touch some files
                 if is_ignore(f):
                     continue
-                delete_album_file(album_file, directory, "Obsolete", options)
+                plan_delete(self.plan, album_file, directory, "Obsolete",
+                            options)
 
         return contains_albums
 
+    def open_manifest(self, options, source_stats):
+        """Returns the ExportManifest of the export folder, or None if it is
+        not used. source_stats is the fileindex.StatCache for library
+        files."""
+        if options.nomanifest:
+            return None
+        manifest_file = os.path.join(self.albumdirectory,
+                                     exportmanifest.MANIFEST_NAME)
+        if options.dryrun and not os.path.exists(manifest_file):
+            return None
+        manifest = exportmanifest.ExportManifest(
+            self.albumdirectory, read_only=options.dryrun,
+            source_stat=source_stats.stat)
+        for target in manifest.recover():
+            print "Resuming interrupted export of %s" % (su.fsenc(target))
+        return manifest
+
     def generate_files(self, options):
-        """Walks through the export tree and sync the files."""
+        """Walks through the export tree and sync the files. The operations
+        are planned first, and the plan is run unless options.dryrun is
+        set."""
         if not os.path.exists(self.albumdirectory) and not options.dryrun:
             os.makedirs(self.albumdirectory)
+        # Stat all library files up front, in parallel.
+        source_stats = fileindex.StatCache()
+        source_files = []
+        for folder in self.named_folders.values():
+            source_files.extend(folder.get_source_files(options))
+        source_stats.prefetch(source_files, _STAT_THREADS)
+        manifest = self.open_manifest(options, source_stats)
+        try:
+            if not self.plan_files(options, manifest, source_stats):
+                return
+            print self.plan.describe()
+            if options.save_plan:
+                plan_file = su.expand_home_folder(options.save_plan)
+                try:
+                    self.plan.save(plan_file)
+                    print "Saved export plan to %s." % (su.fsenc(plan_file))
+                except (IOError, OSError), ex:
+                    print >> sys.stderr, "Could not save %s: %s" % (
+                        su.fsenc(plan_file), ex)
+            if not options.dryrun:
+                self.execute_plan(self.plan, options, manifest, source_stats)
+        finally:
+            if manifest:
+                manifest.close()
+
+    def run_plan(self, plan, options):
+        """Runs a plan that was saved by an earlier export."""
+        if not os.path.exists(self.albumdirectory):
+            os.makedirs(self.albumdirectory)
+        source_stats = fileindex.StatCache()
+        source_files = []
+        for task in plan.tasks:
+            for operation in task.operations:
+                if operation.source:
+                    source_files.append(operation.source)
+        source_stats.prefetch(source_files, _STAT_THREADS)
+        manifest = self.open_manifest(options, source_stats)
+        try:
+            self.execute_plan(plan, options, manifest, source_stats)
+        finally:
+            if manifest:
+                manifest.close()
+
+    def plan_files(self, options, manifest, source_stats):
+        """Adds the operations that bring the exported files up to date to
+        self.plan, planning options.jobs files at a time. Only reads files.
+        Returns False if the export was cancelled."""
+        jobs = []
         for ndir in sorted(self.named_folders):
+            folder = self.named_folders[ndir]
+            iptc_cache = folder.get_iptc_cache(options)
+            for f in sorted(folder.files):
+                jobs.append((folder, folder.files[f], iptc_cache))
+
+        def plan_file(job):
+            (folder, export_file, iptc_cache) = job
+            return export_file.plan_export(options, self.plan, manifest,
+                                           folder.existing_files, iptc_cache,
+                                           source_stats)
+
+        def add_task(index, operations):
+            self.plan.add_task(jobs[index][0].albumdirectory, operations)
+
+        if not self._map_ordered(plan_file, jobs, _get_jobs(options),
+                                 add_task):
+            return False
+        export_files = []
+        for folder in self.named_folders.values():
+            export_files.extend(folder.get_export_files())
+        self.plan.export_files = export_files
+        return True
+
+    def execute_plan(self, plan, options, manifest, source_stats):
+        """Runs the operations of plan: the folder operations first, in
+        order, and then the tasks, options.jobs at a time, or one per core
+        for plans that convert images if -j is not set. Returns False if the
+        export was cancelled."""
+        for operation in plan.operations:
             if self._check_abort():
-                break
-            self.named_folders[ndir].generate_files(options)
+                return False
+            if operation.kind == exportplan.DELETE:
+                delete_album_file(operation.path, operation.data)
+            elif operation.kind == exportplan.MKDIR:
+                if not os.path.isdir(operation.path):
+                    try:
+                        os.makedirs(operation.path)
+                    except OSError, ex:
+                        print >> sys.stderr, "Could not create %s: %s" % (
+                            su.fsenc(operation.path), ex)
+
+        tasks = plan.tasks
+        iptc_batches = _get_iptc_batches(tasks)
+        progress = _Progress(tasks)
+        jobs = _get_jobs(options)
+        resize_pool = None
+        resize_cache = None
+        if plan.get_counts().get(exportplan.RESIZE):
+            # Unless -j is set, images are converted in a process for each
+            # core, with as many threads to keep them busy.
+            resize_pool = imageutils.ResizePool(options.jobs)
+            jobs = resize_pool.size
+            resize_cache = open_resize_cache(options)
+
+        def execute(index):
+            _execute_task(tasks[index], options, manifest, iptc_batches[index],
+                          source_stats, resize_pool, resize_cache)
+
+        def task_done(index, result):
+            progress.task_done(tasks[index])
+            # Write the IPTC updates of a folder once all its files are done.
+            iptc_batch = iptc_batches[index]
+            if iptc_batch and (index + 1 == len(tasks) or
+                               iptc_batches[index + 1] is not iptc_batch):
+                _flush_iptc_batch(iptc_batch, manifest)
+
+        try:
+            completed = self._map_ordered(execute, xrange(len(tasks)), jobs,
+                                          task_done)
+        finally:
+            for iptc_batch in set([b for b in iptc_batches if b]):
+                _flush_iptc_batch(iptc_batch, manifest)
+            if resize_pool:
+                resize_pool.close()
+            if resize_cache:
+                if resize_cache.hits:
+                    print "Reused %d resized images from the cache." % (
+                        resize_cache.hits)
+                resize_cache.close()
+        if completed and manifest and plan.export_files is not None:
+            manifest.retain(plan.export_files)
+        return completed
+
+    def _map_ordered(self, function, items, jobs, callback):
+        """Calls function for each of items, jobs at a time, and
+        callback(index, result) for each item, in order, from this thread.
+        What function prints is printed in the same order as in a serial run.
+        Returns False if the export was cancelled."""
+        if jobs <= 1:
+            for (index, item) in enumerate(items):
+                if self._check_abort():
+                    return False
+                callback(index, function(item))
+            return True
+
+        output = _OrderedOutput()
+        def collect(item):
+            if self._abort:
+                return (None, [])
+            return output.collect(function, item)
+
+        pool = ThreadPool(jobs)
+        output.install()
+        try:
+            results = pool.imap(collect, items)
+            for (index, (result, item_output)) in enumerate(results):
+                output.replay(item_output)
+                callback(index, result)
+                if self._check_abort():
+                    return False
+        finally:
+            # Items that have not started yet return right away after an
+            # abort.
+            pool.close()
+            pool.join()
+            output.uninstall()
+        return True
+
+
+def _get_jobs(options):
+    """Returns the number of files to export at the same time: options.jobs,
+    or 1 if -j is not set."""
+    return options.jobs or 1
+
+
+def _execute_task(task, options, manifest, iptc_batch, source_stats,
+                  resize_pool=None, resize_cache=None):
+    """Runs the operations of an exportplan.Task. Operations on a file whose
+    write failed are skipped."""
+    failed = set()
+    try:
+        for operation in task.operations:
+            if operation.path in failed:
+                continue
+            if operation.kind in exportplan.WRITE_OPERATIONS:
+                if not copy_or_link_file(operation, options, manifest,
+                                         resize_pool, resize_cache,
+                                         source_stats):
+                    failed.add(operation.path)
+            elif operation.kind == exportplan.METADATA:
+                _execute_iptc_update(operation, iptc_batch, manifest)
+                # Linked library files are updated in place.
+                source_stats.discard(operation.path)
+            elif operation.kind == exportplan.RECORD and manifest:
+                (mod_date, metadata_hash) = operation.data
+                manifest.update(operation.path, operation.source, mod_date,
+                                metadata_hash)
+            elif operation.kind == exportplan.VERIFY and manifest:
+                manifest.set_verified(operation.path, operation.data)
+    except OSError, ose:
+        print >> sys.stderr, "Failed to export %s: %s" % (
+            su.fsenc(task.operations[0].path), ose)
+
+
+def _execute_iptc_update(operation, iptc_batch, manifest):
+    """Runs a METADATA operation. Updates that were not known when the plan
+    was made are looked up now."""
+    data = operation.data
+    iptc_hash = data["hash"]
+    if not iptc_hash:
+        manifest = None
+    updates = data["updates"]
+    if updates is None:
+        updates = get_iptc_updates(operation.path, data["expected"])
+        if updates is None:
+            if manifest:
+                manifest.set_verified(operation.path, iptc_hash)
+            return
+    if not data["batch"]:
+        iptc_batch = None
+    update_iptc_data(operation.path, updates, iptc_batch, manifest, iptc_hash)
+
+
+def _get_iptc_batches(tasks):
+    """Returns a list with the exiftool.IptcUpdateBatch for each of tasks, or
+    None. The tasks of a folder share a batch, if any of them has IPTC
+    updates that can be batched. Updates of linked files are not batched, as
+    they have to be written before the file is linked again."""
+    batched_folders = set()
+    for task in tasks:
+        for operation in task.operations:
+            if (operation.kind == exportplan.METADATA and
+                operation.data["batch"]):
+                batched_folders.add(task.folder)
+    batches = {}
+    result = []
+    for task in tasks:
+        if not task.folder in batched_folders:
+            result.append(None)
+            continue
+        if not task.folder in batches:
+            batches[task.folder] = exiftool.IptcUpdateBatch()
+        result.append(batches[task.folder])
+    return result
+
+
+class _Progress(object):
+    """Reports how many of the tasks of an export plan are done, with an
+    estimate of the time left, every _PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, tasks):
+        self._total_tasks = len(tasks)
+        self._total_size = sum([task.get_size() for task in tasks])
+        self._done_tasks = 0
+        self._done_size = 0
+        self._start = time.time()
+        self._last_report = self._start
+
+    def task_done(self, task):
+        """Notes that task is done, and prints the progress if it is time
+        for it."""
+        self._done_tasks += 1
+        self._done_size += task.get_size()
+        now = time.time()
+        if (now - self._last_report < _PROGRESS_INTERVAL or
+            self._done_tasks == self._total_tasks):
+            return
+        self._last_report = now
+        # The estimate is based on the bytes processed, if there are any.
+        if self._total_size and self._done_size:
+            fraction = float(self._done_size) / self._total_size
+        else:
+            fraction = float(self._done_tasks) / self._total_tasks
+        left = int((now - self._start) * (1.0 - fraction) / fraction)
+        print ("Exported %d of %d files (%.1f of %.1f MB), about %d:%02d "
+               "left.") % (self._done_tasks, self._total_tasks,
+                           self._done_size / _MB, self._total_size / _MB,
+                           left / 60, left % 60)
+
+
+class _OrderedOutput(object):
+    """Collects what export threads print to sys.stdout and sys.stderr, so it
+    can be printed in order from the main thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._streams = None
+
+    def install(self):
+        """Replaces sys.stdout and sys.stderr with collecting streams."""
+        self._streams = (sys.stdout, sys.stderr)
+        sys.stdout = _CollectingStream(self._local, sys.stdout)
+        sys.stderr = _CollectingStream(self._local, sys.stderr)
+
+    def uninstall(self):
+        """Restores sys.stdout and sys.stderr."""
+        (sys.stdout, sys.stderr) = self._streams
+
+    def collect(self, function, *args):
+        """Calls function, and returns its result, and what it printed as a
+        list of (stream, text) pairs."""
+        self._local.output = []
+        try:
+            result = function(*args)
+            return (result, self._local.output)
+        finally:
+            self._local.output = None
+
+    def replay(self, output):
+        """Prints output returned by collect()."""
+        for (stream, text) in output:
+            stream.write(text)
+
+
+class _CollectingStream(object):
+    """File like object that adds text to the output list of the current
+    thread, or writes it to stream if the thread does not collect output."""
+
+    def __init__(self, local, stream):
+        self._local = local
+        self._stream = stream
+        self._softspace = threading.local()
+
+    def write(self, text):
+        output = getattr(self._local, "output", None)
+        if output is None:
+            self._stream.write(text)
+        else:
+            output.append((self._stream, text))
+
+    # The print statement keeps track of pending spaces in the softspace
+    # attribute, which must not be shared between threads.
+    def _getsoftspace(self):
+        return getattr(self._softspace, "value", 0)
+
+    def _setsoftspace(self, value):
+        self._softspace.value = value
+    softspace = property(_getsoftspace, _setsoftspace)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
 
 
 def export_iphoto(library, data, excludes, options):
@@ -789,6 +1616,58 @@ def export_iphoto(library, data, excludes, options):
     print "Exporting photos from iPhoto to export folder..."
     library.generate_files(options)
 
+def open_resize_cache(options):
+    """Returns the derivativecache.DerivativeCache for the --resize-cache
+    option, or None if it is not set, or can't be opened."""
+    if not options.resize_cache:
+        return None
+    folder = os.path.join(su.expand_home_folder(options.cachedir),
+                          _RESIZE_CACHE_FOLDER)
+    try:
+        return derivativecache.DerivativeCache(
+            folder, options.resize_cache * 1024 * 1024, options.copy_mode)
+    except (OSError, sqlite3.Error), ex:
+        print >> sys.stderr, "Could not open the resized image cache %s: %s" % (
+            su.fsenc(folder), ex)
+        return None
+
+def run_export_plan(plan_file, options):
+    """Runs an export plan saved with --save-plan."""
+    try:
+        plan = exportplan.load_plan(plan_file)
+    except (IOError, ValueError), ex:
+        print >> sys.stderr, "Could not read export plan: %s" % (ex)
+        return 1
+    print plan.describe()
+    if options.dryrun:
+        return 0
+    if (plan.get_counts().get(exportplan.METADATA) and
+        not exiftool.check_exif_tool()):
+        print >> sys.stderr, "Exiftool is needed for the IPTC updates."
+        return 1
+    # One exiftool process for each export thread.
+    exiftool.start_sessions(_get_jobs(options))
+    try:
+        ExportLibrary(plan.export_folder).run_plan(plan, options)
+    finally:
+        exiftool.stop_sessions()
+    return 0
+
+def get_image_selection(options):
+    """Returns the iphotodata.ImageSelection for the events and albums that
+    export_iphoto() processes."""
+    excludes = None
+    if options.exclude:
+        excludes = su.fsdec(options.exclude)
+    selection = iphotodata.ImageSelection(excludes)
+    if options.events:
+        selection.add(["Event"], su.fsdec(options.events))
+    if options.albums:
+        selection.add(["Regular", "Published"], su.fsdec(options.albums))
+    if options.smarts:
+        selection.add(["Smart"], su.fsdec(options.smarts))
+    return selection
+
 USAGE = """usage: %prog [options]
 Exports images and movies from an iPhoto library into a folder.
 
@@ -802,13 +1681,26 @@ def get_option_parser():
         "-a", "--albums",
         help="""Export matching regular albums. The argument
         is a regular expression. Use -a . to export all regular albums.""")
+    p.add_option(
+        "--cachedir", default="~/Library/Caches/Phoshare",
+        help="""Folder for the cache of the parsed iPhoto library data, which
+        is reused until iPhoto changes the library. Default:
+        "%default".""")
+    p.add_option(
+        "--copy-mode", dest="copy_mode", type="choice",
+        choices=filecopy.COPY_MODES, default=filecopy.CLONE,
+        help="""How files are copied: "clone" makes copy-on-write clones on
+        file systems that support them (APFS, btrfs, XFS), "kernel" lets the
+        kernel copy the data (Linux only), and "buffered" copies the data
+        through memory. Modes that don't work for a file fall back to the
+        ones after them. Default: "%default".""")
     p.add_option(
         "-d", "--delete", action="store_true",
         help="Delete obsolete files that are no longer in your iPhoto library.")
     p.add_option(
         "--dryrun", action="store_true",
-        help="""Show what would have been done, but don't change or copy any
-             files.""")
+        help="""Only plan the export: show what would have been done, but
+             don't change or copy any files.""")
     p.add_option("-e", "--events",
                  help="""Export matching events. The argument is
                  a regular expression. Use -e . to export all events.""")
@@ -826,8 +1718,17 @@ def get_option_parser():
                  help="Copy face names into keywords.")
     p.add_option("-f", "--faces", action="store_true",
                  help="Copy faces into metadata.")
+    p.add_option("--fingerprint", action="store_true",
+                 help="""Detect changed files by comparing fingerprints of
+                 their content, not counting the meta data, instead of
+                 their modification times and sizes. Fingerprints are
+                 cached in the export folder.""")
     p.add_option("--folderhints", dest="folderhints", action="store_true",
                  help="Scan event and album descriptions for folder hints.")
+    p.add_option("--fsync", action="store_true",
+                 help="""Flush each exported file to disk before it replaces
+                 the previous version. Slower, but makes sure no file is lost
+                 if the system crashes during an export.""")
     p.add_option("--gps", action="store_true",
                  help="Process GPS location information")
     p.add_option('--ignore',
@@ -838,6 +1739,12 @@ def get_option_parser():
                  help="""Path to iPhoto library, e.g.
                  "%s/Pictures/iPhoto Library".""",
                  default="~/Pictures/iPhoto Library")
+    p.add_option(
+        "-j", "--jobs", type="int",
+        help="""Number of files to export at the same time. Values above 1
+        speed up exports that copy, convert, or check many files. Default:
+        1, or the number of cores for exports that convert images with
+        --size.""")
     p.add_option(
         "-k", "--iptc", action="store_const", const=1, dest="iptc",
         help="""Check the IPTC data of all new or updated files. Checks for
@@ -853,9 +1760,22 @@ def get_option_parser():
       help="""Use links instead of copying files. Use with care, as changes made
       to the exported files might affect the image that is stored in the iPhoto
       library.""")
+    p.add_option(
+        "--loadselected", action="store_true",
+        help="""Only load the images of the events and albums selected with
+        -e, -a, -s and -x from the iPhoto library. Speeds up exports of a few
+        events or albums from large libraries. A valid library data cache is
+        still used, but a new one is not written.""")
     p.add_option(
       "-n", "--nametemplate", default="${caption}",
       help="""Template for naming image files. Default: "${caption}".""")
+    p.add_option("--nocache", action="store_true",
+                 help="Don't read or write the iPhoto library data cache.")
+    p.add_option(
+        "--nomanifest", action="store_true",
+        help="""Don't use the manifest of exported files (%s in the export
+        folder), and check every file in the export folder for changes.""" % (
+            exportmanifest.MANIFEST_NAME))
     p.add_option("-o", "--originals", action="store_true",
                       help="Export original files into Originals.")
     p.add_option("--picasa", action="store_true",
@@ -863,9 +1783,27 @@ def get_option_parser():
     p.add_option("--pictures", action="store_false", dest="movies",
                  default=True,
                  help="Export pictures only (no movies).")
+    p.add_option(
+        "--resize-cache", dest="resize_cache", type="int", default=0,
+        metavar="MB",
+        help="""Keep up to this many megabytes of images converted with
+        --size in a cache in the --cachedir folder. Exports of the same
+        images at the same size link or copy them from the cache, instead of
+        converting them again. The least recently used images are removed
+        when the cache is full. Default: no cache.""")
+    p.add_option(
+        "--run-plan", dest="run_plan",
+        help="""Run an export plan saved with --save-plan, without reading
+        the iPhoto library.""")
+    p.add_option(
+        "--save-plan", dest="save_plan",
+        help="""Save the plan of the export to this file. With --dryrun,
+        nothing is exported, and the plan can be run later with
+        --run-plan.""")
     p.add_option(
       "--size", type='int', help="""Resize images so that neither width or height
-      exceeds this size. Converts all images to jpeg.""")
+      exceeds this size. Converts all images to jpeg, with Pillow if it is
+      installed, else with ImageMagick or sips.""")
     p.add_option(
         "-s", "--smarts",
         help="""Export matching smart albums. The argument
@@ -876,6 +1814,12 @@ def get_option_parser():
         "-x", "--exclude",
         help="""Don't export matching albums or events. The pattern is a
         regular expression.""")
+    p.add_option(
+        "--xmlparser", type="choice", choices=applexml.PARSER_BACKENDS,
+        default=applexml.DEFAULT_BACKEND,
+        help="""Parser for the iPhoto AlbumData.xml file, one of %s. Default:
+        "%s".""" % (", ".join(applexml.PARSER_BACKENDS),
+                    applexml.DEFAULT_BACKEND))
     p.add_option('--verbose', action='store_true', 
                  help='Print verbose messages.')
     p.add_option('--version', action='store_true', 
@@ -905,6 +1849,21 @@ def main():
     if options.size and options.link:
         parser.error("Cannot use --size and --link together.")
 
+    if options.size and not imageutils.get_resize_backends():
+        print >> sys.stderr, ("Resizing images with --size needs Pillow "
+                              "(http://python-pillow.org/), or ImageMagick.")
+        return 1
+
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+
+    if options.resize_cache < 0:
+        parser.error("--resize-cache can't be negative.")
+
+    if options.run_plan:
+        return run_export_plan(su.expand_home_folder(options.run_plan),
+                               options)
+
     if not options.iphoto:
         parser.error("Need to specify the iPhoto library with the --iphoto "
                      "option.")
@@ -920,14 +1879,30 @@ def main():
         parser.error("No action specified. Use --export to export from your "
                      "iPhoto library.")
 
+    if options.loadselected and options.facealbums:
+        parser.error("Cannot use --loadselected and --facealbums together.")
+
     album_xml_file = iphotodata.get_album_xmlfile(
         su.expand_home_folder(options.iphoto))
     places = False
-    data = iphotodata.get_iphoto_data(album_xml_file, places)
+    cache_dir = None
+    selection = None
+    if options.loadselected:
+        selection = get_image_selection(options)
+    if not options.nocache:
+        cache_dir = su.expand_home_folder(options.cachedir)
+    data = iphotodata.get_iphoto_data(album_xml_file, places,
+                                      options.xmlparser, cache_dir, selection)
 
     if options.export:
         album = ExportLibrary(su.expand_home_folder(options.export))
-        export_iphoto(album, data, options.exclude, options)
+        if options.iptc > 0:
+            # One exiftool process for each export thread.
+            exiftool.start_sessions(_get_jobs(options))
+        try:
+            export_iphoto(album, data, options.exclude, options)
+        finally:
+            exiftool.stop_sessions()
 
 
 if __name__ == "__main__":
@@ -15,8 +15,28 @@
 #   limitations under the License.
    
 import datetime
+import time
 
 from xml import sax
+from xml.etree import cElementTree
+
+# Top level containers of AlbumData.xml that iter_applexml() reports one entry
+# at a time, instead of as a complete dict or list.
+STREAMED_KEYS = ("Master Image List", "List of Albums", "List of Rolls")
+
+# Number of bytes read from the XML file per parser feed.
+_READ_CHUNK_SIZE = 256 * 1024
+
+# Parser backends for read_applexml() and iter_applexml(). "etree" uses the C
+# implementation of ElementTree.iterparse, and converts the entries of top
+# level containers in one go, clearing the parsed elements as it goes. "sax"
+# makes a Python callback for every element. Both build identical trees.
+PARSER_BACKENDS = ("etree", "sax")
+DEFAULT_BACKEND = "etree"
+
+# Simple value elements, and the elements that give the data structure.
+_VALUE_TAGS = ("key", "date", "string", "integer", "real", "data")
+_STRUCTURE_TAGS = ("plist", "dict", "array")
 
 #APPLE_BASE = time.mktime((2001, 1, 1, 0, 0, 0, 0, 0, -1))
 APPLE_BASE = 978307200 # 2001/1/1
@@ -29,6 +49,10 @@ def getappletime(value):
         # bad time stamp in database, default to "now"
         return datetime.datetime.now()
 
+def getappletimestamp(date):
+    '''Converts a date and time into a numeric Apple time stamp'''
+    return time.mktime(date.timetuple()) + date.microsecond / 1e6 - APPLE_BASE
+
 class AppleXMLResolver(sax.handler.EntityResolver): #IGNORE:W0232
     '''Helper to deal with XML entity resolving'''
     
@@ -55,6 +79,16 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         else:
             current_top[self.key] = xml_object
      
+    def add_complete_object(self, xml_object):
+        '''Adds an object that was parsed in one go, including all of its
+        content.'''
+        self.add_object(xml_object)
+
+    def wants_entry(self): #IGNORE:R0201
+        '''Tests if the value for the current key should be built. Parsers
+        that build values in one go can skip the ones that are not wanted.'''
+        return True
+
     def startElement(self, name, _attributes): #IGNORE:C0103
         '''Handles the start of an XML element'''
         self._parsingdata = False
@@ -120,13 +154,239 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         return self.top_node[0]
 
       
-def read_applexml(filename):
-    '''Reads the named file, and parses it as an Apple XML file. Returns the top 
-    node.'''
+def _etree_text(element):
+    '''Returns the text of a simple value element, as AppleXMLHandler would
+    collect it.'''
+    text = element.text
+    if text is None:
+        return None
+    if element.tag == "data":
+        # <data> content is split over several lines, see
+        # AppleXMLHandler.characters().
+        text = "".join(text.split())
+    # ElementTree returns plain strings for ASCII text.
+    return unicode(text)
+
+
+def _etree_object(element):
+    '''Converts an element and its content into the objects that
+    AppleXMLHandler builds for it.'''
+    tag = element.tag
+    if tag == "dict":
+        result = {}
+        key = None
+        for child in element:
+            if child.tag == "key":
+                key = _etree_text(child)
+            else:
+                result[key] = _etree_object(child)
+        return result
+    if tag == "array":
+        return [_etree_object(child) for child in element]
+    if tag == "true":
+        return True
+    if tag == "false":
+        return False
+    if tag not in _VALUE_TAGS:
+        print "unrecognized element in XML data: " + tag
+    return _etree_text(element)
+
+
+def _parse_etree(xml_file, handler):
+    '''Parses xml_file with ElementTree.iterparse, and reports the plist
+    structure down to the entries of the top level containers to handler.
+    Each entry is converted in one go, and then cleared. Yields after every
+    top level key, value, or container entry.'''
+    depth = 0
+    # Open elements at depth 1 (plist), 2 (top dict), and 3 (top level
+    # containers). Entries are cleared from their parent once converted.
+    parents = [None, None, None, None]
+    for (event, element) in cElementTree.iterparse(
+        xml_file, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth <= 3:
+                parents[depth] = element
+                if element.tag in _STRUCTURE_TAGS:
+                    handler.startElement(element.tag, None)
+            continue
+        depth -= 1
+        if depth > 3:
+            continue
+        if depth == 3:
+            # an entry of a top level container
+            if element.tag == "key":
+                handler.key = _etree_text(element)
+            elif handler.wants_entry():
+                handler.add_complete_object(_etree_object(element))
+        elif element.tag in _STRUCTURE_TAGS:
+            handler.endElement(element.tag)
+        else:
+            # top level key or simple value
+            handler.startElement(element.tag, None)
+            handler.chars = _etree_text(element)
+            handler.endElement(element.tag)
+        if depth:
+            parents[depth].clear()
+        yield None
+
+
+def _parse_sax(xml_file, handler):
+    '''Parses xml_file with the xml.sax reader, and reports every element to
+    handler. Yields after every chunk of data.'''
     parser = sax.make_parser()
-    handler = AppleXMLHandler()
     parser.setContentHandler(handler)
     parser.setEntityResolver(AppleXMLResolver())
-    parser.parse(filename)
+    while True:
+        chunk = xml_file.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        yield None
+    parser.close()
+    yield None
+
+
+def _parse(xml_file, handler, backend):
+    '''Parses xml_file into handler with the named backend. Returns a
+    generator that yields whenever handler may have new data.'''
+    if backend == "etree":
+        return _parse_etree(xml_file, handler)
+    if backend == "sax":
+        return _parse_sax(xml_file, handler)
+    raise ValueError, "Unknown XML parser backend %s (use one of %s)" % (
+        backend, ", ".join(PARSER_BACKENDS))
+
+
+def read_applexml(filename, backend=DEFAULT_BACKEND):
+    '''Reads the named file, and parses it as an Apple XML file. Returns the top 
+    node. backend is one of PARSER_BACKENDS.'''
+    handler = AppleXMLHandler()
+    xml_file = open(filename, "rb")
+    try:
+        for _ in _parse(xml_file, handler, backend):
+            pass
+    finally:
+        xml_file.close()
     return handler.gettopnode()
 
+
+class AppleXMLStreamHandler(AppleXMLHandler):
+    '''Parses an Apple XML file, and reports the top level values as events
+    instead of building a tree for the whole file.
+
+    Each event is a (key, item_key, value) tuple. For the containers named in
+    streamed_keys, there is one event per entry, with item_key set to the
+    dict key or list index of the entry. All other top level values are
+    reported as a single event with item_key set to None. Events are collected
+    in self.events until the caller removes them.
+
+    If entry_filter is set, it is called as entry_filter(key, item_key) for the
+    entries of streamed dicts by parsers that build entries in one go, which
+    then skip the entries for which it returns False. Other parsers report
+    all entries.'''
+
+    def __init__(self, streamed_keys, entry_filter=None):
+        AppleXMLHandler.__init__(self)
+        self.streamed_keys = streamed_keys
+        self.entry_filter = entry_filter
+        self.events = []
+        self._top_key = None  # key of the current top level value
+        self._section = None  # key of the current streamed container
+        self._section_index = 0
+        self._item_key = None  # key or index of the current streamed entry
+
+    def wants_entry(self):
+        '''Tests if the value for the current key should be built, which is
+        not the case for entries of streamed dicts rejected by
+        entry_filter.'''
+        if (self.entry_filter and self._section and
+            len(self.parse_stack) == 3 and
+            isinstance(self.parse_stack[-1], dict)):
+            return self.entry_filter(self._section, self.key)
+        return True
+
+    def add_object(self, xml_object):
+        '''Adds an object to the current container, or reports it as an
+        event if it is a top level value or an entry of a streamed
+        container.'''
+        depth = len(self.parse_stack)
+        is_container = isinstance(xml_object, (dict, list))
+        if depth == 2:
+            self._top_key = self.key
+            if is_container and self.key in self.streamed_keys:
+                self._section = self.key
+                self._section_index = 0
+            elif not is_container:
+                self.events.append((self.key, None, xml_object))
+        elif depth == 3 and self._section:
+            if isinstance(self.parse_stack[-1], list):
+                self._item_key = self._section_index
+                self._section_index += 1
+            else:
+                self._item_key = self.key
+            if not is_container:
+                self.events.append((self._section, self._item_key,
+                                    xml_object))
+        else:
+            AppleXMLHandler.add_object(self, xml_object)
+
+    def add_complete_object(self, xml_object):
+        '''Adds an object that was parsed in one go, including all of its
+        content, and reports it if it is an entry of a streamed container.'''
+        self.add_object(xml_object)
+        if (len(self.parse_stack) == 3 and self._section and
+            isinstance(xml_object, (dict, list))):
+            self.events.append((self._section, self._item_key, xml_object))
+
+    def endElement(self, name): #IGNORE:C0103
+        '''callback for the end of a parsed XML element'''
+        if name == "dict" or name == "array":
+            xml_object = self.parse_stack.pop()
+            depth = len(self.parse_stack)
+            if depth == 3 and self._section:
+                self.events.append((self._section, self._item_key, xml_object))
+            elif depth == 2:
+                if self._section:
+                    self._section = None
+                else:
+                    self.events.append((self._top_key, None, xml_object))
+            self.chars = None
+        else:
+            AppleXMLHandler.endElement(self, name)
+
+
+def iter_applexml(filename, streamed_keys=STREAMED_KEYS,
+                  backend=DEFAULT_BACKEND, entry_filter=None):
+    '''Reads the named file as an Apple XML file, and yields
+    (key, item_key, value) events as they are parsed (see
+    AppleXMLStreamHandler). Only the value of one event is held in memory at a
+    time, rather than the tree of the whole file. backend is one of
+    PARSER_BACKENDS. With the etree backend, entry_filter can reject entries
+    of streamed dicts before they are built (see AppleXMLStreamHandler). It
+    is called after all previous events have been consumed.'''
+    handler = AppleXMLStreamHandler(streamed_keys, entry_filter)
+    xml_file = open(filename, "rb")
+    try:
+        for _ in _parse(xml_file, handler, backend):
+            for event in handler.events:
+                yield event
+            del handler.events[:]
+    finally:
+        xml_file.close()
+
+
+def iter_appledata(top_node, streamed_keys=STREAMED_KEYS):
+    '''Yields the same events as iter_applexml() for a tree that was already
+    read with read_applexml(). Top level values are reported in key order, as
+    in the XML file.'''
+    for key in sorted(top_node):
+        value = top_node[key]
+        if key in streamed_keys and isinstance(value, dict):
+            for item_key, item in value.iteritems():
+                yield (key, item_key, item)
+        elif key in streamed_keys and isinstance(value, list):
+            for index, item in enumerate(value):
+                yield (key, index, item)
+        else:
+            yield (key, None, value)
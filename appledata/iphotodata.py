@@ -39,61 +39,218 @@ None - should not really happen
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import cPickle
 import datetime
+import hashlib
 import os
+import re
 import sys
 
 import appledata.applexml as applexml
 import tilutil.systemutils as sysutils
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # ImageTable is not available
+
+# Version of the parsed library cache format. Increment whenever the pickled
+# classes change, so stale caches are ignored.
+_CACHE_VERSION = 7
+
+# Shared value for empty lists in IPhotoImage.
+_EMPTY = ()
+
+# Number of bytes at the start of AlbumData.xml that are hashed to validate
+# the parsed library cache, in addition to the file's size and mtime.
+_CACHE_HASH_BYTES = 64 * 1024
+
+class StringPool(object):
+    """Keeps one shared copy of strings that repeat across the records of a
+    library, like keywords, face names, event ids, and the directories of
+    image paths."""
+
+    def __init__(self):
+        self._strings = {}
+        self.directories = []  # table of directories, indexed by id
+        self._directory_ids = {}
+
+    def intern(self, value):
+        """Returns the shared copy of value."""
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+    def split_path(self, path):
+        """Splits path into a (directory id, file name) pair, adding the
+        directory to the directory table if needed."""
+        if path is None:
+            return (None, None)
+        (directory, name) = os.path.split(path)
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = len(self.directories)
+            self.directories.append(directory)
+            self._directory_ids[directory] = directory_id
+        return (directory_id, name)
+
+    def join_path(self, directory_id, name):
+        """Returns the path for a pair returned by split_path()."""
+        if name is None:
+            return None
+        return os.path.join(self.directories[directory_id], name)
+
+
+class ImageSelection(object):
+    """Selects the events and albums to load from a library, using the same
+    rules as the exporter: an album is selected if its name, or the name of
+    one of its folders, matches an include pattern for its album type, and
+    its name does not match the exclude pattern. Patterns are regular
+    expressions, matched at the start of names."""
+
+    def __init__(self, excludes=None):
+        self._includes = []  # list of (album types, compiled pattern)
+        self._exclude = None
+        if excludes:
+            self._exclude = re.compile(excludes)
+
+    def add(self, album_types, includes):
+        """Selects albums of one of the album_types whose names match the
+        pattern includes. Use "Event" for events."""
+        self._includes.append((album_types, re.compile(includes)))
+
+    def matches(self, albumtype, name, folder_names):
+        """Tests if an album or event is selected. folder_names are the names
+        of the folders that contain it."""
+        if self._exclude and self._exclude.match(name):
+            return False
+        for (album_types, pattern) in self._includes:
+            if not albumtype in album_types:
+                continue
+            if pattern.match(name):
+                return True
+            for folder_name in folder_names:
+                if pattern.match(folder_name):
+                    return True
+        return False
+
+    def select_images(self, album_data, roll_data):
+        """Returns the set of ids of the images in the selected albums and
+        events, given their raw data records. Folders come before the albums
+        they contain in album_data."""
+        images = set()
+        folder_names = {}  # folder id -> names of the folder and its parents
+        for data in album_data:
+            name = data.get("AlbumName") or "xxx"
+            albumtype = data.get("Album Type")
+            parent_folders = folder_names.get(data.get("Parent"), ())
+            if albumtype == "Folder":
+                folder_names[data.get("AlbumId")] = parent_folders + (name,)
+            elif self.matches(albumtype, name, parent_folders):
+                images.update(data.get("KeyList") or ())
+        for data in roll_data:
+            name = data.get("RollName") or data.get("AlbumName") or "xxx"
+            if self.matches("Event", name, ()):
+                images.update(data.get("KeyList") or ())
+        return images
+
+
 class IPhotoData(object):
     """top level iPhoto data node."""
 
-    def __init__(self, xml_data):
-        """# call with results of readAppleXML."""
-        self.data = xml_data
+    def __init__(self, xml_data=None, selection=None):
+        """# call with results of readAppleXML, or with None, and then pass
+        the events from applexml.iter_applexml() to load_events(). If
+        selection (an ImageSelection) is set, only the images of the selected
+        albums and events are loaded; all albums and events are still
+        loaded, but others can have missing images."""
+        self.data = {}
+        self.selection = selection
+        self.partial = False  # True if not all images were loaded
 
         self.albums = {}
         self.face_albums = None
 
         # Master map of keywords
-        self.keywords = self.data.get("List of Keywords")
+        self.keywords = {}
 
         self.face_names = {}  # Master map of faces
-        face_list = self.data.get("List of Faces")
-        if face_list:
-            for face_entry in face_list.values():
-                face_key = face_entry.get("key")
-                face_name = face_entry.get("name")
-                self.face_names[face_key] = face_name
-                # Other keys in face_entry: image, key image face index, PhotoCount, Order
-
+        self.strings = StringPool()
         self.images_by_id = {}
-        image_data = self.data.get("Master Image List")
-        if image_data:
-            for key in image_data:
-                image = IPhotoImage(image_data.get(key), self.keywords, self.face_names)
-                self.images_by_id[key] = image
+        self.master_album = None
+        self._rolls = {}
 
-        album_data = self.data.get("List of Albums")
+        self.images_by_base_name = None
+        self.images_by_file_name = None
 
-        self.master_album = None
-        for data in album_data:
+        # Raw album and event data, while events are loaded.
+        self._album_data = []
+        self._roll_data = []
+        self._selected_images = None
+        self._image_table = None
+
+        if xml_data is not None:
+            self.load_events(applexml.iter_appledata(xml_data))
+
+    def load_events(self, xml_events):
+        """Builds the library data from (key, item_key, value) events, as
+        generated by applexml.iter_applexml().
+
+        Images are created as their events arrive. Album and event data refer
+        to images, and are kept until all events have been read."""
+        for (key, item_key, value) in xml_events:
+            if key == "Master Image List":
+                if self.wants_entry(key, item_key):
+                    self.images_by_id[item_key] = IPhotoImage(value, self)
+            elif key == "List of Albums":
+                self._album_data.append(value)
+            elif key == "List of Rolls":
+                self._roll_data.append(value)
+            elif key == "List of Keywords":
+                for (keyword_id, keyword) in value.iteritems():
+                    self.keywords[keyword_id] = self.strings.intern(keyword)
+            elif key == "List of Faces":
+                for face_entry in value.values():
+                    face_key = face_entry.get("key")
+                    face_name = self.strings.intern(face_entry.get("name"))
+                    self.face_names[face_key] = face_name
+                    # Other keys in face_entry: image, key image face index,
+                    # PhotoCount, Order
+            else:
+                self.data[key] = value
+
+        self.partial = self._selected_images is not None
+        for data in self._album_data:
             album = IPhotoAlbum(data, self.images_by_id, self.albums,
-                                self.master_album)
+                                self.master_album, self.partial)
             self.albums[album.albumid] = album
             if album.master:
                 self.master_album = album
 
-        roll_data = self.data.get("List of Rolls")
-        self._rolls = {}
-        if roll_data:
-            for roll in roll_data:
-                roll = IPhotoRoll(roll, self.images_by_id)
-                self._rolls[roll.albumid] = roll
-
-        self.images_by_base_name = None
-        self.images_by_file_name = None
+        for roll in self._roll_data:
+            roll = IPhotoRoll(roll, self.images_by_id, self.strings,
+                              self.partial)
+            self._rolls[roll.albumid] = roll
+        self._album_data = []
+        self._roll_data = []
+        self._selected_images = None
+
+    def wants_entry(self, key, item_key):
+        """Tests if entry item_key of the top level container key should be
+        loaded. Can be passed as entry_filter to applexml.iter_applexml().
+
+        With a selection, only the images of the selected albums and events
+        are wanted. These are determined when the first image comes up, as
+        album and event data come before the images in AlbumData.xml."""
+        if key != "Master Image List" or self.selection is None:
+            return True
+        if self._selected_images is None:
+            if not self._album_data and not self._roll_data:
+                # No albums or events yet, so we cannot select.
+                return True
+            self._selected_images = self.selection.select_images(
+                self._album_data, self._roll_data)
+        return item_key in self._selected_images
 
     def _build_image_name_list(self):
         self.images_by_base_name = {}
@@ -156,6 +313,13 @@ class IPhotoData(object):
                 image_map[image.originalpath] = image
         return image_map
 
+    def getimagetable(self):
+        """Returns the ImageTable (columnar NumPy view) of the images, built
+        on first use. Raises ImportError if NumPy is not installed."""
+        if self._image_table is None:
+            self._image_table = ImageTable(self)
+        return self._image_table
+
     def checkalbumsizes(self, max_size):
         """Prints a message for any event or album that has too many images."""
         messages = []
@@ -232,46 +396,120 @@ class IPhotoData(object):
 class IPhotoImage(object):
     """Describes an image in the iPhoto database."""
 
-    def __init__(self, data, keyword_map, face_map):
-        self.data = data
+    # Only the fields that are used are kept, not the raw data record. Empty
+    # lists are represented by the shared _EMPTY tuple. Paths are stored as
+    # (directory id, file name) pairs, see StringPool.split_path(). Dates,
+    # GPS, keywords and faces are kept in their raw form, and only decoded
+    # when they are first used.
+    __slots__ = ("caption", "comment", "_date", "_mod_date", "_library",
+                 "_image_dir", "_image_name", "_thumb_dir", "_thumb_name",
+                 "_original_dir", "_original_name", "mediatype", "rating",
+                 "_gps", "_keywords", "roll", "rotation_is_only_edit",
+                 "albums", "_faces", "_face_rectangles", "placenames")
+
+    def __init__(self, data, library):
+        """Creates an image from its data record. library is the IPhotoData
+        with the keyword and face maps and the string pool."""
+        strings = library.strings
+        self._library = library
         self.caption = data.get("Caption")
         self.comment = data.get("Comment")
-        self.date = applexml.getappletime(data.get("DateAsTimerInterval"))
-        self.mod_date = applexml.getappletime(data.get("ModDateAsTimerInterval"))
-        self.image_path = data.get("ImagePath")
+        self._date = data.get("DateAsTimerInterval")
+        self._mod_date = data.get("ModDateAsTimerInterval")
+        (self._image_dir, self._image_name) = strings.split_path(
+            data.get("ImagePath"))
+        (self._thumb_dir, self._thumb_name) = strings.split_path(
+            data.get("ThumbPath"))
+        (self._original_dir, self._original_name) = strings.split_path(
+            data.get("OriginalPath"))
+        self.mediatype = strings.intern(data.get("MediaType"))
         self.rating = int(data.get("Rating"))
         if data.get("longitude"):
-            latitude = float(data.get("latitude"))
-            longitude = float(data.get("longitude"))
-            self.gps = (float("%.6f" % (latitude)), float("%.6f" % (longitude)))
+            self._gps = (data.get("latitude"), data.get("longitude"))
         else:
-            self.gps = None
+            self._gps = None
 
-        self.keywords = []
         keyword_list = data.get("Keywords")
-        if keyword_list is not None:
-            for i in keyword_list:
-                self.keywords.append(keyword_map.get(i))
+        if keyword_list:
+            # tuple of keyword ids, decoded into a list of keywords on first
+            # use.
+            self._keywords = tuple([strings.intern(i) for i in keyword_list])
+        else:
+            self._keywords = _EMPTY
 
-        self.originalpath = data.get("OriginalPath")
-        self.roll = data.get("Roll")
+        self.roll = strings.intern(data.get("Roll"))
+        self.rotation_is_only_edit = data.get("RotationIsOnlyEdit")
 
-        self.albums = []  # list of albums that this image belongs to
-        self.faces = []
-        self.face_rectangles = []
-        self.placenames = []
+        self.albums = _EMPTY  # list of albums that this image belongs to
+        self.placenames = _EMPTY
 
+        # (face key, rectangle) pairs, decoded into _faces and
+        # _face_rectangles on first use (_face_rectangles is None until then).
+        self._faces = _EMPTY
+        self._face_rectangles = _EMPTY
         face_list = data.get("Faces")
         if face_list:
-            for face_entry in face_list:
-                face_key = face_entry.get("face key")
-                face_name = face_map.get(face_key)
-                if face_name:
-                    self.faces.append(face_name)
-                    # Rectangle is '{{x, y}, {width, height}}' as ratios,
-                    # referencing the lower left corner of the face rectangle.
-                    self.face_rectangles.append(self._parse_face_rectangle(face_entry.get("rectangle")))
-                # Other keys in face_entry: face index
+            self._faces = tuple([(strings.intern(face_entry.get("face key")),
+                                  face_entry.get("rectangle"))
+                                 for face_entry in face_list])
+            self._face_rectangles = None
+            # Other keys in face_entry: face index
+
+    def _getdate(self):
+        if not isinstance(self._date, datetime.datetime):
+            self._date = applexml.getappletime(self._date)
+        return self._date
+    date = property(_getdate, doc="Date of image.")
+
+    def _getmoddate(self):
+        if not isinstance(self._mod_date, datetime.datetime):
+            self._mod_date = applexml.getappletime(self._mod_date)
+        return self._mod_date
+    mod_date = property(_getmoddate, doc="Modification date of image.")
+
+    def _getgps(self):
+        if self._gps and isinstance(self._gps[0], basestring):
+            latitude = float(self._gps[0])
+            longitude = float(self._gps[1])
+            self._gps = (float("%.6f" % (latitude)),
+                         float("%.6f" % (longitude)))
+        return self._gps
+    gps = property(_getgps, doc="(latitude, longitude) of image, or None.")
+
+    def _getkeywords(self):
+        if isinstance(self._keywords, tuple) and self._keywords:
+            keyword_map = self._library.keywords
+            self._keywords = [keyword_map.get(i) for i in self._keywords]
+        return self._keywords
+    keywords = property(_getkeywords, doc="List of keywords.")
+
+    def _decode_faces(self):
+        """Looks up the face names, and parses the face rectangles."""
+        face_map = self._library.face_names
+        faces = []
+        face_rectangles = []
+        for (face_key, rectangle) in self._faces:
+            face_name = face_map.get(face_key)
+            if face_name:
+                faces.append(face_name)
+                # Rectangle is '{{x, y}, {width, height}}' as ratios,
+                # referencing the lower left corner of the face rectangle.
+                face_rectangles.append(self._parse_face_rectangle(rectangle))
+        self._faces = faces or _EMPTY
+        self._face_rectangles = face_rectangles or _EMPTY
+
+    def _getfaces(self):
+        if self._face_rectangles is None:
+            self._decode_faces()
+        return self._faces
+    faces = property(_getfaces, doc="List of face names.")
+
+    def _getfacerectangles(self):
+        if self._face_rectangles is None:
+            self._decode_faces()
+        return self._face_rectangles
+    face_rectangles = property(_getfacerectangles,
+                               doc="List of face rectangles, matching faces.")
 
     def _parse_face_rectangle(self, string_data):
         """Parse a rectangle specification into an array of coordinate data.
@@ -290,16 +528,15 @@ class IPhotoImage(object):
 
     def getimagepath(self):
         """Returns the full path to this image.."""
-        return self.image_path
+        return self._library.strings.join_path(self._image_dir, self._image_name)
 
     def getimagename(self):
         """Returns the file name of this image.."""
-        name = os.path.split(self.image_path)[1]
-        return name
+        return self._image_name
 
     def getbasename(self):
         """Returns the base name of the main image file."""
-        return sysutils.getfilebasename(self.image_path)
+        return sysutils.getfilebasename(self._image_name)
 
     def getcaption(self):
         """gets the caption (title) of the image."""
@@ -309,15 +546,19 @@ class IPhotoImage(object):
 
     def ismovie(self):
         """Tests if this image is a movie."""
-        return self.data.get("MediaType") == "Movie"
+        return self.mediatype == "Movie"
 
     def addalbum(self, album):
         """Adds an album to the list of albums for this image."""
+        if not self.albums:
+            self.albums = []
         self.albums.append(album)
 
     def addface(self, name):
         """Adds a face (name) to the list of faces for this image."""
-        self.faces.append(name)
+        if not self.faces:
+            self._faces = []
+        self._faces.append(name)
 
     def getfaces(self):
         """Gets the list of face tags for this image."""
@@ -327,28 +568,36 @@ class IPhotoImage(object):
         """Tests if the image is hidden (using keyword "Hidden")"""
         return "Hidden" in self.keywords
 
+    def _getimagepath(self):
+        return self.getimagepath()
+    image_path = property(_getimagepath, doc="Path to image")
+
     def _getthumbpath(self):
-        return self.data.get("ThumbPath")
+        return self._library.strings.join_path(self._thumb_dir, self._thumb_name)
     thumbpath = property(_getthumbpath, doc="Path to thumbnail image")
 
-    def _getrotationisonlyedit(self):
-        return self.data.get("RotationIsOnlyEdit")
-    rotation_is_only_edit = property(_getrotationisonlyedit,
-                                     doc="Rotation is only edit.")
+    def _getoriginalpath(self):
+        return self._library.strings.join_path(self._original_dir, self._original_name)
+    originalpath = property(_getoriginalpath, doc="Path to original image")
 
 
 class IPhotoContainer(object):
     """Base class for IPhotoAlbum and IPhotoRoll."""
 
-    def __init__(self, data, albumtype, master, images):
-        self.data = data
+    __slots__ = ("name", "albumtype", "albumid", "comment", "images", "albums",
+                 "master")
 
+    def __init__(self, data, albumtype, master, images, partial=False):
+        """Creates a container with the images listed in data. If partial is
+        set, images only has some of the library's images, and missing
+        images are left out silently."""
         self.name = ""
         self.albumtype = albumtype
         self.albumid = -1
         self.images = []
         self.albums = []
         self.master = master
+        self.comment = data.get("Comments")  # comments (description)
 
         if not self.isfolder():
             keylist = data.get("KeyList")
@@ -356,13 +605,9 @@ class IPhotoContainer(object):
                 image = images.get(key)
                 if image:
                     self.images.append(image)
-                else:
+                elif not partial:
                     print "%s: image with id %s does not exist." % (self.tostring(), key)
 
-    def _getcomment(self):
-        return self.data.get("Comments")
-    comment = property(_getcomment, doc='comments (description)')
-
     def _getsize(self):
         return len(self.images)
     size = property(_getsize, "Gets the size (# of images) of this album.")
@@ -400,26 +645,33 @@ class IPhotoContainer(object):
 class IPhotoRoll(IPhotoContainer):
     """Describes an iPhoto Roll or Event."""
 
-    def __init__(self, data, images):
-        IPhotoContainer.__init__(self, data, "Event", False, images)
+    __slots__ = ("_roll_date",)
+
+    def __init__(self, data, images, strings, partial=False):
+        IPhotoContainer.__init__(self, data, "Event", False, images, partial)
+        self._roll_date = data.get("RollDateAsTimerInterval")
         self.albumid = data.get("RollID")
         if not self.albumid:
             self.albumid = data.get("AlbumId")
+        self.albumid = strings.intern(self.albumid)
         self.name = data.get("RollName")
         if not self.name:
             self.name = data.get("AlbumName")
+        self.name = strings.intern(self.name)
 
     def _getdate(self):
-        return applexml.getappletime(self.data.get("RollDateAsTimerInterval"))
+        return applexml.getappletime(self._roll_date)
     date = property(_getdate, doc="Date of event.")
 
 
 class IPhotoAlbum(IPhotoContainer):
     """Describes an iPhoto Album."""
 
-    def __init__(self, data, images, album_map, master_album):
+    __slots__ = ("parent", "_date")
+
+    def __init__(self, data, images, album_map, master_album, partial=False):
         IPhotoContainer.__init__(self, data, data.get("Album Type"),
-                                 data.get("Master"), images)
+                                 data.get("Master"), images, partial)
         self.albumid = data.get("AlbumId")
         self.name = data.get("AlbumName")
 
@@ -435,16 +687,24 @@ class IPhotoAlbum(IPhotoContainer):
                     self.name, parent_id)
         else:
             self.parent.addalbum(self)
+        self._date = None
 
-        # Albums have no date attribute, so we calculate it from the image dates.
-        self.date = datetime.datetime.now()
-        for image in images.values():
-            if image.date < self.date:
-                self.date = image.date
+    def _getdate(self):
+        # Albums have no date attribute, so we calculate it from the dates of
+        # the album's images the first time it is needed.
+        if self._date is None:
+            self._date = datetime.datetime.now()
+            for image in self.images:
+                if image.date < self._date:
+                    self._date = image.date
+        return self._date
+    date = property(_getdate, doc="Date of the oldest image in the album.")
 
 class IPhotoFace(object):
     """An IPhotoContainer compatible class for a face."""
 
+    __slots__ = ("name", "albumtype", "albumid", "images", "albums", "comment")
+
     def __init__(self, face):
         self.name = face
         self.albumtype = "Face"
@@ -478,6 +738,180 @@ class IPhotoFace(object):
         return "%s (%s)" % (self.name, self.albumtype)
 
 
+class ImageTable(object):
+    """Columnar view of the images of an IPhotoData, for filters and
+    statistics over a whole library. Each column is a NumPy array with one
+    entry per image, in the order of the images list:
+
+    ids - image ids (int64)
+    date, mod_date - Apple time stamps (float64, NaN if unknown)
+    rating - ratings (int8)
+    latitude, longitude - GPS location (float64, NaN if unknown)
+    roll - index into roll_ids (int32, -1 if unknown)
+    mediatype - index into mediatypes (int8)
+
+    Keywords and faces are stored as indexes into keyword_names and
+    face_names, in keyword_index and face_index. The entries for image i are
+    keyword_index[keyword_offsets[i]:keyword_offsets[i + 1]], and likewise
+    for faces.
+
+    Filter methods return boolean masks over the rows, which can be combined
+    with & and |, and turned back into images with getimages().
+    """
+
+    def __init__(self, library):
+        if numpy is None:
+            raise ImportError, "NumPy is needed for image tables."
+        keys = sorted(library.images_by_id, key=int)
+        self.images = [library.images_by_id[key] for key in keys]
+        self._rows = dict((image, row) for (row, image) in
+                          enumerate(self.images))
+        self.roll_ids = sorted([roll.albumid for roll in library.rolls])
+        self.mediatypes = []
+        self.keyword_names = []
+        self.face_names = []
+        roll_map = dict((roll_id, i) for (i, roll_id) in
+                        enumerate(self.roll_ids))
+        mediatype_map = {}
+        keyword_map = {}
+        face_map = {}
+
+        count = len(self.images)
+        self.ids = numpy.array([int(key) for key in keys], dtype=numpy.int64)
+        self.date = numpy.empty(count, dtype=numpy.float64)
+        self.mod_date = numpy.empty(count, dtype=numpy.float64)
+        self.rating = numpy.empty(count, dtype=numpy.int8)
+        self.latitude = numpy.empty(count, dtype=numpy.float64)
+        self.longitude = numpy.empty(count, dtype=numpy.float64)
+        self.roll = numpy.empty(count, dtype=numpy.int32)
+        self.mediatype = numpy.empty(count, dtype=numpy.int8)
+        self.keyword_offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+        self.face_offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+        keyword_index = []
+        face_index = []
+
+        for (row, image) in enumerate(self.images):
+            self.date[row] = _get_timestamp(image._date)
+            self.mod_date[row] = _get_timestamp(image._mod_date)
+            self.rating[row] = image.rating
+            gps = image.gps
+            if gps:
+                (self.latitude[row], self.longitude[row]) = gps
+            else:
+                self.latitude[row] = self.longitude[row] = numpy.nan
+            self.roll[row] = roll_map.get(image.roll, -1)
+            self.mediatype[row] = _get_index(mediatype_map, self.mediatypes,
+                                             image.mediatype)
+            for keyword in image.keywords:
+                keyword_index.append(_get_index(keyword_map,
+                                                self.keyword_names, keyword))
+            self.keyword_offsets[row + 1] = len(keyword_index)
+            for face in image.faces:
+                face_index.append(_get_index(face_map, self.face_names, face))
+            self.face_offsets[row + 1] = len(face_index)
+        self.keyword_index = numpy.array(keyword_index, dtype=numpy.int32)
+        self.face_index = numpy.array(face_index, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.images)
+
+    def getimages(self, mask):
+        """Returns the list of images selected by a boolean mask or an array
+        of row numbers."""
+        rows = numpy.asarray(mask)
+        if rows.dtype == numpy.bool_:
+            rows = numpy.flatnonzero(rows)
+        return [self.images[row] for row in rows]
+
+    def getrows(self, images):
+        """Returns the array of row numbers of images, e.g. the images of an
+        album. Images that are not in the table are skipped."""
+        rows = self._rows
+        return numpy.array([rows[image] for image in images if image in rows],
+                           dtype=numpy.int32)
+
+    def date_mask(self, start=None, end=None):
+        """Selects images taken at or after start, and before end (both
+        datetimes). Images without a date are never selected."""
+        mask = ~numpy.isnan(self.date)
+        if start is not None:
+            mask &= self.date >= applexml.getappletimestamp(start)
+        if end is not None:
+            mask &= self.date < applexml.getappletimestamp(end)
+        return mask
+
+    def rating_mask(self, min_rating, max_rating=5):
+        """Selects images rated between min_rating and max_rating."""
+        return (self.rating >= min_rating) & (self.rating <= max_rating)
+
+    def mediatype_mask(self, mediatype):
+        """Selects images of one media type, e.g. "Image" or "Movie"."""
+        if not mediatype in self.mediatypes:
+            return numpy.zeros(len(self.images), dtype=numpy.bool_)
+        return self.mediatype == self.mediatypes.index(mediatype)
+
+    def gps_mask(self):
+        """Selects images with a GPS location."""
+        return ~numpy.isnan(self.latitude)
+
+    def keyword_mask(self, keyword):
+        """Selects images tagged with a keyword."""
+        return self._list_mask(self.keyword_names, self.keyword_index,
+                               self.keyword_offsets, keyword)
+
+    def face_mask(self, face):
+        """Selects images showing a face (name)."""
+        return self._list_mask(self.face_names, self.face_index,
+                               self.face_offsets, face)
+
+    def _list_mask(self, names, index, offsets, name):
+        """Selects the rows with name in their section of index."""
+        mask = numpy.zeros(len(self.images), dtype=numpy.bool_)
+        if name in names:
+            positions = numpy.flatnonzero(index == names.index(name))
+            mask[numpy.searchsorted(offsets, positions, side="right") - 1] = True
+        return mask
+
+    def roll_sizes(self):
+        """Returns a map from roll (event) id to the number of images in that
+        event."""
+        counts = numpy.bincount(self.roll[self.roll >= 0],
+                                minlength=len(self.roll_ids))
+        return dict(zip(self.roll_ids, counts.tolist()))
+
+    def date_range(self, rows=None):
+        """Returns the (oldest, newest) dates of the images in rows (a mask
+        or an array of row numbers, default all images), or None if none of
+        them has a date."""
+        dates = self.date
+        if rows is not None:
+            dates = dates[rows]
+        dates = dates[~numpy.isnan(dates)]
+        if not len(dates):
+            return None
+        return (applexml.getappletime(dates.min()),
+                applexml.getappletime(dates.max()))
+
+
+def _get_timestamp(value):
+    """Converts a raw or decoded image date into an Apple time stamp."""
+    if value is None:
+        return numpy.nan
+    if isinstance(value, datetime.datetime):
+        return applexml.getappletimestamp(value)
+    return float(value)
+
+
+def _get_index(index_map, values, value):
+    """Returns the index of value in values, adding it if needed."""
+    index = index_map.get(value)
+    if index is None:
+        index = len(values)
+        index_map[value] = index
+        values.append(value)
+    return index
+
+
 def get_album_xmlfile(library_dir):
     """Locates the iPhoto AlbumData.xml file."""
     if os.path.exists(library_dir) and os.path.isdir(library_dir):
@@ -488,18 +922,97 @@ def get_album_xmlfile(library_dir):
         "location.") % (library_dir)
 
 
-def get_iphoto_data(album_xml_file, do_places=False):
-    """reads the iPhoto database and converts it into an iPhotoData object."""
+def _get_cache_file(album_xml_file, cache_dir):
+    """Returns the cache file for the parsed data of album_xml_file."""
+    path_hash = hashlib.sha1(
+        os.path.abspath(album_xml_file).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "iphotodata-%s.cache" % (path_hash))
+
+
+def _get_xml_signature(album_xml_file):
+    """Returns a tuple of the size, mtime, and a hash of the start of
+    album_xml_file, to test if a cached copy of its data is still valid."""
+    xml_stat = os.stat(album_xml_file)
+    xml_file = open(album_xml_file, "rb")
+    try:
+        head_hash = hashlib.sha1(xml_file.read(_CACHE_HASH_BYTES)).hexdigest()
+    finally:
+        xml_file.close()
+    return (xml_stat.st_size, xml_stat.st_mtime, head_hash)
+
+
+def _read_cached_data(cache_file, signature):
+    """Returns the IPhotoData stored in cache_file, or None if there is no
+    cache, or it does not match the signature of the AlbumData.xml file."""
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        cache = open(cache_file, "rb")
+        try:
+            # The header is pickled separately, so a stale cache can be
+            # rejected without loading the data.
+            (version, cache_signature) = cPickle.load(cache)
+            if version != _CACHE_VERSION or cache_signature != signature:
+                return None
+            return cPickle.load(cache)
+        finally:
+            cache.close()
+    except StandardError, ex:
+        print >> sys.stderr, "Ignoring unreadable cache %s: %s" % (
+            cache_file, ex)
+    return None
+
+
+def _write_cached_data(cache_file, signature, data):
+    """Stores data in cache_file, replacing any previous cache."""
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = cache_file + ".tmp"
+        cache = open(tmp_file, "wb")
+        try:
+            cPickle.dump((_CACHE_VERSION, signature), cache,
+                         cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(data, cache, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            cache.close()
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, cPickle.PicklingError), ex:
+        print >> sys.stderr, "Could not write cache %s: %s" % (cache_file, ex)
+
+
+def get_iphoto_data(album_xml_file, do_places=False,
+                    xml_parser=applexml.DEFAULT_BACKEND, cache_dir=None,
+                    selection=None):
+    """reads the iPhoto database and converts it into an iPhotoData object.
+    xml_parser selects the parser backend (see applexml.PARSER_BACKENDS). If
+    cache_dir is set, the parsed data is kept in a cache file in that folder,
+    and reused as long as AlbumData.xml does not change. If selection (an
+    ImageSelection) is set, only the images of the selected albums and
+    events are loaded, unless a valid cache exists. Data loaded this way is
+    not written to the cache."""
     library_dir = os.path.dirname(album_xml_file)
-    print "Reading iPhoto database from " + library_dir + "..."
-    album_xml = applexml.read_applexml(album_xml_file)
+    cache_file = None
+    if cache_dir:
+        cache_file = _get_cache_file(album_xml_file, cache_dir)
+        signature = _get_xml_signature(album_xml_file)
+        data = _read_cached_data(cache_file, signature)
+        if data is not None:
+            print "Read iPhoto database for %s from cache." % (library_dir)
+            return data
 
-    data = IPhotoData(album_xml)
+    print "Reading iPhoto database from " + library_dir + "..."
+    data = IPhotoData(selection=selection)
+    data.load_events(applexml.iter_applexml(album_xml_file,
+                                            backend=xml_parser,
+                                            entry_filter=data.wants_entry))
     if (not data.applicationVersion.startswith("8.") and
         not data.applicationVersion.startswith("7.") and
         not data.applicationVersion.startswith("6.")):
         raise ValueError, "iPhoto version %s not supported" % (
             data.applicationVersion)
 
-
+    if cache_file and selection is None:
+        _write_cached_data(cache_file, signature, data)
     return data
@@ -0,0 +1,180 @@
+"""Writes synthetic iPhoto AlbumData.xml files for the benchmarks."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import random
+import sys
+import tempfile
+
+from xml.sax import saxutils
+
+# The DOCTYPE line of real files is left out, so the sax parser does not try
+# to fetch the DTD from apple.com.
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+"""
+
+def _string(out, key, value):
+    """Writes a key and string value."""
+    out.write("\t<key>%s</key>\n\t<string>%s</string>\n" % (
+        key, saxutils.escape(value)))
+
+def write_albumdata(out, num_images, images_per_event=100,
+                    images_per_album=200, num_albums=None, num_keywords=50,
+                    num_faces=20, seed=1):
+    """Writes an AlbumData.xml with num_images images to the file out. By
+    default, there is one regular album for every images_per_album images."""
+    rnd = random.Random(seed)
+    num_rolls = max(1, num_images // images_per_event)
+    if num_albums is None:
+        num_albums = max(1, num_images // images_per_album)
+    out.write(_HEADER)
+    _string(out, "Application Version", "8.1.2 (424)")
+    out.write("\t<key>Archive Path</key>\n\t<string>/Users/test/Pictures/"
+              "iPhoto Library</string>\n")
+
+    out.write("\t<key>List of Albums</key>\n\t<array>\n")
+    out.write("\t\t<dict>\n\t\t\t<key>AlbumId</key>\n\t\t\t<integer>999000"
+              "</integer>\n\t\t\t<key>AlbumName</key>\n\t\t\t<string>Photos"
+              "</string>\n\t\t\t<key>Album Type</key>\n\t\t\t<string>Regular"
+              "</string>\n\t\t\t<key>Master</key>\n\t\t\t<true/>\n"
+              "\t\t\t<key>KeyList</key>\n\t\t\t<array>\n")
+    for i in xrange(num_images):
+        out.write("\t\t\t\t<string>%d</string>\n" % (i + 1))
+    out.write("\t\t\t</array>\n\t\t</dict>\n")
+    for a in xrange(num_albums):
+        out.write("\t\t<dict>\n\t\t\t<key>AlbumId</key>\n\t\t\t<integer>%d"
+                  "</integer>\n\t\t\t<key>AlbumName</key>\n\t\t\t<string>"
+                  "Album %d</string>\n\t\t\t<key>Album Type</key>\n\t\t\t"
+                  "<string>Regular</string>\n\t\t\t<key>Comments</key>\n"
+                  "\t\t\t<string>@Folder %d</string>\n\t\t\t<key>KeyList"
+                  "</key>\n\t\t\t<array>\n" % (999001 + a, a, a % 7))
+        for _ in xrange(images_per_album):
+            out.write("\t\t\t\t<string>%d</string>\n" % (
+                rnd.randint(1, num_images)))
+        out.write("\t\t\t</array>\n\t\t</dict>\n")
+    out.write("\t</array>\n")
+
+    out.write("\t<key>List of Faces</key>\n\t<dict>\n")
+    for f in xrange(num_faces):
+        out.write("\t\t<key>%d</key>\n\t\t<dict>\n\t\t\t<key>key</key>\n"
+                  "\t\t\t<integer>%d</integer>\n\t\t\t<key>name</key>\n"
+                  "\t\t\t<string>Person %d</string>\n\t\t</dict>\n" % (
+                      f, f, f))
+    out.write("\t</dict>\n")
+
+    out.write("\t<key>List of Keywords</key>\n\t<dict>\n")
+    for k in xrange(num_keywords):
+        out.write("\t\t<key>%d</key>\n\t\t<string>Keyword %d</string>\n" % (
+            k + 1, k + 1))
+    out.write("\t</dict>\n")
+
+    out.write("\t<key>List of Rolls</key>\n\t<array>\n")
+    for r in xrange(num_rolls):
+        out.write("\t\t<dict>\n\t\t\t<key>RollID</key>\n\t\t\t<integer>%d"
+                  "</integer>\n\t\t\t<key>RollName</key>\n\t\t\t<string>"
+                  "%d-%02d Event %d</string>\n\t\t\t<key>RollDateAsTimerInterval"
+                  "</key>\n\t\t\t<real>%d.000000</real>\n\t\t\t<key>KeyList"
+                  "</key>\n\t\t\t<array>\n" % (
+                      r + 1, 2001 + r % 10, r % 12 + 1, r,
+                      r * 86400))
+        for i in xrange(r * images_per_event,
+                        min(num_images, (r + 1) * images_per_event)):
+            out.write("\t\t\t\t<string>%d</string>\n" % (i + 1))
+        out.write("\t\t\t</array>\n\t\t</dict>\n")
+    out.write("\t</array>\n")
+    _string(out, "Major Version", "2")
+
+    out.write("\t<key>Master Image List</key>\n\t<dict>\n")
+    for i in xrange(num_images):
+        roll = i // images_per_event + 1
+        year = 2001 + (roll - 1) % 10
+        path = "/Users/test/Pictures/iPhoto Library/Masters/%d/%02d/%02d/" \
+            "Event %d/IMG_%05d.JPG" % (year, roll % 12 + 1, roll % 28 + 1,
+                                       roll, i)
+        out.write("\t\t<key>%d</key>\n\t\t<dict>\n" % (i + 1))
+        _string(out, "MediaType", rnd.random() < 0.05 and "Movie" or "Image")
+        _string(out, "Caption", "IMG_%05d" % (i))
+        _string(out, "Comment", rnd.random() < 0.2 and "Comment %d" % i or "")
+        _string(out, "GUID", "%032x" % (rnd.getrandbits(128)))
+        out.write("\t\t\t<key>Roll</key>\n\t\t\t<integer>%d</integer>\n" % (
+            roll))
+        out.write("\t\t\t<key>Rating</key>\n\t\t\t<integer>%d</integer>\n" % (
+            rnd.randint(0, 5)))
+        _string(out, "ImagePath", path)
+        _string(out, "ThumbPath", path.replace("/Masters/", "/Thumbnails/"))
+        if rnd.random() < 0.1:
+            _string(out, "OriginalPath",
+                    path.replace("/Masters/", "/Originals/"))
+        stamp = roll * 86400 + i
+        out.write("\t\t\t<key>DateAsTimerInterval</key>\n\t\t\t<real>"
+                  "%d.000000</real>\n" % (stamp))
+        out.write("\t\t\t<key>ModDateAsTimerInterval</key>\n\t\t\t<real>"
+                  "%d.000000</real>\n" % (stamp + 3600))
+        out.write("\t\t\t<key>Keywords</key>\n\t\t\t<array>\n")
+        for _ in xrange(rnd.randint(0, 3)):
+            out.write("\t\t\t\t<string>%d</string>\n" % (
+                rnd.randint(1, num_keywords)))
+        out.write("\t\t\t</array>\n")
+        if rnd.random() < 0.3:
+            out.write("\t\t\t<key>Faces</key>\n\t\t\t<array>\n")
+            out.write("\t\t\t\t<dict>\n\t\t\t\t\t<key>face key</key>\n"
+                      "\t\t\t\t\t<integer>%d</integer>\n\t\t\t\t\t<key>"
+                      "rectangle</key>\n\t\t\t\t\t<string>{{0.25, 0.4}, "
+                      "{0.2, 0.15}}</string>\n\t\t\t\t</dict>\n" % (
+                          rnd.randint(0, num_faces - 1)))
+            out.write("\t\t\t</array>\n")
+        if rnd.random() < 0.2:
+            out.write("\t\t\t<key>latitude</key>\n\t\t\t<real>%f</real>\n"
+                      "\t\t\t<key>longitude</key>\n\t\t\t<real>%f</real>\n" % (
+                          rnd.uniform(-80, 80), rnd.uniform(-170, 170)))
+        out.write("\t\t</dict>\n")
+    out.write("\t</dict>\n")
+    _string(out, "Minor Version", "0")
+    out.write("</dict>\n</plist>\n")
+
+def get_albumdata_file(num_images, num_albums=None):
+    """Returns the path to a synthetic AlbumData.xml file with num_images
+    images (and num_albums albums), creating it in the temp folder if it does
+    not exist yet."""
+    folder = os.path.join(tempfile.gettempdir(), "phoshare_benchmarks")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    name = "AlbumData_%d" % (num_images)
+    if num_albums is not None:
+        name += "_%d" % (num_albums)
+    path = os.path.join(folder, name + ".xml")
+    if not os.path.exists(path):
+        print "Writing %s..." % (path)
+        tmp_path = path + ".tmp"
+        out = open(tmp_path, "w")
+        try:
+            write_albumdata(out, num_images, num_albums=num_albums)
+        finally:
+            out.close()
+        os.rename(tmp_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print >> sys.stderr, "usage: %s <number of images> <output file>" % (
+            sys.argv[0])
+        sys.exit(2)
+    output = open(sys.argv[2], "w")
+    write_albumdata(output, int(sys.argv[1]))
+    output.close()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+"""Compares the AlbumData.xml parser backends in appledata.applexml.
+
+usage: python benchmarks/bench_applexml.py [number of images, ...]
+
+Parses synthetic AlbumData.xml files (default 10k, 100k and 500k images) with
+each backend, both into a complete tree (read_applexml) and as a stream of
+events (iter_applexml), and checks that all backends produce the same data.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import appledata.applexml as applexml
+import albumdata
+
+_DEFAULT_SIZES = (10000, 100000, 500000)
+
+def _time_backend(xml_file, backend):
+    """Returns the tree, the events, and the times it took to read them."""
+    start = time.time()
+    tree = applexml.read_applexml(xml_file, backend)
+    tree_time = time.time() - start
+    start = time.time()
+    events = 0
+    for _ in applexml.iter_applexml(xml_file, backend=backend):
+        events += 1
+    stream_time = time.time() - start
+    return (tree, events, tree_time, stream_time)
+
+
+def main():
+    """Runs the benchmark."""
+    sizes = [int(arg) for arg in sys.argv[1:]] or _DEFAULT_SIZES
+    print "%10s %8s %10s %10s %10s" % ("images", "backend", "tree (s)",
+                                        "stream (s)", "events")
+    for num_images in sizes:
+        xml_file = albumdata.get_albumdata_file(num_images)
+        first_tree = None
+        for backend in applexml.PARSER_BACKENDS:
+            (tree, events, tree_time, stream_time) = _time_backend(xml_file,
+                                                                   backend)
+            print "%10d %8s %10.2f %10.2f %10d" % (num_images, backend,
+                                                   tree_time, stream_time,
+                                                   events)
+            if first_tree is None:
+                first_tree = tree
+            elif tree != first_tree:
+                print >> sys.stderr, "%s: %s backend built a different tree" % (
+                    xml_file, backend)
+                return 1
+            tree = None
+        first_tree = None
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
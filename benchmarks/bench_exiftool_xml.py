@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+"""Compares the parsing of exiftool -X output in tilutil.exiftool with the
+minidom based parser it replaced.
+
+usage: python benchmarks/bench_exiftool_xml.py [files per output, ...]
+
+Parses synthetic exiftool -X outputs (default 1, 10 and 100 files, like a
+single get_iptc_data() call and batches from get_iptc_data_batch()) with both
+parsers, and checks that they return the same data.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import random
+import sys
+import time
+
+from xml.dom import minidom
+from xml.parsers import expat
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilutil.exiftool as exiftool
+
+_DEFAULT_SIZES = (1, 10, 100)
+
+# Number of files parsed for each size.
+_FILES_PER_RUN = 5000
+
+_HEADER = """<?xml version='1.0' encoding='UTF-8'?>
+<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
+"""
+
+_DESCRIPTION = """<rdf:Description rdf:about='%(path)s'
+xmlns:et='http://ns.exiftool.ca/1.0/' et:toolkit='Image::ExifTool 8.15'
+xmlns:ExifIFD='http://ns.exiftool.ca/EXIF/ExifIFD/1.0/'
+xmlns:IPTC='http://ns.exiftool.ca/IPTC/IPTC/1.0/'
+xmlns:XMP-xmp='http://ns.exiftool.ca/XMP/XMP-xmp/1.0/'
+xmlns:XMP-MP='http://ns.exiftool.ca/XMP/XMP-MP/1.0/'
+xmlns:XMP='http://ns.exiftool.ca/XMP/XMP/1.0/'
+xmlns:Composite='http://ns.exiftool.ca/Composite/1.0/'>
+<ExifIFD:DateTimeOriginal>2009:%(month)02d:%(day)02d 10:11:12</ExifIFD:DateTimeOriginal>
+%(keywords)s<IPTC:Caption-Abstract>%(caption)s</IPTC:Caption-Abstract>
+<XMP-xmp:Rating>%(rating)d</XMP-xmp:Rating>
+%(subject)s%(regions)s%(gps)s</rdf:Description>
+"""
+
+_BAG = """<%(tag)s>
+<rdf:Bag>
+%(items)s</rdf:Bag>
+</%(tag)s>
+"""
+
+def _bag(tag, values):
+    """Returns an element with a list of values."""
+    if len(values) == 1:
+        return "<%s>%s</%s>\n" % (tag, values[0], tag)
+    items = "".join(["<rdf:li>%s</rdf:li>\n" % (value) for value in values])
+    return _BAG % {"tag": tag, "items": items}
+
+def make_output(num_files, rnd):
+    """Returns exiftool -X output for num_files files, as returned by
+    exiftool.get_iptc_data(), and the list of files."""
+    files = []
+    descriptions = []
+    for i in xrange(num_files):
+        path = u"/Volumes/Photos/Event %d/IMG_%04d \xe9t\xe9.jpg" % (
+            rnd.randint(1, 500), i)
+        files.append(path)
+        keywords = ["Keyword %d" % (rnd.randint(1, 50))
+                    for _ in xrange(rnd.randint(0, 4))]
+        regions = ""
+        if rnd.random() < 0.3:
+            faces = ["Person %d" % (rnd.randint(1, 20))
+                     for _ in xrange(rnd.randint(1, 3))]
+            regions = (_bag("XMP-MP:RegionPersonDisplayName", faces) +
+                       _bag("XMP-MP:RegionRectangle",
+                            ["0.25, 0.4, 0.2, 0.15"] * len(faces)))
+        gps = ""
+        if rnd.random() < 0.2:
+            gps = ("<Composite:GPSLatitude>%.6f N</Composite:GPSLatitude>\n"
+                   "<Composite:GPSLongitude>%.6f W</Composite:GPSLongitude>\n"
+                   % (rnd.uniform(0, 80), rnd.uniform(0, 170)))
+        descriptions.append(_DESCRIPTION % {
+            "path": path.encode("utf-8"),
+            "month": rnd.randint(1, 12),
+            "day": rnd.randint(1, 28),
+            "keywords": keywords and _bag("IPTC:Keywords", keywords) or "",
+            "subject": keywords and _bag("XMP:Subject", keywords[:1]) or "",
+            "caption": rnd.choice(("Caption", "Caption &amp; more",
+                                   "IMG_%04d" % (i))),
+            "rating": rnd.randint(0, 5),
+            "regions": regions,
+            "gps": gps})
+    output = _HEADER + "".join(descriptions) + "</rdf:RDF>"
+    # exiftool output is read line by line, and each line is stripped.
+    output = "\n".join([line.strip() for line in output.split("\n")])
+    return (output, files)
+
+# The minidom based parser, as it was before the switch to expat.
+
+def _minidom_nodevalues(xml_data, tag, data):
+    """Extracts one or more node values from an XML element, and appends
+       it to the data array. Node values can be directly below the element,
+       or a list in <rdf:Bag><rfd:li>...</rfd:li>...</rdf:Bag> format.
+    """
+    for xml_element in xml_data.getElementsByTagName(tag):
+        if (xml_element.firstChild.nodeValue and
+            xml_element.firstChild.nodeValue != "\n"):
+            data.append(xml_element.firstChild.nodeValue)
+        for xml_bag in xml_element.getElementsByTagName("rdf:Bag"):
+            for xml_li in xml_bag.getElementsByTagName("rdf:li"):
+                data.append(xml_li.firstChild.nodeValue)
+
+def _minidom_description_data(xml_desc, image_file):
+    """Extracts the IPTC data of one file from its rdf:Description element.
+    """
+    keywords = []
+    caption = None
+    date_time_original = None
+    rating = 0
+    gps = None
+    region_names = []
+    region_rectangles = []
+    gps_latitude = None
+    gps_longitude = None
+
+    _minidom_nodevalues(xml_desc, "IPTC:Keywords", keywords)
+    # Keywords can also be stored as Subject in the XMP directory
+    _minidom_nodevalues(xml_desc, "XMP:Subject", keywords)
+    for xml_caption in xml_desc.getElementsByTagName("IPTC:Caption-Abstract"):
+        caption = xml_caption.firstChild.nodeValue
+    for xml_element in xml_desc.getElementsByTagName(
+        "ExifIFD:DateTimeOriginal"):
+        if not xml_element.firstChild:
+            continue
+        try:
+            date_time_original = time.strptime(xml_element.firstChild.nodeValue,
+                                               "%Y:%m:%d %H:%M:%S")
+            date_time_original = datetime.datetime(
+                date_time_original.tm_year,
+                date_time_original.tm_mon,
+                date_time_original.tm_mday,
+                date_time_original.tm_hour,
+                date_time_original.tm_min,
+                date_time_original.tm_sec)
+        except ValueError, _ve:
+            print >> sys.stderr, ("Exiftool returned an invalid date %s for %s - "
+                                  "ignoring.") % (
+                xml_element.firstChild.nodeValue, image_file)
+    for xml_element in xml_desc.getElementsByTagName("XMP-xmp:Rating"):
+        rating = int(xml_element.firstChild.nodeValue)
+    for xml_element in xml_desc.getElementsByTagName("Composite:GPSLatitude"):
+        gps_latitude = xml_element.firstChild.nodeValue
+    for xml_element in xml_desc.getElementsByTagName("Composite:GPSLongitude"):
+        gps_longitude = xml_element.firstChild.nodeValue
+    string_rectangles = []
+    _minidom_nodevalues(xml_desc, 'XMP-MP:RegionRectangle', string_rectangles)
+    for string_rectangle in string_rectangles:
+        rectangle = []
+        for c in string_rectangle.split(','):
+            rectangle.append(float(c))
+        region_rectangles.append(rectangle)
+    _minidom_nodevalues(xml_desc, 'XMP-MP:RegionPersonDisplayName', region_names)
+
+    if gps_latitude and gps_longitude:
+        latitude = float(gps_latitude[0:-2])
+        if gps_latitude.endswith(" S"):
+            latitude = -latitude
+        longitude = float(gps_longitude[0:-2])
+        if gps_longitude.endswith(" W"):
+            longitude = -longitude
+        gps = (latitude, longitude)
+
+    return (keywords, caption, date_time_original, rating, gps,
+            region_rectangles, region_names)
+
+def _minidom_parse_iptc_output(output, image_files):
+    """Parses the exiftool -X output for image_files, and returns a map from
+    file to its IPTC data. Files not found in the output are left out."""
+    result = {}
+    if not output:
+        return result
+    files_by_name = {}
+    for image_file in image_files:
+        files_by_name[exiftool._utf8(image_file).decode('utf8')] = image_file
+    try:
+        xml_data = minidom.parseString(output)
+        for xml_desc in xml_data.getElementsByTagName("rdf:Description"):
+            image_file = files_by_name.get(xml_desc.getAttribute("rdf:about"))
+            if image_file is None:
+                if len(image_files) != 1:
+                    continue
+                image_file = image_files[0]
+            result[image_file] = _minidom_description_data(xml_desc, image_file)
+        xml_data.unlink()
+    except expat.ExpatError, ex:
+        print >> sys.stderr, "Could not parse exiftool output %s: %s" % (
+            output, ex)
+    return result
+
+
+def _time_parser(parse, outputs):
+    """Returns the results of parse for all outputs, and the time it took."""
+    start = time.time()
+    results = [parse(output, files) for (output, files) in outputs]
+    return (results, time.time() - start)
+
+
+def main():
+    """Runs the benchmark."""
+    sizes = [int(arg) for arg in sys.argv[1:]] or _DEFAULT_SIZES
+    rnd = random.Random(1)
+    print "%10s %10s %12s %12s %8s" % ("files/out", "files", "minidom (s)",
+                                       "expat (s)", "speedup")
+    for size in sizes:
+        outputs = [make_output(size, rnd)
+                   for _ in xrange(max(1, _FILES_PER_RUN // size))]
+        (old_results, old_time) = _time_parser(_minidom_parse_iptc_output,
+                                               outputs)
+        (new_results, new_time) = _time_parser(exiftool._parse_iptc_output,
+                                               outputs)
+        print "%10d %10d %12.3f %12.3f %7.1fx" % (
+            size, size * len(outputs), old_time, new_time,
+            old_time / max(new_time, 1e-6))
+        if old_results != new_results:
+            print >> sys.stderr, "Parsers returned different data."
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
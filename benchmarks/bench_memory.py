@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+"""Reports the memory used per image by the iPhoto library object model.
+
+usage: python benchmarks/bench_memory.py [number of images]
+
+Loads a synthetic AlbumData.xml file (default 20k images), and reports the
+bytes per image for the raw parsed image records (the dicts built by
+applexml.read_applexml), and for the IPhotoImage objects built by
+iphotodata.get_iphoto_data. Sizes are computed by walking the object graph
+with sys.getsizeof(), counting shared objects once.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import albumdata
+
+_DEFAULT_IMAGES = 20000
+
+def _get_slots(cls):
+    """Returns all __slots__ names of a class and its base classes."""
+    names = []
+    for klass in cls.__mro__:
+        slots = getattr(klass, "__slots__", ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        names.extend(slots)
+    return names
+
+
+def deep_size(obj, seen, stop_types=()):
+    """Returns the size of obj and everything it references that is not in
+    seen yet. Objects of stop_types are not followed (but counted)."""
+    size = 0
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.iterkeys())
+            pending.extend(item.itervalues())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+        elif isinstance(item, stop_types) and item is not obj:
+            continue
+        elif hasattr(item, "__class__") and not isinstance(item, type):
+            if hasattr(item, "__dict__"):
+                pending.append(item.__dict__)
+            for name in _get_slots(item.__class__):
+                if hasattr(item, name):
+                    pending.append(getattr(item, name))
+    return size
+
+
+def main():
+    """Runs the benchmark."""
+    if len(sys.argv) > 1:
+        num_images = int(sys.argv[1])
+    else:
+        num_images = _DEFAULT_IMAGES
+    xml_file = albumdata.get_albumdata_file(num_images)
+
+    tree = applexml.read_applexml(xml_file)
+    raw_size = deep_size(tree["Master Image List"], set())
+    tree = None
+
+    data = iphotodata.get_iphoto_data(xml_file)
+    # Don't count the albums and events an image refers to, they are not part
+    # of the image record. Tables shared by all images are counted once.
+    seen = set()
+    stop_types = (iphotodata.IPhotoData, iphotodata.IPhotoContainer,
+                  iphotodata.IPhotoFace)
+    image_size = deep_size(data.strings, seen)
+    for image in data.images:
+        image_size += deep_size(image, seen, stop_types)
+
+    print "%d images" % (num_images)
+    print "%10d bytes/image in raw image records" % (raw_size / num_images)
+    print "%10d bytes/image in IPhotoImage objects" % (
+        image_size / num_images)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+"""Shows how the time to load an iPhoto library grows with the number of
+images and albums.
+
+usage: python benchmarks/bench_scaling.py [number of images, ...]
+
+Loads synthetic AlbumData.xml files for each combination of image count
+(default 10k, 50k and 100k) and album count (100, 500 and 2000), and prints a
+table of load times. Load time should grow linearly in both.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import appledata.iphotodata as iphotodata
+import albumdata
+
+_DEFAULT_IMAGES = (10000, 50000, 100000)
+_ALBUMS = (100, 500, 2000)
+
+def main():
+    """Runs the benchmark."""
+    sizes = [int(arg) for arg in sys.argv[1:]] or _DEFAULT_IMAGES
+    results = []
+    for num_images in sizes:
+        times = []
+        for num_albums in _ALBUMS:
+            xml_file = albumdata.get_albumdata_file(num_images, num_albums)
+            start = time.time()
+            iphotodata.get_iphoto_data(xml_file)
+            times.append(time.time() - start)
+        results.append((num_images, times))
+
+    print "%10s" % ("images") + "".join(
+        ["%12s" % ("%d albums" % (num_albums)) for num_albums in _ALBUMS])
+    for (num_images, times) in results:
+        print "%10d" % (num_images) + "".join(
+            ["%11.2fs" % (load_time) for load_time in times])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+"""Measures the cost of loading an iPhoto library when only a small part of
+it is exported.
+
+usage: python benchmarks/bench_startup.py [number of images]
+
+Loads a synthetic AlbumData.xml file (default 200k images), and then uses the
+image fields that an export reads for the images of one event. Also reports
+how long it takes to use the same fields for all images, which is the work
+that is saved by decoding image records lazily.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import appledata.iphotodata as iphotodata
+import albumdata
+
+_DEFAULT_IMAGES = 200000
+
+def use_images(images):
+    """Reads the image fields that ExportFile uses."""
+    for image in images:
+        image.getimagepath()
+        image.getcaption()
+        image.ismovie()
+        _ = (image.date, image.mod_date, image.keywords, image.faces,
+             image.face_rectangles, image.gps, image.originalpath)
+
+
+def main():
+    """Runs the benchmark."""
+    if len(sys.argv) > 1:
+        num_images = int(sys.argv[1])
+    else:
+        num_images = _DEFAULT_IMAGES
+    xml_file = albumdata.get_albumdata_file(num_images)
+
+    start = time.time()
+    data = iphotodata.get_iphoto_data(xml_file)
+    load_time = time.time() - start
+
+    event = sorted(data.rolls, key=lambda roll: roll.name)[0]
+    start = time.time()
+    use_images(event.images)
+    event_time = time.time() - start
+
+    start = time.time()
+    use_images(data.images)
+    all_time = time.time() - start
+
+    print "%d images" % (num_images)
+    print "%8.2f s to load the library" % (load_time)
+    print "%8.3f s to use the %d images of event %s" % (
+        event_time, event.size, event.name)
+    print "%8.2f s to use all images" % (all_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
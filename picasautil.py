@@ -182,8 +182,12 @@ def main():
       return 1
 
     contacts = get_picasa_contacts()
-    process_face_keywords(options.folder.decode(sys.getfilesystemencoding()),
-                          contacts)
+    exiftool.start_sessions()
+    try:
+      process_face_keywords(options.folder.decode(sys.getfilesystemencoding()),
+                            contacts)
+    finally:
+      exiftool.stop_sessions()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+"""Tests of tilutil.exportmanifest.
+
+usage: python tests/test_exportmanifest.py
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilutil.exportmanifest as exportmanifest
+import tilutil.fileindex as fileindex
+
+# Starts a write of a target through a temporary file, and exits without
+# ending it or closing the manifest, like an interrupted export.
+_INTERRUPTED_WRITE = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+import tilutil.exportmanifest as exportmanifest
+(folder, target, temp) = sys.argv[2:5]
+manifest = exportmanifest.ExportManifest(folder)
+manifest.begin(target, temp)
+open(temp, "wb").write("partial")
+os._exit(1)
+"""
+
+
+def _write_file(path, data):
+    output = open(path, "wb")
+    try:
+        output.write(data)
+    finally:
+        output.close()
+
+
+def _read_folder(folder):
+    """Returns a dict that maps the names of the files in folder to their
+    content."""
+    result = {}
+    for name in os.listdir(folder):
+        input_file = open(os.path.join(folder, name), "rb")
+        try:
+            result[name] = input_file.read()
+        finally:
+            input_file.close()
+    return result
+
+
+class ExportManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "source.jpg")
+        self.target = os.path.join(self.folder, "target.jpg")
+        _write_file(self.source, "source data")
+        _write_file(self.target, "exported data")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _get_manifest_file(self):
+        return os.path.join(self.folder, exportmanifest.MANIFEST_NAME)
+
+    def test_update(self):
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.update(self.target, self.source, 1.0, "hash")
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.folder)
+        try:
+            info = fileindex.FileInfo(os.stat(self.target))
+            self.assertTrue(manifest.is_current(self.target, self.source, 1.0,
+                                                "hash", info))
+            self.assertFalse(manifest.is_current(self.target, self.source,
+                                                 2.0, "hash", info))
+        finally:
+            manifest.close()
+
+    def _interrupt_write(self, target, temp):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.call([sys.executable, "-c", _INTERRUPTED_WRITE, root,
+                         self.folder, target, temp])
+
+    def test_recover_after_interrupted_write(self):
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.update(self.target, self.source, 1.0, "hash")
+        manifest.close()
+        temp = self.target + ".tmp"
+        self._interrupt_write(self.target, temp)
+        self.assertTrue(os.path.exists(temp))
+
+        manifest = exportmanifest.ExportManifest(self.folder)
+        try:
+            self.assertEqual(manifest.recover(), [self.target])
+            self.assertFalse(os.path.exists(temp))
+            self.assertEqual(manifest.get(self.target), None)
+        finally:
+            manifest.close()
+        manifest = exportmanifest.ExportManifest(self.folder)
+        try:
+            self.assertEqual(manifest.recover(), [])
+        finally:
+            manifest.close()
+
+    def test_finished_write_is_not_recovered(self):
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.begin(self.target, self.target + ".tmp")
+        manifest.update(self.target, self.source, 1.0, "hash")
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.folder)
+        try:
+            self.assertEqual(manifest.recover(), [])
+            self.assertTrue(manifest.get(self.target))
+        finally:
+            manifest.close()
+
+    def test_read_only_manifest_is_not_changed(self):
+        manifest = exportmanifest.ExportManifest(self.folder)
+        manifest.update(self.target, self.source, 1.0, "hash")
+        manifest.set_verified(self.target, "iptc")
+        manifest.begin(self.source, self.source + ".tmp")
+        manifest.close()
+        before = _read_folder(self.folder)
+
+        manifest = exportmanifest.ExportManifest(self.folder, read_only=True)
+        try:
+            self.assertEqual(manifest.recover(), [])
+            self.assertTrue(manifest.get(self.target))
+            self.assertTrue(manifest.is_verified(self.target, "iptc"))
+            manifest.update(self.target, self.source, 2.0, "hash")
+            manifest.set_verified(self.target, "other")
+            manifest.begin(self.target)
+            manifest.remove(self.target)
+            manifest.retain([])
+        finally:
+            manifest.close()
+        self.assertEqual(_read_folder(self.folder), before)
+
+    def test_read_only_manifest_of_older_version(self):
+        # A manifest without the tables added later.
+        connection = sqlite3.connect(self._get_manifest_file())
+        connection.execute(exportmanifest._SCHEMA)
+        connection.commit()
+        connection.close()
+        before = _read_folder(self.folder)
+
+        manifest = exportmanifest.ExportManifest(self.folder, read_only=True)
+        try:
+            self.assertEqual(manifest.get(self.target), None)
+            self.assertFalse(manifest.is_verified(self.target, "iptc"))
+            self.assertEqual(manifest.get_fingerprint(self.target), None)
+        finally:
+            manifest.close()
+        self.assertEqual(_read_folder(self.folder), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
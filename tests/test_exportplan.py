@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+"""Tests of tilutil.exportplan.
+
+usage: python tests/test_exportplan.py
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilutil.exportplan as exportplan
+
+
+def _make_plan():
+    """Returns a plan with an operation of each kind."""
+    plan = exportplan.ExportPlan(u"/export")
+    plan.add(exportplan.Operation(exportplan.DELETE, u"/export/old.jpg",
+                                  data=u"/export"))
+    plan.add_folder(u"/export/Caf\xe9")
+    folder = u"/export/Caf\xe9"
+    plan.add_task(folder, [
+        exportplan.Operation(exportplan.RESIZE, folder + u"/a.jpg",
+                             u"/library/a.jpg", 1000, 1024),
+        exportplan.Operation(exportplan.METADATA, folder + u"/a.jpg",
+                             size=1000, data={"expected": {"caption": u"A"},
+                                              "updates": None, "hash": "1",
+                                              "batch": True}),
+        exportplan.Operation(exportplan.RECORD, folder + u"/a.jpg",
+                             u"/library/a.jpg", data=(1.5, "2"))])
+    plan.add_task(folder, [
+        exportplan.Operation(exportplan.LINK, folder + u"/b.jpg",
+                             u"/library/b.jpg", 2000),
+        exportplan.Operation(exportplan.VERIFY, folder + u"/b.jpg",
+                             data="3")])
+    plan.export_files = set([folder + u"/a.jpg", folder + u"/b.jpg"])
+    return plan
+
+
+def _describe_operation(operation):
+    return (operation.kind, operation.path, operation.source, operation.size,
+            operation.data)
+
+
+def _describe_plan(plan):
+    """Returns the content of plan as nested tuples."""
+    tasks = []
+    for task in plan.tasks:
+        tasks.append((task.folder, [_describe_operation(operation)
+                                    for operation in task.operations]))
+    return (plan.export_folder,
+            [_describe_operation(operation) for operation in plan.operations],
+            tasks, plan.export_files)
+
+
+class ExportPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plan_file = os.path.join(self.folder, "export.plan")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write_pickles(self, *values):
+        output = open(self.plan_file, "wb")
+        try:
+            for value in values:
+                cPickle.dump(value, output, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            output.close()
+
+    def test_add_folder_once(self):
+        plan = exportplan.ExportPlan(u"/export")
+        self.assertTrue(plan.add_folder(u"/export/a"))
+        self.assertFalse(plan.add_folder(u"/export/a"))
+        self.assertEqual(plan.get_counts(), {exportplan.MKDIR: 1})
+
+    def test_save_and_load(self):
+        plan = _make_plan()
+        plan.save(self.plan_file)
+        # Saving again replaces the file.
+        plan.save(self.plan_file)
+        self.assertEqual(os.listdir(self.folder), ["export.plan"])
+        loaded = exportplan.load_plan(self.plan_file)
+        self.assertEqual(_describe_plan(loaded), _describe_plan(plan))
+        self.assertEqual(loaded.get_counts(), plan.get_counts())
+        self.assertEqual(loaded.get_size(), 4000)
+        self.assertEqual(loaded.describe(), plan.describe())
+
+    def test_load_other_version(self):
+        self._write_pickles(exportplan._PLAN_VERSION + 1, _make_plan())
+        self.assertRaises(ValueError, exportplan.load_plan, self.plan_file)
+
+    def test_load_other_files(self):
+        self._write_pickles(exportplan._PLAN_VERSION, ["not", "a", "plan"])
+        self.assertRaises(ValueError, exportplan.load_plan, self.plan_file)
+        self._write_pickles(exportplan._PLAN_VERSION)
+        self.assertRaises(ValueError, exportplan.load_plan, self.plan_file)
+        output = open(self.plan_file, "wb")
+        try:
+            output.write("not a plan")
+        finally:
+            output.close()
+        self.assertRaises(ValueError, exportplan.load_plan, self.plan_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+"""Tests of tilutil.imagemetadata.
+
+usage: python tests/test_imagemetadata.py
+
+The test images are built by the tests. If exiftool is installed, the data
+read from them is also compared with what exiftool.get_iptc_data() reads.
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cStringIO
+import datetime
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tilutil.exiftool as exiftool
+import tilutil.imagemetadata as imagemetadata
+
+# TIFF field types.
+_ASCII = 2
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+
+_XMP = """<x:xmpmeta xmlns:x="adobe:ns:meta/">
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+<rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+ xmlns:dc="http://purl.org/dc/elements/1.1/"
+ xmlns:MP="http://ns.microsoft.com/photo/1.2/"
+ xmlns:MPRI="http://ns.microsoft.com/photo/1.2/t/RegionInfo#"
+ xmlns:MPReg="http://ns.microsoft.com/photo/1.2/t/Region#"
+ xmp:Rating="4">
+<dc:subject><rdf:Bag><rdf:li>Sunset</rdf:li></rdf:Bag></dc:subject>
+<MP:RegionInfo rdf:parseType="Resource"><MPRI:Regions><rdf:Bag>
+<rdf:li MPReg:Rectangle="0.1, 0.2, 0.3, 0.4"
+ MPReg:PersonDisplayName="Ann"/>
+</rdf:Bag></MPRI:Regions></MP:RegionInfo>
+</rdf:Description>
+</rdf:RDF>
+</x:xmpmeta>"""
+
+# The data read from the test images.
+_EXPECTED = ([u"Beach", u"Caf\xe9", u"Sunset"],
+             u"A day at the beach", datetime.datetime(2009, 5, 29, 10, 11, 12),
+             4, (37.5, -122.25), [[0.1, 0.2, 0.3, 0.4]], [u"Ann"])
+
+
+def _make_iim():
+    """Returns IPTC-IIM data with a UTF-8 caption and keywords."""
+    data = ""
+    for (record, dataset, value) in ((1, 90, "\x1b%G"), (2, 25, "Beach"),
+                                     (2, 25, "Caf\xc3\xa9"),
+                                     (2, 120, "A day at the beach")):
+        data += "\x1c%c%c%s%s" % (record, dataset,
+                                  struct.pack(">H", len(value)), value)
+    return data
+
+
+def _rationals(*values):
+    return "".join([struct.pack("<II", value, 1) for value in values])
+
+
+def _make_ifd(entries, offset):
+    """Returns a little-endian IFD at offset, followed by the values that
+    don't fit into its entries. entries is a list of (tag, type, count,
+    value)."""
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack("<H", len(entries))
+    data = ""
+    for (tag, field_type, count, value) in sorted(entries):
+        if len(value) <= 4:
+            field = value + "\0" * (4 - len(value))
+        else:
+            field = struct.pack("<I", data_offset + len(data))
+            data += value + "\0" * (len(value) % 2)
+        ifd += struct.pack("<HHI", tag, field_type, count) + field
+    return ifd + struct.pack("<I", 0) + data
+
+
+def _make_tiff(is_tiff_file):
+    """Returns a TIFF structure with EXIF and GPS data, and the IPTC and XMP
+    data if is_tiff_file is set."""
+    exif_entries = [(0x9003, _ASCII, 20, "2009:05:29 10:11:12\0")]
+    gps_entries = [(1, _ASCII, 2, "N\0"),
+                   (2, _RATIONAL, 3, _rationals(37, 30, 0)),
+                   (3, _ASCII, 2, "W\0"),
+                   (4, _RATIONAL, 3, _rationals(122, 15, 0))]
+    entries = [(0x0100, _SHORT, 1, struct.pack("<H", 1)),
+               (0x0101, _SHORT, 1, struct.pack("<H", 1))]
+    if is_tiff_file:
+        iim = _make_iim()
+        iim += "\0" * (-len(iim) % 4)
+        entries.append((0x83bb, _LONG, len(iim) / 4, iim))
+        entries.append((0x02bc, 1, len(_XMP), _XMP))
+    # The pointers are LONG values, so their size does not depend on them.
+    pointers = [(0x8769, _LONG, 1, "\0" * 4), (0x8825, _LONG, 1, "\0" * 4)]
+    exif_offset = 8 + len(_make_ifd(entries + pointers, 8))
+    exif_ifd = _make_ifd(exif_entries, exif_offset)
+    gps_offset = exif_offset + len(exif_ifd)
+    pointers = [(0x8769, _LONG, 1, struct.pack("<I", exif_offset)),
+                (0x8825, _LONG, 1, struct.pack("<I", gps_offset))]
+    return ("II*\0" + struct.pack("<I", 8) + _make_ifd(entries + pointers, 8) +
+            exif_ifd + _make_ifd(gps_entries, gps_offset))
+
+
+def _make_segment(marker, data):
+    return "\xff%c%s%s" % (marker, struct.pack(">H", len(data) + 2), data)
+
+
+def _make_jpeg():
+    """Returns the meta data segments of a JPEG file, without image data."""
+    iim = _make_iim()
+    resources = "8BIM" + struct.pack(">HHI", 0x0404, 0, len(iim)) + iim
+    return ("\xff\xd8" +
+            _make_segment(0xe1, "Exif\0\0" + _make_tiff(False)) +
+            _make_segment(0xe1, "http://ns.adobe.com/xap/1.0/\0" + _XMP) +
+            _make_segment(0xed, "Photoshop 3.0\0" + resources) +
+            "\xff\xd9")
+
+
+class ImageMetaDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write_image(self, name, data):
+        path = os.path.join(self.folder, name)
+        output = open(path, "wb")
+        try:
+            output.write(data)
+        finally:
+            output.close()
+        return path
+
+    def _check_image(self, path):
+        self.assertEqual(imagemetadata.read_iptc_data(path), _EXPECTED)
+        if exiftool.check_exif_tool(cStringIO.StringIO()):
+            self.assertEqual(imagemetadata.read_iptc_data(path),
+                             exiftool.get_iptc_data(path))
+
+    def test_jpeg(self):
+        self._check_image(self._write_image("test.jpg", _make_jpeg()))
+
+    def test_tiff(self):
+        self._check_image(self._write_image("test.tif", _make_tiff(True)))
+
+    def test_file_without_meta_data(self):
+        path = self._write_image("empty.jpg", "\xff\xd8\xff\xd9")
+        self.assertEqual(imagemetadata.read_iptc_data(path),
+                         ([], None, None, 0, None, [], []))
+
+    def test_unreadable_files(self):
+        self.assertEqual(imagemetadata.read_iptc_data(
+            self._write_image("test.png", "\x89PNG\r\n\x1a\n")), None)
+        # A file that ends in the EXIF data.
+        self.assertEqual(imagemetadata.read_iptc_data(self._write_image(
+            "cut.jpg", "\xff\xd8\xff\xe1\x00\x40Exif\0\0II*\0")), None)
+        self.assertEqual(imagemetadata.read_iptc_data(
+            self._write_image("text.jpg", "not an image")), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
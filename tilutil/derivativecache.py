@@ -0,0 +1,229 @@
+'''Cache of resized images, shared by all exports
+
+Converting an image with --size decodes the full size library image, which
+takes much longer than reading the result. The cache keeps the converted
+images, so exports of the same images at the same size, e.g. to another
+folder, or after a caption changed the file names, link or copy them
+instead. The least recently used images are removed when the cache gets
+larger than its limit.
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import filecopy
+import imageutils
+
+# Name of the index database in the cache folder.
+_INDEX_NAME = "index.db"
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS derivatives (
+    key TEXT PRIMARY KEY,
+    size INTEGER,
+    last_used REAL)"""
+
+# When the cache is full, the least recently used images are removed until
+# it is at this fraction of its limit, so there is room for a few more
+# images before the next cleanup.
+_LOW_WATER_MARK = 0.9
+
+# Number of changes after which the index is committed.
+_COMMIT_INTERVAL = 100
+
+
+def get_key(source_stat, height_width_max, image_format="jpeg"):
+    """Returns the cache key of the source with the os.stat() result
+    source_stat, converted to image_format, and resized to
+    height_width_max. The key changes when the source is replaced or
+    modified."""
+    # The content fingerprint of the source would also survive a copy of the
+    # library, but leaves out the EXIF data, which is copied into the
+    # converted image.
+    key = "%d:%d:%d:%r:%d:%s:%d" % (
+        source_stat.st_dev, source_stat.st_ino, source_stat.st_size,
+        source_stat.st_mtime, height_width_max, image_format,
+        imageutils.JPEG_QUALITY)
+    return hashlib.sha1(key).hexdigest()
+
+
+class DerivativeCache(object):
+    """Converted images, stored in a folder by their get_key(), with an index
+    of their sizes and last use. Can be used from several threads at the
+    same time."""
+
+    def __init__(self, folder, max_size, copy_mode=filecopy.CLONE):
+        """Opens (or creates) the cache in folder. The cache holds up to
+        max_size bytes. Images that can't be linked are copied with
+        copy_mode, see filecopy.COPY_MODES."""
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.max_size = max_size
+        self._copy_mode = copy_mode
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._connection = sqlite3.connect(
+            os.path.join(folder, _INDEX_NAME), check_same_thread=False)
+        self._connection.execute(_SCHEMA)
+        # Maps keys to [size, last use].
+        self._entries = {}
+        for (key, size, last_used) in self._connection.execute(
+            "SELECT key, size, last_used FROM derivatives"):
+            self._entries[key] = [size, last_used]
+        self._size = sum([entry[0] for entry in self._entries.values()])
+        self.hits = 0
+        self.stores = 0
+
+    def _get_path(self, key):
+        """Returns the path of the image for key. Images are spread over
+        256 subfolders."""
+        return os.path.join(self.folder, key[0:2], key + ".jpg")
+
+    def fetch(self, key, target):
+        """Links or copies the image for key to target. Returns False if the
+        cache does not have it."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+        finally:
+            self._lock.release()
+        if entry is None:
+            return False
+        path = self._get_path(key)
+        try:
+            # A different size means the image was changed, e.g. through an
+            # exported file linked to it.
+            if os.path.getsize(path) != entry[0]:
+                self._remove(key)
+                return False
+            self._link_or_copy(path, target)
+        except (IOError, OSError):
+            if os.path.exists(target):
+                os.remove(target)
+            self._remove(key)
+            return False
+        self._lock.acquire()
+        try:
+            entry[1] = time.time()
+            self._connection.execute(
+                "UPDATE derivatives SET last_used = ? WHERE key = ?",
+                (entry[1], key))
+            self.hits += 1
+            self._changed()
+        finally:
+            self._lock.release()
+        return True
+
+    def store(self, key, image_file):
+        """Adds image_file as the image for key, and removes the least
+        recently used images if the cache gets too large. Raises IOError or
+        OSError if the image can't be added."""
+        size = os.path.getsize(image_file)
+        if size > self.max_size:
+            return
+        path = self._get_path(key)
+        temp_file = path + ".tmp"
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.mkdir(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        try:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            self._link_or_copy(image_file, temp_file)
+            os.rename(temp_file, path)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        self._lock.acquire()
+        try:
+            previous = self._entries.get(key)
+            if previous:
+                self._size -= previous[0]
+            self._entries[key] = [size, time.time()]
+            self._size += size
+            self._connection.execute(
+                "INSERT OR REPLACE INTO derivatives VALUES (?, ?, ?)",
+                (key, size, self._entries[key][1]))
+            self.stores += 1
+            self._changed()
+            if self._size > self.max_size:
+                self._evict(int(self.max_size * _LOW_WATER_MARK))
+        finally:
+            self._lock.release()
+
+    def _link_or_copy(self, source, target):
+        """Makes target a hard link to source, or a copy if source is on
+        another volume."""
+        try:
+            os.link(source, target)
+        except OSError:
+            filecopy.copy_file(source, target, self._copy_mode)
+
+    def _evict(self, max_size):
+        """Removes the least recently used images until the cache holds at
+        most max_size bytes. Must be called with the lock held."""
+        entries = sorted(self._entries.items(), key=lambda item: item[1][1])
+        for (key, _) in entries:
+            if self._size <= max_size:
+                break
+            self._delete(key)
+
+    def _remove(self, key):
+        """Removes the image for key."""
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._delete(key)
+        finally:
+            self._lock.release()
+
+    def _delete(self, key):
+        """Removes the image for key. Must be called with the lock held."""
+        path = self._get_path(key)
+        try:
+            os.remove(path)
+        except OSError:
+            if os.path.exists(path):
+                return  # keep counting it
+        self._size -= self._entries.pop(key)[0]
+        self._connection.execute("DELETE FROM derivatives WHERE key = ?",
+                                 (key,))
+        self._changed()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= _COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self):
+        """Writes all changes, and closes the index."""
+        self._lock.acquire()
+        try:
+            self._connection.commit()
+            self._connection.close()
+        finally:
+            self._lock.release()
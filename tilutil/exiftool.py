@@ -20,17 +20,23 @@ Created on May 29, 2009
 
 import datetime
 import os
+import Queue
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 
-from xml.dom import minidom
-from xml import parsers
+from xml.parsers import expat
 
 import systemutils as su
 
 EXIFTOOL = "exiftool"
 
+# ExifToolPool used by get_iptc_data() and update_iptcdata(), see
+# start_sessions().
+_pool = None
+
 def check_exif_tool(msgstream=sys.stderr):
     """Tests if a compatible version of exiftool is available."""
     try:
@@ -52,126 +58,468 @@ copy from http://www.sno.phy.queensu.ca/~phil/exiftool/.
 """ % (EXIFTOOL)
     return False
 
-def _get_xml_nodevalues(xml_data, tag, data):
-    """Extracts one or more node values from an XML element, and appends
-       it to the data array. Node values can be directly below the element,
-       or a list in <rdf:Bag><rfd:li>...</rfd:li>...</rdf:Bag> format.
-    """
-    for xml_element in xml_data.getElementsByTagName(tag):
-        if (xml_element.firstChild.nodeValue and
-            xml_element.firstChild.nodeValue != "\n"):
-            data.append(xml_element.firstChild.nodeValue)
-        for xml_bag in xml_element.getElementsByTagName("rdf:Bag"):
-            for xml_li in xml_bag.getElementsByTagName("rdf:li"):
-                data.append(xml_li.firstChild.nodeValue)
+class ExifToolSession(object):
+    """A running "exiftool -stay_open True -@ -" process, which executes
+    commands sent to its stdin. This saves the exiftool start up time for
+    every command after the first."""
 
-def get_iptc_data(image_file):
-    """get caption, keywords, datetime, rating, and GPS info all in one 
-       operation."""
-    output = su.execandcombine(
-        (EXIFTOOL, "-X", "-m", "-q", "-q", '-c', '%.6f', "-Keywords", 
-         "-Caption-Abstract", "-DateTimeOriginal", "-Rating", "-GPSLatitude",
-         "-Subject", "-GPSLongitude", "-RegionRectangle",
-         "-RegionPersonDisplayName", "%s" % (image_file.encode('utf8'))))
-  
-    keywords = []
-    caption = None
+    def __init__(self, executable=EXIFTOOL):
+        self._process = subprocess.Popen(
+            (executable, "-stay_open", "True", "-@", "-"), shell=False,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        self._count = 0
+
+    def execute(self, args):
+        """Runs exiftool with the arguments args (without the executable),
+        and returns all output in a single string, like
+        systemutils.execandcombine(). Raises IOError if exiftool
+        terminated."""
+        return self.execute_batch([args])[0]
+
+    def execute_batch(self, commands):
+        """Runs several commands (lists of arguments), and returns the list
+        of their outputs. The commands are sent in one write, separated by
+        -execute, so keep batches small enough for their output to fit into
+        the pipe buffer."""
+        lines = []
+        first = self._count + 1
+        for args in commands:
+            self._count += 1
+            for arg in args:
+                if isinstance(arg, unicode):
+                    arg = arg.encode("utf-8")
+                lines.append(arg + "\n")
+            lines.append("-execute%d\n" % (self._count))
+        self._process.stdin.write("".join(lines))
+        self._process.stdin.flush()
+
+        results = []
+        for count in xrange(first, self._count + 1):
+            ready = "{ready%d}" % (count)
+            data = []
+            while True:
+                line = self._process.stdout.readline()
+                if not line:
+                    raise IOError, "exiftool terminated unexpectedly"
+                line = line.strip()
+                if line == ready:
+                    break
+                data.append(line.replace("\r", "\n"))
+            results.append("\n".join(data))
+        return results
+
+    def close(self):
+        """Stops the exiftool process."""
+        try:
+            self._process.stdin.write("-stay_open\nFalse\n")
+            self._process.stdin.close()
+        except IOError:
+            pass
+        self._process.wait()
+
+
+class ExifToolPool(object):
+    """Up to size ExifToolSessions, started as needed, that can be shared by
+    several threads."""
+
+    def __init__(self, size=1, executable=EXIFTOOL):
+        self.size = size
+        self.executable = executable
+        self._idle = Queue.Queue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        """Returns an idle session, starting a new one if none is idle and
+        there are fewer than size."""
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self._lock.acquire()
+        try:
+            if len(self._sessions) < self.size:
+                session = ExifToolSession(self.executable)
+                self._sessions.append(session)
+                return session
+        finally:
+            self._lock.release()
+        return self._idle.get()
+
+    def execute(self, args):
+        """Runs a command in an idle session, see ExifToolSession.execute()."""
+        return self.execute_batch([args])[0]
+
+    def execute_batch(self, commands):
+        """Runs commands in an idle session, see
+        ExifToolSession.execute_batch(). If the session terminates, e.g.
+        because exiftool crashed on a bad file, the commands run again in
+        their own exiftool processes."""
+        session = self._get_session()
+        try:
+            result = session.execute_batch(commands)
+        except IOError, ex:
+            # Don't reuse a broken session.
+            self._lock.acquire()
+            try:
+                self._sessions.remove(session)
+            finally:
+                self._lock.release()
+            session.close()
+            print >> sys.stderr, "Restarting exiftool: %s" % (ex)
+            return _execute_separately(commands, self.executable)
+        self._idle.put(session)
+        return result
+
+    def close(self):
+        """Stops all sessions."""
+        self._lock.acquire()
+        try:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+        finally:
+            self._lock.release()
+
+
+def start_sessions(count=1):
+    """Makes get_iptc_data() and update_iptcdata() use up to count exiftool
+    processes that stay open, instead of starting exiftool for every call.
+    Call stop_sessions() when done."""
+    global _pool
+    stop_sessions()
+    _pool = ExifToolPool(count)
+
+
+def stop_sessions():
+    """Stops the exiftool processes started for start_sessions()."""
+    global _pool
+    if _pool:
+        _pool.close()
+        _pool = None
+
+
+def _execute(args):
+    """Runs exiftool with args, and returns all output in a single string."""
+    if _pool:
+        return _pool.execute(args)
+    return su.execandcombine([EXIFTOOL] + list(args))
+
+
+def _execute_batch(commands):
+    """Runs several exiftool commands in one exiftool process, and returns the
+    list of their outputs."""
+    if _pool:
+        return _pool.execute_batch(commands)
+    session = ExifToolSession()
+    try:
+        return session.execute_batch(commands)
+    except IOError, ex:
+        print >> sys.stderr, "Restarting exiftool: %s" % (ex)
+        return _execute_separately(commands)
+    finally:
+        session.close()
+
+
+def _execute_separately(commands, executable=EXIFTOOL):
+    """Runs each of commands in an exiftool process of its own, and returns
+    the list of their outputs."""
+    return [su.execandcombine([executable] + [_utf8(arg) for arg in args])
+            for args in commands]
+
+
+# Tags read by get_iptc_data().
+_IPTC_TAGS = ("-Keywords", "-Caption-Abstract", "-DateTimeOriginal", "-Rating",
+              "-GPSLatitude", "-Subject", "-GPSLongitude", "-RegionRectangle",
+              "-RegionPersonDisplayName")
+
+# Maximum number of files read by one exiftool command in
+# get_iptc_data_batch().
+_BATCH_SIZE = 100
+
+def _get_iptc_command(image_files):
+    """Returns the exiftool arguments to read the IPTC data of image_files."""
+    return (("-X", "-m", "-q", "-q", '-c', '%.6f') + _IPTC_TAGS +
+            tuple([_utf8(image_file) for image_file in image_files]))
+
+def _utf8(value):
+    """Returns value as an UTF-8 encoded string."""
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+def _empty_iptc_data():
+    """Returns the IPTC data of a file without any."""
+    return ([], None, None, 0, None, [], [])
+
+# Elements of the exiftool -X output that get_iptc_data() looks at. Their
+# values are the text directly in the element, and for _LIST_ELEMENTS also
+# the items of a list in <rdf:Bag><rdf:li>...</rdf:li>...</rdf:Bag> format.
+_LIST_ELEMENTS = ("IPTC:Keywords", "XMP:Subject", "XMP-MP:RegionRectangle",
+                  "XMP-MP:RegionPersonDisplayName")
+_VALUE_ELEMENTS = _LIST_ELEMENTS + (
+    "IPTC:Caption-Abstract", "ExifIFD:DateTimeOriginal", "XMP-xmp:Rating",
+    "Composite:GPSLatitude", "Composite:GPSLongitude")
+
+class _IptcOutputParser(object):
+    """Extracts the IPTC data of all files from exiftool -X output in a single
+    pass with expat, without building a DOM."""
+
+    def __init__(self, image_files):
+        self.results = {}
+        self._image_files = image_files
+        self._files_by_name = {}
+        for image_file in image_files:
+            self._files_by_name[_utf8(image_file).decode('utf8')] = image_file
+        self._image_file = None  # file of the current rdf:Description
+        self._values = None  # element name -> list of values
+        self._names = []  # names of the open elements
+        # [name, depth, text] of the open element from _VALUE_ELEMENTS. text
+        # is None once the first child element started.
+        self._element = None
+        self._item = None  # text of the open rdf:li of a list element
+
+    def parse(self, output):
+        """Parses output, and adds the data for each file to results."""
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._characters
+        parser.Parse(output, True)
+
+    def _start_element(self, name, attributes):
+        element = self._element
+        if element and element[2] is not None:
+            self._add_text(element)
+        self._names.append(name)
+        if name == "rdf:Description":
+            self._image_file = self._files_by_name.get(
+                attributes.get("rdf:about"))
+            if self._image_file is None and len(self._image_files) == 1:
+                self._image_file = self._image_files[0]
+            self._values = {}
+        elif self._values is None:
+            return
+        elif name in _VALUE_ELEMENTS and element is None:
+            self._element = [name, len(self._names), []]
+        elif (name == "rdf:li" and element and self._names[-2] == "rdf:Bag"
+              and element[0] in _LIST_ELEMENTS):
+            self._item = []
+
+    def _add_text(self, element):
+        """Adds the text directly in element (before its first child)."""
+        text = "".join(element[2])
+        element[2] = None
+        if text and (text != "\n" or not element[0] in _LIST_ELEMENTS):
+            self._values.setdefault(element[0], []).append(text)
+
+    def _characters(self, data):
+        if self._item is not None:
+            self._item.append(data)
+        elif self._element and len(self._names) == self._element[1]:
+            if self._element[2] is not None:
+                self._element[2].append(data)
+
+    def _end_element(self, name):
+        element = self._element
+        if self._item is not None and name == "rdf:li":
+            self._values.setdefault(element[0], []).append(
+                "".join(self._item))
+            self._item = None
+        elif element and len(self._names) == element[1]:
+            if element[2] is not None:
+                self._add_text(element)
+            self._element = None
+        elif name == "rdf:Description" and self._values is not None:
+            if self._image_file is not None:
+                self.results[self._image_file] = _get_iptc_values(
+                    self._values, self._image_file)
+            self._values = None
+        self._names.pop()
+
+def _get_last_value(values, name):
+    """Returns the last value found for element name, or None."""
+    element_values = values.get(name)
+    if element_values:
+        return element_values[-1]
+    return None
+
+def _get_iptc_values(values, image_file):
+    """Converts the element values found for a file into the tuple returned
+    by get_iptc_data()."""
+    keywords = values.get("IPTC:Keywords", [])
+    # Keywords can also be stored as Subject in the XMP directory
+    keywords.extend(values.get("XMP:Subject", []))
+    caption = _get_last_value(values, "IPTC:Caption-Abstract")
     date_time_original = None
     rating = 0
     gps = None
-    region_names = []
+    region_names = values.get("XMP-MP:RegionPersonDisplayName", [])
     region_rectangles = []
-    if output:
+
+    for value in values.get("ExifIFD:DateTimeOriginal", []):
         try:
-            gps_latitude = None
-            gps_longitude = None
-
-            xml_data = minidom.parseString(output)
-        
-            for xml_desc in xml_data.getElementsByTagName("rdf:Description"):
-                _get_xml_nodevalues(xml_desc, "IPTC:Keywords", keywords)
-                # Keywords can also be stored as Subject in the XMP directory
-                _get_xml_nodevalues(xml_desc, "XMP:Subject", keywords)
-                for xml_caption in xml_data.getElementsByTagName(
-                    "IPTC:Caption-Abstract"):
-                    caption = xml_caption.firstChild.nodeValue
-                for xml_element in xml_data.getElementsByTagName(
-                    "ExifIFD:DateTimeOriginal"):
-                    if not xml_element.firstChild:
-                        continue
-                    try:
-                        date_time_original = time.strptime(xml_element.firstChild.nodeValue,
-                                                           "%Y:%m:%d %H:%M:%S")
-                        date_time_original = datetime.datetime(
-                            date_time_original.tm_year,
-                            date_time_original.tm_mon,
-                            date_time_original.tm_mday,
-                            date_time_original.tm_hour,
-                            date_time_original.tm_min,
-                            date_time_original.tm_sec)
-                    except ValueError, _ve:
-                        print >> sys.stderr, ("Exiftool returned an invalid date %s for %s - "
-                                              "ignoring.") % (
-                            xml_element.firstChild.nodeValue, image_file)
-                for xml_element in xml_data.getElementsByTagName("XMP-xmp:Rating"):
-                    rating = int(xml_element.firstChild.nodeValue)
-                for xml_element in xml_data.getElementsByTagName(
-                    "Composite:GPSLatitude"):
-                    gps_latitude = xml_element.firstChild.nodeValue
-                for xml_element in xml_data.getElementsByTagName(
-                    "Composite:GPSLongitude"):
-                    gps_longitude = xml_element.firstChild.nodeValue
-                string_rectangles = []
-                _get_xml_nodevalues(xml_desc, 'XMP-MP:RegionRectangle', string_rectangles)
-                for string_rectangle in string_rectangles:
-                    rectangle = []
-                    for c in string_rectangle.split(','):
-                        rectangle.append(float(c))
-                    region_rectangles.append(rectangle)
-                _get_xml_nodevalues(xml_desc, 'XMP-MP:RegionPersonDisplayName', region_names)
-
-            xml_data.unlink()
-            if gps_latitude and gps_longitude:
-                latitude = float(gps_latitude[0:-2])
-                if gps_latitude.endswith(" S"):
-                    latitude = -latitude
-                longitude = float(gps_longitude[0:-2])
-                if gps_longitude.endswith(" W"):
-                    longitude = -longitude
-                gps = (latitude, longitude)
-        except parsers.expat.ExpatError, ex:
-            print >> sys.stderr, "Could not parse exiftool output %s: %s" % (
-                output, ex)
+            date_time_original = time.strptime(value, "%Y:%m:%d %H:%M:%S")
+            date_time_original = datetime.datetime(
+                date_time_original.tm_year,
+                date_time_original.tm_mon,
+                date_time_original.tm_mday,
+                date_time_original.tm_hour,
+                date_time_original.tm_min,
+                date_time_original.tm_sec)
+        except ValueError, _ve:
+            print >> sys.stderr, ("Exiftool returned an invalid date %s for %s - "
+                                  "ignoring.") % (value, image_file)
+    for value in values.get("XMP-xmp:Rating", []):
+        rating = int(value)
+    gps_latitude = _get_last_value(values, "Composite:GPSLatitude")
+    gps_longitude = _get_last_value(values, "Composite:GPSLongitude")
+    for string_rectangle in values.get("XMP-MP:RegionRectangle", []):
+        rectangle = []
+        for c in string_rectangle.split(','):
+            rectangle.append(float(c))
+        region_rectangles.append(rectangle)
+
+    if gps_latitude and gps_longitude:
+        latitude = float(gps_latitude[0:-2])
+        if gps_latitude.endswith(" S"):
+            latitude = -latitude
+        longitude = float(gps_longitude[0:-2])
+        if gps_longitude.endswith(" W"):
+            longitude = -longitude
+        gps = (latitude, longitude)
 
     return (keywords, caption, date_time_original, rating, gps,
             region_rectangles, region_names)
 
+def _parse_iptc_output(output, image_files):
+    """Parses the exiftool -X output for image_files, and returns a map from
+    file to its IPTC data. Files not found in the output are left out."""
+    if not output:
+        return {}
+    parser = _IptcOutputParser(image_files)
+    try:
+        parser.parse(output)
+    except expat.ExpatError, ex:
+        print >> sys.stderr, "Could not parse exiftool output %s: %s" % (
+            output, ex)
+    return parser.results
 
-def update_iptcdata(filepath, new_caption, new_keywords, new_datetime, 
-                    new_rating, new_gps, new_rectangles, new_persons): 
-    """Updates the caption and keywords of an image file."""
+def get_iptc_data(image_file):
+    """get caption, keywords, datetime, rating, and GPS info all in one 
+       operation."""
+    output = _execute(_get_iptc_command([image_file]))
+    result = _parse_iptc_output(output, [image_file])
+    return result.get(image_file) or _empty_iptc_data()
+
+def get_iptc_data_batch(image_files):
+    """Gets the data returned by get_iptc_data() for many files, using one
+    exiftool command per _BATCH_SIZE files. Returns a map from file to data.
+    Files missing from the exiftool output, e.g. because a warning made it
+    unreadable, are left out, so they can be read one at a time."""
+    result = {}
+    image_files = list(image_files)
+    for start in xrange(0, len(image_files), _BATCH_SIZE):
+        batch = image_files[start:start + _BATCH_SIZE]
+        result.update(_parse_iptc_output(_execute(_get_iptc_command(batch)),
+                                         batch))
+    return result
+
+
+class IptcDataCache(object):
+    """IPTC data of a set of files, read with get_iptc_data_batch() the first
+    time data for any of them is needed. Can be shared by several threads."""
+
+    def __init__(self, image_files):
+        self._image_files = set(image_files)
+        self._data = None
+        self._lock = threading.Lock()
+
+    def get_iptc_data(self, image_file):
+        """Returns the data for image_file like get_iptc_data(), reading it
+        with all other files if needed."""
+        self._lock.acquire()
+        try:
+            if not image_file in self._image_files:
+                data = None
+            else:
+                if self._data is None:
+                    self._data = get_iptc_data_batch(self._image_files)
+                data = self._data.get(image_file)
+        finally:
+            self._lock.release()
+        if data is None:
+            return get_iptc_data(image_file)
+        return data
+
+    def discard(self, image_file):
+        """Drops the data for image_file, e.g. because the file changed."""
+        self._lock.acquire()
+        try:
+            self._image_files.discard(image_file)
+            if self._data is not None:
+                self._data.pop(image_file, None)
+        finally:
+            self._lock.release()
+
+
+def _needs_tmp_file(value):
+    """Tests if value has to be passed to exiftool through a file. Argument
+    lines of a -@ argument file end at a newline, and exiftool strips the
+    white space around the "=" of an assignment in them."""
+    return (value.strip() != value or "\n" in value or "\r" in value)
+
+
+def _get_assignment(tag, value, tmp_files):
+    """Returns the exiftool argument that sets tag to value. Values that
+    _needs_tmp_file() are written to a temporary file, which is added to
+    tmp_files."""
+    if not _needs_tmp_file(value):
+        return u'-%s=%s' % (tag, value)
+    tmpfd, tmp = tempfile.mkstemp(dir="/var/tmp")
+    tmp_file = os.fdopen(tmpfd, "w")
+    try:
+        tmp_file.write(value.encode("utf-8"))
+    finally:
+        tmp_file.close()
+    tmp_files.append(tmp)
+    return '-%s<=%s' % (tag, tmp)
+
+
+def _get_update_command(filepath, new_caption, new_keywords, new_datetime,
+                        new_rating, new_gps, new_rectangles, new_persons,
+                        tmp_files, inline_caption=False):
+    """Returns the exiftool arguments for update_iptcdata(). Temporary files
+    that have to be removed after the command ran are added to tmp_files. If
+    inline_caption is set, captions that fit into a single argument line are
+    passed directly instead of through a temporary file."""
     # Some cameras write into ImageDescription, so we wipe it out to not cause
     # conflicts with Caption-Abstract. We also wipe out the XMP Subject and Description
     # tags (we use Keywords and Caption-Abstract).
-    command = [EXIFTOOL, '-F', '-ImageDescription=', '-Subject=', '-Description=']
-    tmp = None
+    command = ['-F', '-ImageDescription=', '-Subject=', '-Description=']
     if not new_caption is None:
-        tmpfd, tmp = tempfile.mkstemp(dir="/var/tmp")
-        os.close(tmpfd)
-        file1 = open(tmp, "w")
         if not new_caption:
             # you can't set caption to an empty string
             new_caption = " "
-        print >> file1, new_caption.encode("utf-8")
-        file1.close()
-        command.append('-Caption-Abstract<=%s' % (tmp))
+        if inline_caption and not _needs_tmp_file(new_caption):
+            command.append(u'-Caption-Abstract=%s' % (new_caption))
+        else:
+            tmpfd, tmp = tempfile.mkstemp(dir="/var/tmp")
+            os.close(tmpfd)
+            tmp_files.append(tmp)
+            file1 = open(tmp, "w")
+            print >> file1, new_caption.encode("utf-8")
+            file1.close()
+            command.append('-Caption-Abstract<=%s' % (tmp))
     
     if new_datetime:
         command.append('-DateTimeOriginal="%s"' % (
             new_datetime.strftime("%Y:%m:%d %H:%M:%S")))
     if new_keywords:
         for keyword in new_keywords:
-            command.append(u'-keywords=%s' % (keyword))
+            command.append(_get_assignment("keywords", keyword, tmp_files))
     elif new_keywords != None:
         command.append('-keywords=')
     if new_rating >= 0:
@@ -193,7 +541,8 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
             command.append('-GPSLongitudeRef=W')
     if new_persons:
         for person in new_persons:
-            command.append(u'-RegionPersonDisplayName=%s' % (person))
+            command.append(_get_assignment("RegionPersonDisplayName", person,
+                                           tmp_files))
     elif new_persons != None:
         command.append('-RegionPersonDisplayName=')
     if new_rectangles:
@@ -203,9 +552,12 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         command.append('-RegionRectangle=')
     command.append("-iptc:CodedCharacterSet=ESC % G")
     command.append(filepath)
-    result = su.execandcombine(command)
-    if tmp:
-        os.remove(tmp)
+    return command
+
+
+def _check_update_result(filepath, result):
+    """Checks the output of an update command, and removes the backup file
+    made by exiftool. Returns True if the update was successful."""
     if result == "1 image files updated":
         # wipe out the back file created by exiftool
         backup_file = filepath + "_original"
@@ -216,4 +568,75 @@ def update_iptcdata(filepath, new_caption, new_keywords, new_datetime,
         print >> sys.stderr, "Failed to update IPTC data in image %s: %s" % (
             su.fsenc(filepath), result)
         return False
-    
+
+
+def update_iptcdata(filepath, new_caption, new_keywords, new_datetime, 
+                    new_rating, new_gps, new_rectangles, new_persons): 
+    """Updates the caption and keywords of an image file."""
+    tmp_files = []
+    try:
+        command = _get_update_command(filepath, new_caption, new_keywords,
+                                      new_datetime, new_rating, new_gps,
+                                      new_rectangles, new_persons, tmp_files)
+        result = _execute(command)
+    finally:
+        for tmp in tmp_files:
+            os.remove(tmp)
+    return _check_update_result(filepath, result)
+
+
+class IptcUpdateBatch(object):
+    """Collects update_iptcdata() calls, and runs them in one exiftool
+    process, as commands separated by -execute. Can be shared by several
+    threads."""
+
+    def __init__(self, max_size=_BATCH_SIZE):
+        """Updates are run when max_size of them are pending, or on
+        flush()."""
+        self.max_size = max_size
+        self._updates = []  # list of (filepath, command) tuples
+        self._tmp_files = []
+        self._lock = threading.Lock()
+
+    def update_iptcdata(self, filepath, new_caption, new_keywords,
+                        new_datetime, new_rating, new_gps, new_rectangles,
+                        new_persons):
+        """Adds an update, see exiftool.update_iptcdata(). Returns the map
+        from file to success returned by flush() if that was called because
+        the batch was full, else None."""
+        self._lock.acquire()
+        try:
+            command = _get_update_command(
+                filepath, new_caption, new_keywords, new_datetime,
+                new_rating, new_gps, new_rectangles, new_persons,
+                self._tmp_files, inline_caption=True)
+            self._updates.append((filepath, command))
+            if len(self._updates) < self.max_size:
+                return None
+            return self._flush()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Runs all pending updates, and returns a map from file to True if
+        its update was successful."""
+        self._lock.acquire()
+        try:
+            return self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        (updates, self._updates) = (self._updates, [])
+        (tmp_files, self._tmp_files) = (self._tmp_files, [])
+        results = {}
+        if not updates:
+            return results
+        try:
+            outputs = _execute_batch([command for (_, command) in updates])
+        finally:
+            for tmp in tmp_files:
+                os.remove(tmp)
+        for ((filepath, _), output) in zip(updates, outputs):
+            results[filepath] = _check_update_result(filepath, output)
+        return results
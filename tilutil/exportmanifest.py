@@ -0,0 +1,432 @@
+'''Manifest of exported files, kept in the export folder
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sqlite3
+import threading
+
+import systemutils as su
+
+# Name of the manifest database in the export folder. It starts with a ".",
+# so the export folder scan ignores it.
+MANIFEST_NAME = ".phoshare_manifest.db"
+
+# Number of updates after which changes are committed, so an interrupted
+# export keeps most of its records.
+_COMMIT_INTERVAL = 500
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+    target TEXT PRIMARY KEY,
+    source TEXT,
+    source_mtime REAL,
+    source_size INTEGER,
+    mod_date REAL,
+    metadata_hash TEXT,
+    target_mtime REAL,
+    target_size INTEGER)"""
+
+_VERIFIED_SCHEMA = """CREATE TABLE IF NOT EXISTS verified (
+    target TEXT PRIMARY KEY,
+    metadata_hash TEXT,
+    target_mtime REAL,
+    target_size INTEGER,
+    target_inode INTEGER)"""
+
+_JOURNAL_SCHEMA = """CREATE TABLE IF NOT EXISTS journal (
+    target TEXT PRIMARY KEY,
+    temp TEXT)"""
+
+_FINGERPRINTS_SCHEMA = """CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    fingerprint TEXT)"""
+
+
+def _unicode_path(path):
+    """Returns path as a unicode string."""
+    if isinstance(path, unicode):
+        return path
+    return su.fsdec(path)
+
+
+def get_file_state(path):
+    """Returns the (mtime, size, inode) of a file, or None if it does not
+    exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+class ManifestEntry(object):
+    """The recorded state of one exported file."""
+
+    __slots__ = ("source", "source_mtime", "source_size", "mod_date",
+                 "metadata_hash", "target_mtime", "target_size")
+
+    def __init__(self, row):
+        (self.source, self.source_mtime, self.source_size, self.mod_date,
+         self.metadata_hash, self.target_mtime, self.target_size) = row
+
+
+class ExportManifest(object):
+    """Records, for every exported file, the source file and its stat, the
+    iPhoto modification date, a hash of the exported meta data, and the stat
+    of the exported file. A later export can then skip files whose source and
+    iPhoto record did not change, without looking at the exported file.
+
+    It also records the files whose IPTC data has been verified, with a hash
+    of the expected meta data and the stat of the file at that time, so the
+    check can be skipped as long as neither changes. It keeps a journal of
+    the files that are being written, so recover() can clean up after an
+    interrupted export. Finally, it caches the content fingerprints of
+    source and exported files.
+
+    A manifest can be used from several threads at the same time."""
+
+    def __init__(self, export_folder, read_only=False, source_stat=os.stat):
+        """Opens (or creates) the manifest in export_folder. If read_only is
+        set, the manifest must exist, and is not changed. source_stat is the
+        function used to stat source files, e.g. a fileindex.StatCache.stat.
+        """
+        self.read_only = read_only
+        self._source_stat = source_stat
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(
+            os.path.join(export_folder, MANIFEST_NAME),
+            check_same_thread=False)
+        # begin() commits for every file that gets written. In a WAL journal
+        # with synchronous=NORMAL, commits don't wait for the disk. The
+        # exclusive lock makes SQLite keep the WAL index in memory, as the
+        # shared memory file it would use otherwise does not work on network
+        # volumes. A commit lost in a system crash only makes the next
+        # export check the file again.
+        if not read_only:
+            self._connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA synchronous = NORMAL")
+            self._connection.execute(_SCHEMA)
+            self._connection.execute(_VERIFIED_SCHEMA)
+            self._connection.execute(_JOURNAL_SCHEMA)
+            self._connection.execute(_FINGERPRINTS_SCHEMA)
+        self._entries = None
+        self._verified = None
+        # Hashes of files with pending IPTC updates, see set_pending().
+        self._pending_verifications = {}
+
+    def _load(self):
+        """Reads all entries into memory, which is much faster than one
+        query per file."""
+        self._entries = {}
+        for row in self._select(
+            "SELECT target, source, source_mtime, source_size, mod_date, "
+            "metadata_hash, target_mtime, target_size FROM files"):
+            self._entries[row[0]] = ManifestEntry(row[1:])
+        self._verified = {}
+        for row in self._select(
+            "SELECT target, metadata_hash, target_mtime, target_size, "
+            "target_inode FROM verified"):
+            self._verified[row[0]] = (row[1], row[2:])
+        self._fingerprints = {}
+        for row in self._select(
+            "SELECT path, mtime, size, fingerprint FROM fingerprints"):
+            self._fingerprints[row[0]] = (row[1:3], row[3])
+
+    def _select(self, query):
+        """Returns the rows of query. A read-only manifest does not create
+        its tables, so a missing table, e.g. in a manifest written by an
+        older version, has no rows."""
+        try:
+            return self._connection.execute(query).fetchall()
+        except sqlite3.OperationalError:
+            if not self.read_only:
+                raise
+            return []
+
+    def get(self, target):
+        """Returns the ManifestEntry for target, or None."""
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._load()
+            return self._entries.get(_unicode_path(target))
+        finally:
+            self._lock.release()
+
+    def is_current(self, target, source, mod_date, metadata_hash,
+                   target_info):
+        """Tests if target was exported from the current version of source,
+        and did not change since. target_info is the fileindex.FileInfo of
+        target. Only source is checked on disk."""
+        entry = self.get(target)
+        if (entry is None or entry.source != _unicode_path(source) or
+            entry.mod_date != mod_date or
+            entry.metadata_hash != metadata_hash or
+            entry.target_mtime != target_info.mtime or
+            entry.target_size != target_info.size):
+            return False
+        try:
+            source_stat = self._source_stat(source)
+        except OSError:
+            return False
+        return (entry.source_mtime == source_stat.st_mtime and
+                entry.source_size == source_stat.st_size)
+
+    def update(self, target, source, mod_date, metadata_hash):
+        """Records that target was exported from source."""
+        if self.read_only:
+            return
+        try:
+            source_stat = self._source_stat(source)
+            target_stat = os.stat(target)
+        except OSError:
+            self.remove(target)
+            return
+        row = (_unicode_path(source), source_stat.st_mtime,
+               source_stat.st_size, mod_date, metadata_hash,
+               target_stat.st_mtime, target_stat.st_size)
+        self._lock.acquire()
+        try:
+            # A pending IPTC update ends the write in updates_done().
+            if not target in self._pending_verifications:
+                self.end(target)
+            target = _unicode_path(target)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (target,) + row)
+            if self._entries is not None:
+                self._entries[target] = ManifestEntry(row)
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def remove(self, target):
+        """Forgets about target."""
+        if self.read_only:
+            return
+        target = _unicode_path(target)
+        self._lock.acquire()
+        try:
+            self._connection.execute("DELETE FROM files WHERE target = ?",
+                                     (target,))
+            self._connection.execute("DELETE FROM verified WHERE target = ?",
+                                     (target,))
+            self._connection.execute("DELETE FROM journal WHERE target = ?",
+                                     (target,))
+            if self._entries is not None:
+                self._entries.pop(target, None)
+                self._verified.pop(target, None)
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def is_verified(self, target, metadata_hash):
+        """Tests if the IPTC data of target was verified for metadata_hash,
+        and target did not change since."""
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._load()
+            verified = self._verified.get(_unicode_path(target))
+        finally:
+            self._lock.release()
+        if verified is None or verified[0] != metadata_hash:
+            return False
+        return get_file_state(target) == verified[1]
+
+    def set_verified(self, target, metadata_hash):
+        """Records that target has the IPTC data described by
+        metadata_hash. The recorded stat of target is updated too, as the
+        IPTC update that got it there may have run after update()."""
+        if self.read_only:
+            return
+        state = get_file_state(target)
+        if state is None:
+            return
+        target = _unicode_path(target)
+        self._lock.acquire()
+        try:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)",
+                (target, metadata_hash) + state)
+            self._connection.execute(
+                "UPDATE files SET target_mtime = ?, target_size = ? "
+                "WHERE target = ?", state[0:2] + (target,))
+            if self._entries is not None:
+                self._verified[target] = (metadata_hash, state)
+                entry = self._entries.get(target)
+                if entry is not None:
+                    (entry.target_mtime, entry.target_size) = state[0:2]
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def set_pending(self, target, metadata_hash):
+        """Notes that an IPTC update for metadata_hash is pending for target.
+        It gets recorded as verified by updates_done()."""
+        self._lock.acquire()
+        try:
+            self.begin(target)
+            self._pending_verifications[target] = metadata_hash
+        finally:
+            self._lock.release()
+
+    def updates_done(self, results):
+        """Records the files with pending updates that were successful.
+        results maps files to success, as returned by
+        exiftool.IptcUpdateBatch.flush()."""
+        if not results:
+            return
+        self._lock.acquire()
+        try:
+            for (target, success) in results.items():
+                metadata_hash = self._pending_verifications.pop(target, None)
+                if success and metadata_hash is not None:
+                    self.set_verified(target, metadata_hash)
+                self.end(target)
+        finally:
+            self._lock.release()
+
+    def get_fingerprint(self, path):
+        """Returns the fingerprint recorded for path, if the file did not
+        change since, else None."""
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._load()
+            recorded = self._fingerprints.get(_unicode_path(path))
+        finally:
+            self._lock.release()
+        if recorded is None:
+            return None
+        state = get_file_state(path)
+        if state is None or state[0:2] != recorded[0]:
+            return None
+        return recorded[1]
+
+    def set_fingerprint(self, path, state, fingerprint):
+        """Records the fingerprint of path, computed when the file had state,
+        as returned by get_file_state()."""
+        if self.read_only or state is None:
+            return
+        path = _unicode_path(path)
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._load()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                (path,) + state[0:2] + (fingerprint,))
+            self._fingerprints[path] = (state[0:2], fingerprint)
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def begin(self, target, temp=None):
+        """Records that target is about to be written, through the temporary
+        file temp if set. The record, and all earlier changes, are committed
+        right away."""
+        if self.read_only:
+            return
+        if temp is not None:
+            temp = _unicode_path(temp)
+        self._lock.acquire()
+        try:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?)",
+                (_unicode_path(target), temp))
+            self._connection.commit()
+            self._pending = 0
+        finally:
+            self._lock.release()
+
+    def end(self, target):
+        """Records that the writing of target, started with begin(), is
+        done."""
+        if self.read_only:
+            return
+        self._lock.acquire()
+        try:
+            self._connection.execute("DELETE FROM journal WHERE target = ?",
+                                     (_unicode_path(target),))
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def recover(self):
+        """Cleans up after an interrupted export: removes the temporary files
+        of writes that did not finish, and forgets about their targets, so
+        they get checked again. Returns the list of these targets."""
+        if self.read_only:
+            return []
+        self._lock.acquire()
+        try:
+            rows = self._connection.execute(
+                "SELECT target, temp FROM journal").fetchall()
+            for (target, temp) in rows:
+                if temp and os.path.exists(temp):
+                    os.remove(temp)
+                self.remove(target)
+            self._connection.commit()
+            self._pending = 0
+        finally:
+            self._lock.release()
+        return [target for (target, _) in rows]
+
+    def retain(self, targets):
+        """Forgets about all files that are not in targets."""
+        if self.read_only:
+            return
+        keep = set([_unicode_path(target) for target in targets])
+        self._lock.acquire()
+        try:
+            if self._entries is None:
+                self._load()
+            for target in set(self._entries.keys() + self._verified.keys()):
+                if not target in keep:
+                    self.remove(target)
+            # Fingerprints are kept for the files, and their sources.
+            keep.update([entry.source for entry in self._entries.values()])
+            for path in self._fingerprints.keys():
+                if not path in keep:
+                    self._connection.execute(
+                        "DELETE FROM fingerprints WHERE path = ?", (path,))
+                    del self._fingerprints[path]
+                    self._changed()
+        finally:
+            self._lock.release()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= _COMMIT_INTERVAL:
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self):
+        """Writes all changes, and closes the manifest."""
+        self._lock.acquire()
+        try:
+            if not self.read_only:
+                self._connection.commit()
+            self._connection.close()
+        finally:
+            self._lock.release()
@@ -0,0 +1,190 @@
+'''Plan of the file operations that bring an export folder up to date
+
+An export runs in two phases: the iPhoto library is compared with the export
+folder first, which only reads files, and results in an ExportPlan. The plan
+is then executed. A plan can also be saved, and executed later.
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import os
+
+# Kinds of operations. The meaning of the source and data of an Operation
+# depends on its kind:
+#   DELETE    deletes the file or folder path; data is the folder that path
+#             must be in.
+#   MKDIR     creates the folder path.
+#   COPY      copies source to path.
+#   LINK      makes path a hard link to source.
+#   RESIZE    converts source to a JPEG at path; data is the maximum width
+#             and height.
+#   METADATA  updates the IPTC data of path; data is a dict with the
+#             "expected" data, the "updates" to make (None if they are not
+#             known until the plan runs), the "hash" to record for them in
+#             the manifest, and "batch", which is True if the update can be
+#             deferred to the end of the folder.
+#   RECORD    records in the manifest that path was exported from source;
+#             data is a tuple of the iPhoto modification date and the
+#             meta data hash.
+#   VERIFY    records in the manifest that the IPTC data of path is correct;
+#             data is the hash of the data.
+DELETE = "delete"
+MKDIR = "mkdir"
+COPY = "copy"
+LINK = "link"
+RESIZE = "resize"
+METADATA = "metadata"
+RECORD = "record"
+VERIFY = "verify"
+
+# Operations that write an exported file.
+WRITE_OPERATIONS = (COPY, LINK, RESIZE)
+
+# Version of the saved plan format. Increment whenever the pickled classes
+# change, so old plans are rejected.
+_PLAN_VERSION = 1
+
+_MB = 1024.0 * 1024.0
+
+
+class Operation(object):
+    """One step of an ExportPlan."""
+
+    __slots__ = ("kind", "path", "source", "size", "data")
+
+    def __init__(self, kind, path, source=None, size=0, data=None):
+        self.kind = kind
+        self.path = path
+        self.source = source
+        # Estimated number of bytes the operation reads or writes.
+        self.size = size
+        self.data = data
+
+
+class Task(object):
+    """The operations for one image, which have to run in order. Tasks are
+    independent of each other."""
+
+    __slots__ = ("folder", "operations")
+
+    def __init__(self, folder, operations):
+        # The album folder of the image; IPTC updates of a folder are
+        # batched.
+        self.folder = folder
+        self.operations = operations
+
+    def get_size(self):
+        """Returns the estimated number of bytes read and written."""
+        return sum([operation.size for operation in self.operations])
+
+
+class ExportPlan(object):
+    """The operations of an export. The folder operations (deletes and new
+    folders) run first, in order. The tasks run after them, and can run in
+    parallel."""
+
+    def __init__(self, export_folder):
+        self.export_folder = export_folder
+        self.operations = []
+        self.tasks = []
+        # All files of the export, or None if the plan is not complete.
+        # Manifest records of other files are dropped when the plan ran.
+        self.export_files = None
+        self._folders = set()
+
+    def add(self, operation):
+        """Adds a folder operation."""
+        self.operations.append(operation)
+
+    def add_folder(self, folder):
+        """Adds a MKDIR operation for folder. Returns False if it was added
+        before."""
+        if folder in self._folders:
+            return False
+        self._folders.add(folder)
+        self.add(Operation(MKDIR, folder))
+        return True
+
+    def add_task(self, folder, operations):
+        """Adds a task with operations for an image in folder, unless there
+        are none."""
+        if operations:
+            self.tasks.append(Task(folder, operations))
+
+    def get_size(self):
+        """Returns the estimated number of bytes the tasks read and
+        write."""
+        return sum([task.get_size() for task in self.tasks])
+
+    def get_counts(self):
+        """Returns a dict with the number of operations of each kind."""
+        counts = {}
+        for operation in self.operations:
+            counts[operation.kind] = counts.get(operation.kind, 0) + 1
+        for task in self.tasks:
+            for operation in task.operations:
+                counts[operation.kind] = counts.get(operation.kind, 0) + 1
+        return counts
+
+    def describe(self):
+        """Returns a one line summary of the plan."""
+        counts = self.get_counts()
+        parts = []
+        for (kind, label) in ((DELETE, "deletes"), (MKDIR, "new folders"),
+                              (COPY, "copies"), (LINK, "links"),
+                              (RESIZE, "conversions"),
+                              (METADATA, "IPTC checks")):
+            if counts.get(kind):
+                parts.append("%d %s" % (counts[kind], label))
+        if not parts:
+            return "Export plan: nothing to do."
+        size = self.get_size()
+        if size:
+            parts.append("%.1f MB to process" % (size / _MB))
+        return "Export plan: %s." % (", ".join(parts))
+
+    def save(self, plan_file):
+        """Writes the plan to plan_file, replacing any previous file."""
+        tmp_file = plan_file + ".tmp"
+        output = open(tmp_file, "wb")
+        try:
+            cPickle.dump(_PLAN_VERSION, output, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(self, output, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            output.close()
+        os.rename(tmp_file, plan_file)
+
+
+def load_plan(plan_file):
+    """Reads a plan written by ExportPlan.save(). Raises ValueError if the
+    file does not contain a plan of the current format."""
+    data = open(plan_file, "rb")
+    try:
+        try:
+            version = cPickle.load(data)
+            if version != _PLAN_VERSION:
+                raise ValueError, "%s has an unsupported format" % (plan_file)
+            plan = cPickle.load(data)
+        except (EOFError, cPickle.UnpicklingError, AttributeError,
+                ImportError, IndexError):
+            raise ValueError, "%s is not an export plan" % (plan_file)
+    finally:
+        data.close()
+    if not isinstance(plan, ExportPlan):
+        raise ValueError, "%s is not an export plan" % (plan_file)
+    return plan
@@ -0,0 +1,163 @@
+'''Copies files without passing their data through Python buffers
+
+copy_file() tries, in this order, to clone the file (a copy-on-write reflink
+on btrfs or XFS, or clonefile() on APFS), to let the kernel copy the data
+(copy_file_range() or sendfile() on Linux), and finally shutil.copy2().
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+
+import systemutils as su
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Copy modes, in the order copy_file() tries them. A mode falls back to the
+# ones after it if the file system does not support it.
+CLONE = "clone"
+KERNEL = "kernel"
+BUFFERED = "buffered"
+COPY_MODES = (CLONE, KERNEL, BUFFERED)
+
+# ioctl that clones a file on Linux, from linux/fs.h.
+_FICLONE = 0x40049409
+
+# Number of bytes copied per copy_file_range() or sendfile() call.
+_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Errors meaning that a copy method is not supported for the files.
+_UNSUPPORTED_ERRORS = set([errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                           errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF])
+if hasattr(errno, "ENOTSUP"):
+    _UNSUPPORTED_ERRORS.add(errno.ENOTSUP)
+
+_libc = None
+
+
+def _get_libc():
+    """Returns the C library, loaded with ctypes."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if hasattr(_libc, "copy_file_range"):
+            _libc.copy_file_range.restype = ctypes.c_ssize_t
+            _libc.copy_file_range.argtypes = [
+                ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                ctypes.c_size_t, ctypes.c_uint]
+        if sys.platform.startswith("linux") and hasattr(_libc, "sendfile"):
+            _libc.sendfile.restype = ctypes.c_ssize_t
+            _libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                       ctypes.c_void_p, ctypes.c_size_t]
+        if hasattr(_libc, "clonefile"):
+            _libc.clonefile.restype = ctypes.c_int
+            _libc.clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                                        ctypes.c_uint]
+    return _libc
+
+
+def _clone_file(source, target):
+    """Clones source into target. Returns False if the file system does not
+    support it."""
+    libc = _get_libc()
+    if hasattr(libc, "clonefile"):
+        # Mac OS X 10.12 and later. The target must not exist.
+        if libc.clonefile(su.fsenc(source), su.fsenc(target), 0) == 0:
+            return True
+        error = ctypes.get_errno()
+        if error in _UNSUPPORTED_ERRORS:
+            return False
+        raise OSError(error, os.strerror(error), target)
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    source_file = open(source, "rb")
+    try:
+        target_file = open(target, "wb")
+        try:
+            fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+            return True
+        except IOError, e:
+            if e.errno in _UNSUPPORTED_ERRORS:
+                return False
+            raise
+        finally:
+            target_file.close()
+    finally:
+        source_file.close()
+
+
+def _kernel_copy(source, target):
+    """Copies source into target with copy_file_range() or sendfile().
+    Returns False if neither of them can be used for the files."""
+    libc = _get_libc()
+    copy_functions = []
+    if hasattr(libc, "copy_file_range"):
+        copy_functions.append(lambda source_fd, target_fd, size:
+                              libc.copy_file_range(source_fd, None, target_fd,
+                                                   None, size, 0))
+    if sys.platform.startswith("linux") and hasattr(libc, "sendfile"):
+        copy_functions.append(lambda source_fd, target_fd, size:
+                              libc.sendfile(target_fd, source_fd, None, size))
+    if not copy_functions:
+        return False
+    source_file = open(source, "rb")
+    try:
+        target_file = open(target, "wb")
+        try:
+            for copy_function in copy_functions:
+                copied = 0
+                while True:
+                    count = copy_function(source_file.fileno(),
+                                          target_file.fileno(), _CHUNK_SIZE)
+                    if count == 0:
+                        return True
+                    if count < 0:
+                        error = ctypes.get_errno()
+                        if copied == 0 and error in _UNSUPPORTED_ERRORS:
+                            break  # try the next function
+                        raise OSError(error, os.strerror(error), target)
+                    copied += count
+            return False
+        finally:
+            target_file.close()
+    finally:
+        source_file.close()
+
+
+def copy_file(source, target, mode=CLONE, buffered_copy=shutil.copy2):
+    """Copies source to target, and its permission bits and modification
+    time, like shutil.copy2(). mode is the first method to try, see
+    COPY_MODES. buffered_copy is the function used if the other methods
+    cannot be used. Returns the mode that was used."""
+    if not mode in COPY_MODES:
+        raise ValueError, "unknown copy mode %s" % (mode)
+    if mode == CLONE and _clone_file(source, target):
+        shutil.copystat(source, target)
+        return CLONE
+    if mode in (CLONE, KERNEL) and _kernel_copy(source, target):
+        shutil.copystat(source, target)
+        return KERNEL
+    buffered_copy(source, target)
+    return BUFFERED
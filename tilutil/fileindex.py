@@ -0,0 +1,187 @@
+'''In-memory index of a folder tree, built in a single pass, and a cache of
+file stats
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import stat
+import unicodedata
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+import systemutils as su
+
+
+def _normalize(path):
+    """Returns path as unicode in Normalization Form C, the form of the paths
+    in a FileIndex."""
+    if not isinstance(path, unicode):
+        path = su.fsdec(path)
+    return unicodedata.normalize("NFC", path)
+
+
+class FileInfo(object):
+    """The stat data of a file or folder in a FileIndex."""
+
+    __slots__ = ("is_dir", "size", "mtime", "inode")
+
+    def __init__(self, file_stat):
+        self.is_dir = stat.S_ISDIR(file_stat.st_mode)
+        self.size = file_stat.st_size
+        self.mtime = file_stat.st_mtime
+        self.inode = file_stat.st_ino
+
+
+def _stat(path):
+    """Stats path, following symbolic links like os.path.isdir() does.
+    Returns the stat of a broken link itself."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return os.lstat(path)
+
+
+class FileIndex(object):
+    """Maps the paths of all files and folders in a folder tree to their
+    FileInfo. The tree is read once, with one directory read per folder and
+    one stat per entry, so later questions about it need no file system
+    access. Paths are unicode, in Normalization Form C."""
+
+    def __init__(self, root, skip_folder=None):
+        """Reads the tree at root. Folders for which skip_folder(path)
+        returns True are indexed, but not their content."""
+        self.root = _normalize(root)
+        self._skip_folder = skip_folder
+        self._entries = {}
+        self._children = {}
+        if os.path.isdir(self.root):
+            self._entries[self.root] = FileInfo(os.stat(self.root))
+            self._scan(self.root)
+
+    def _scan(self, root):
+        """Reads the folder tree at root, without recursion."""
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            names = []
+            for (name, file_stat) in self._read_folder(folder):
+                name = unicodedata.normalize("NFC", name)
+                path = os.path.join(folder, name)
+                info = FileInfo(file_stat)
+                self._entries[path] = info
+                names.append(name)
+                if info.is_dir and not (self._skip_folder and
+                                        self._skip_folder(path)):
+                    folders.append(path)
+            names.sort()
+            self._children[folder] = names
+
+    def _read_folder(self, folder):
+        """Returns (name, stat) tuples for the entries of folder."""
+        result = []
+        if scandir:
+            for entry in scandir(folder):
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    file_stat = entry.stat(follow_symlinks=False)
+                result.append((entry.name, file_stat))
+        else:
+            for name in os.listdir(folder):
+                result.append((name, _stat(os.path.join(folder, name))))
+        return result
+
+    def get(self, path):
+        """Returns the FileInfo of path, or None if it is not in the
+        index. path may be in any normalization form."""
+        return self._entries.get(_normalize(path))
+
+    def exists(self, path):
+        """Tests if path is in the index."""
+        return _normalize(path) in self._entries
+
+    def isdir(self, path):
+        """Tests if path is a folder in the index."""
+        info = self.get(path)
+        return info is not None and info.is_dir
+
+    def listdir(self, folder):
+        """Returns the sorted names in folder, like os_listdir_unicode(). The
+        list is empty for folders that were not read."""
+        return list(self._children.get(_normalize(folder), []))
+
+
+class StatCache(object):
+    """Caches the os.stat() results of files, so each file is stat'ed once.
+    The stats of many files can be read ahead with parallel threads, which
+    helps a lot on network volumes."""
+
+    def __init__(self):
+        # Maps paths to their stat, or the OSError os.stat() raised.
+        self._stats = {}
+
+    def prefetch(self, paths, threads):
+        """Stats the paths that are not cached yet, with the given number of
+        threads."""
+        paths = [path for path in set(paths) if not path in self._stats]
+        if not paths:
+            return
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_get_stat, paths, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+        for (path, result) in zip(paths, results):
+            self._stats[path] = result
+
+    def stat(self, path):
+        """Returns the stat of path, like os.stat()."""
+        result = self._stats.get(path)
+        if result is None:
+            result = _get_stat(path)
+            self._stats[path] = result
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def getmtime(self, path):
+        """Returns the modification time of path, like
+        os.path.getmtime()."""
+        return self.stat(path).st_mtime
+
+    def getsize(self, path):
+        """Returns the size of path, like os.path.getsize()."""
+        return self.stat(path).st_size
+
+    def discard(self, path):
+        """Drops the cached stat of path, e.g. because the file changed."""
+        self._stats.pop(path, None)
+
+
+def _get_stat(path):
+    """Returns the stat of path, or the OSError os.stat() raises."""
+    try:
+        return os.stat(path)
+    except OSError, e:
+        return e
@@ -0,0 +1,155 @@
+'''Fingerprints of the content of image and movie files
+
+A fingerprint covers the image data of a file, but not the meta data that
+exiftool updates, so an exported copy with updated IPTC data has the same
+fingerprint as its source.
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import mmap
+import os
+import struct
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+import systemutils as su
+
+# JPEG segments that hold meta data: APP1 (EXIF, XMP), APP13 (IPTC), and
+# comments.
+_JPEG_META_DATA_MARKERS = (0xe1, 0xed, 0xfe)
+
+# PNG chunks that hold meta data.
+_PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+_PNG_META_DATA_CHUNKS = ("tEXt", "zTXt", "iTXt", "eXIf", "tIME")
+
+# Formats that keep their meta data between parts of the image data, so
+# exiftool updates change the file in places a fingerprint can't skip.
+_UNSUPPORTED_EXTENSIONS = ("tif", "tiff")
+
+# Other files, like movies, are fingerprinted by their size and
+# _SAMPLE_COUNT blocks of _SAMPLE_SIZE bytes, spread over the file.
+_SAMPLE_COUNT = 16
+_SAMPLE_SIZE = 64 * 1024
+
+
+def _new_hash():
+    """Returns the hash object for a fingerprint, and its name."""
+    if xxhash:
+        return (xxhash.xxh64(), "xxh64")
+    return (hashlib.sha1(), "sha1")
+
+
+def get_fingerprint(path):
+    """Returns the fingerprint of a file, as a string, or None if its format
+    is not supported."""
+    if su.getfileextension(path) in _UNSUPPORTED_EXTENSIONS:
+        return None
+    data_file = open(path, "rb")
+    try:
+        header = data_file.read(len(_PNG_SIGNATURE))
+        kind = None
+        if header.startswith("\xff\xd8"):
+            (digest, name) = _new_hash()
+            if _hash_mapped(data_file, _hash_jpeg, digest):
+                kind = "jpeg"
+        elif header == _PNG_SIGNATURE:
+            (digest, name) = _new_hash()
+            if _hash_mapped(data_file, _hash_png, digest):
+                kind = "png"
+        if kind is None:
+            (digest, name) = _new_hash()
+            _hash_samples(data_file, digest)
+            kind = "sampled"
+    finally:
+        data_file.close()
+    return "%s:%s:%s" % (name, kind, digest.hexdigest())
+
+
+def _hash_mapped(data_file, hash_function, digest):
+    """Calls hash_function with the mapped content of data_file, and
+    digest. Returns False if the file can't be parsed."""
+    data = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return hash_function(data, digest)
+    except struct.error:
+        return False  # truncated file
+    finally:
+        data.close()
+
+
+def _hash_jpeg(data, digest):
+    """Adds the segments of a JPEG file, other than meta data segments, to
+    digest. Returns False if the file can't be parsed."""
+    pos = 2
+    size = len(data)
+    while pos + 4 <= size:
+        if data[pos] != "\xff":
+            return False
+        marker = ord(data[pos + 1])
+        if marker == 0xff:
+            pos += 1
+            continue
+        if marker == 0xda:
+            # The compressed image data follows the start of scan segment,
+            # up to the end of the file.
+            digest.update(data[pos:])
+            return True
+        if marker == 0xd9:
+            break
+        if marker == 0xd8 or 0xd0 <= marker <= 0xd7:
+            pos += 2
+            continue
+        (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        if not marker in _JPEG_META_DATA_MARKERS:
+            digest.update(data[pos:pos + 2 + length])
+        pos += 2 + length
+    return False
+
+
+def _hash_png(data, digest):
+    """Adds the chunks of a PNG file, other than meta data chunks, to
+    digest. Returns False if the file can't be parsed."""
+    pos = len(_PNG_SIGNATURE)
+    size = len(data)
+    while pos + 12 <= size:
+        (length,) = struct.unpack(">I", data[pos:pos + 4])
+        chunk_type = data[pos + 4:pos + 8]
+        if not chunk_type in _PNG_META_DATA_CHUNKS:
+            digest.update(data[pos + 4:pos + 8 + length])
+        pos += 12 + length
+        if chunk_type == "IEND":
+            return True
+    return False
+
+
+def _hash_samples(data_file, digest):
+    """Adds the size of data_file, and blocks spread over it, to digest."""
+    size = os.fstat(data_file.fileno()).st_size
+    digest.update(str(size))
+    if size <= _SAMPLE_COUNT * _SAMPLE_SIZE:
+        data_file.seek(0)
+        digest.update(data_file.read())
+        return
+    step = (size - _SAMPLE_SIZE) / (_SAMPLE_COUNT - 1)
+    for i in xrange(_SAMPLE_COUNT):
+        data_file.seek(i * step)
+        digest.update(data_file.read(_SAMPLE_SIZE))
@@ -0,0 +1,355 @@
+'''Reads image meta data directly from JPEG and TIFF files
+
+The data returned by read_iptc_data() is the same as exiftool.get_iptc_data()
+returns, but only the meta data segments of the file are read (through mmap),
+and no exiftool process is needed.
+
+@author: tsporkert@gmail.com
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import mmap
+import struct
+import sys
+import time
+
+from xml.etree import cElementTree
+
+import systemutils as su
+
+# Extensions of the files read_iptc_data() can read.
+_EXTENSIONS = ("jpg", "jpeg", "tif", "tiff")
+
+_EXIF_HEADER = "Exif\0\0"
+_XMP_HEADER = "http://ns.adobe.com/xap/1.0/\0"
+_PHOTOSHOP_HEADER = "Photoshop 3.0\0"
+
+# TIFF tags
+_TAG_XMP = 0x02bc
+_TAG_IPTC = 0x83bb
+_TAG_EXIF_IFD = 0x8769
+_TAG_GPS_IFD = 0x8825
+_TAG_DATE_TIME_ORIGINAL = 0x9003
+_TAG_GPS_LATITUDE_REF = 1
+_TAG_GPS_LATITUDE = 2
+_TAG_GPS_LONGITUDE_REF = 3
+_TAG_GPS_LONGITUDE = 4
+
+# Sizes of the TIFF field types, by type number.
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8,
+               11: 4, 12: 8}
+
+# Photoshop image resource with the IPTC data.
+_RESOURCE_IPTC = 0x0404
+
+# IPTC (record, dataset) numbers.
+_IPTC_CODED_CHARACTER_SET = (1, 90)
+_IPTC_KEYWORDS = (2, 25)
+_IPTC_CAPTION = (2, 120)
+_IPTC_UTF8 = "\x1b%G"
+
+# XMP names, in ElementTree notation.
+_RDF_LI = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}li"
+_XMP_RATING = "{http://ns.adobe.com/xap/1.0/}Rating"
+_XMP_SUBJECT = "{http://purl.org/dc/elements/1.1/}subject"
+_XMP_REGION_RECTANGLE = "{http://ns.microsoft.com/photo/1.2/t/Region#}Rectangle"
+_XMP_REGION_PERSON = (
+    "{http://ns.microsoft.com/photo/1.2/t/Region#}PersonDisplayName")
+
+
+class _MetaData(object):
+    """The values collected from the meta data segments of a file."""
+
+    def __init__(self):
+        self.iptc = None  # IPTC-IIM data
+        self.xmp = None  # XMP packet
+        self.date_time_original = None
+        self.gps = None
+
+
+def can_read(image_file):
+    """Tests if read_iptc_data() supports the format of image_file."""
+    return su.getfileextension(image_file) in _EXTENSIONS
+
+
+def read_iptc_data(image_file):
+    """Reads caption, keywords, datetime, rating, GPS info, and regions from
+    a JPEG or TIFF file. Returns the same tuple as exiftool.get_iptc_data(),
+    or None if the file format is not supported or the file could not be
+    read, in which case exiftool should be used."""
+    if not can_read(image_file):
+        return None
+    try:
+        image = open(image_file, "rb")
+        try:
+            data = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            image.close()
+    except (IOError, OSError, ValueError, mmap.error):
+        return None
+    try:
+        try:
+            meta_data = _MetaData()
+            if data[0:2] == "\xff\xd8":
+                _read_jpeg(data, meta_data)
+            elif data[0:4] in ("II*\0", "MM\0*"):
+                _read_tiff(data, 0, meta_data, True)
+            else:
+                return None
+            return _get_iptc_data(meta_data, image_file)
+        except (struct.error, IndexError, ValueError, TypeError):
+            return None
+    finally:
+        data.close()
+
+
+def _read_jpeg(data, meta_data):
+    """Reads the meta data segments of a JPEG file, up to the image data."""
+    pos = 2
+    size = len(data)
+    while pos + 4 <= size:
+        if data[pos] != "\xff":
+            raise ValueError, "invalid JPEG segment"
+        marker = ord(data[pos + 1])
+        if marker == 0xff:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0xd8 or 0xd0 <= marker <= 0xd7:
+            # markers without data
+            pos += 2
+            continue
+        if marker in (0xd9, 0xda):
+            # end of image, or start of the image data
+            break
+        (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+        start = pos + 4
+        end = pos + 2 + length
+        if marker == 0xe1:
+            if data[start:start + len(_EXIF_HEADER)] == _EXIF_HEADER:
+                _read_tiff(data, start + len(_EXIF_HEADER), meta_data, False)
+            elif data[start:start + len(_XMP_HEADER)] == _XMP_HEADER:
+                if meta_data.xmp is None:
+                    meta_data.xmp = data[start + len(_XMP_HEADER):end]
+        elif marker == 0xed:
+            if (data[start:start + len(_PHOTOSHOP_HEADER)] ==
+                _PHOTOSHOP_HEADER):
+                _read_photoshop_resources(
+                    data, start + len(_PHOTOSHOP_HEADER), end, meta_data)
+        pos = end
+
+
+def _read_photoshop_resources(data, pos, end, meta_data):
+    """Finds the IPTC data in the Photoshop image resources of a JPEG APP13
+    segment."""
+    while pos + 12 <= end and data[pos:pos + 4] == "8BIM":
+        (resource_id,) = struct.unpack(">H", data[pos + 4:pos + 6])
+        # The name is a Pascal string, padded to an even size.
+        name_size = ord(data[pos + 6]) + 1
+        pos += 6 + name_size + name_size % 2
+        (size,) = struct.unpack(">I", data[pos:pos + 4])
+        pos += 4
+        if resource_id == _RESOURCE_IPTC and meta_data.iptc is None:
+            meta_data.iptc = data[pos:pos + size]
+        pos += size + size % 2
+
+
+def _read_tiff(data, start, meta_data, is_tiff_file):
+    """Reads a TIFF structure (a TIFF file, or the EXIF data of a JPEG file)
+    that starts at offset start in data. IPTC and XMP data are only read from
+    TIFF files."""
+    if data[start:start + 2] == "II":
+        order = "<"
+    elif data[start:start + 2] == "MM":
+        order = ">"
+    else:
+        raise ValueError, "invalid TIFF header"
+    (ifd_offset,) = struct.unpack(order + "I", data[start + 4:start + 8])
+    ifd0 = _read_ifd(data, start, order, ifd_offset)
+
+    if is_tiff_file:
+        if _TAG_IPTC in ifd0:
+            meta_data.iptc = _get_bytes(data, start, order, ifd0[_TAG_IPTC])
+        if _TAG_XMP in ifd0:
+            meta_data.xmp = _get_bytes(data, start, order, ifd0[_TAG_XMP])
+
+    if _TAG_EXIF_IFD in ifd0:
+        exif_ifd = _read_ifd(data, start, order, _get_number(
+            data, start, order, ifd0[_TAG_EXIF_IFD]))
+        if _TAG_DATE_TIME_ORIGINAL in exif_ifd:
+            meta_data.date_time_original = _get_bytes(
+                data, start, order,
+                exif_ifd[_TAG_DATE_TIME_ORIGINAL]).rstrip("\0 ")
+
+    if _TAG_GPS_IFD in ifd0:
+        gps_ifd = _read_ifd(data, start, order, _get_number(
+            data, start, order, ifd0[_TAG_GPS_IFD]))
+        if _TAG_GPS_LATITUDE in gps_ifd and _TAG_GPS_LONGITUDE in gps_ifd:
+            latitude = _get_degrees(data, start, order,
+                                    gps_ifd[_TAG_GPS_LATITUDE])
+            if _get_bytes(data, start, order, gps_ifd.get(
+                _TAG_GPS_LATITUDE_REF, (2, 0, ""))).startswith("S"):
+                latitude = -latitude
+            longitude = _get_degrees(data, start, order,
+                                     gps_ifd[_TAG_GPS_LONGITUDE])
+            if _get_bytes(data, start, order, gps_ifd.get(
+                _TAG_GPS_LONGITUDE_REF, (2, 0, ""))).startswith("W"):
+                longitude = -longitude
+            meta_data.gps = (float("%.6f" % (latitude)),
+                             float("%.6f" % (longitude)))
+
+
+def _read_ifd(data, start, order, offset):
+    """Returns a map from tag to (type, count, value) for the entries of the
+    IFD at offset. value is the raw value field of the entry."""
+    pos = start + offset
+    (count,) = struct.unpack(order + "H", data[pos:pos + 2])
+    pos += 2
+    entries = {}
+    for _ in xrange(count):
+        (tag, field_type, field_count) = struct.unpack(order + "HHI",
+                                                      data[pos:pos + 8])
+        entries[tag] = (field_type, field_count, data[pos + 8:pos + 12])
+        pos += 12
+    return entries
+
+
+def _get_bytes(data, start, order, entry):
+    """Returns the data of an IFD entry, which is stored in the entry if it
+    fits into 4 bytes."""
+    (field_type, count, value) = entry
+    size = _TYPE_SIZES.get(field_type, 1) * count
+    if size <= 4:
+        return value[:size]
+    (offset,) = struct.unpack(order + "I", value)
+    return data[start + offset:start + offset + size]
+
+
+def _get_number(data, start, order, entry):
+    """Returns the value of a SHORT or LONG IFD entry."""
+    if entry[0] == 3:
+        return struct.unpack(order + "H", entry[2][:2])[0]
+    return struct.unpack(order + "I", entry[2])[0]
+
+
+def _get_degrees(data, start, order, entry):
+    """Converts a GPS coordinate (3 rationals: degrees, minutes, seconds)
+    into degrees."""
+    values = struct.unpack(order + "6I", _get_bytes(data, start, order,
+                                                    entry)[:24])
+    result = 0.0
+    for (i, divisor) in enumerate((1.0, 60.0, 3600.0)):
+        if values[2 * i + 1]:
+            result += values[2 * i] / float(values[2 * i + 1]) / divisor
+    return result
+
+
+def _read_iim(iptc):
+    """Returns a map from (record, dataset) to the list of values in IPTC-IIM
+    data."""
+    values = {}
+    pos = 0
+    while pos + 5 <= len(iptc) and iptc[pos] == "\x1c":
+        key = (ord(iptc[pos + 1]), ord(iptc[pos + 2]))
+        (length,) = struct.unpack(">H", iptc[pos + 3:pos + 5])
+        pos += 5
+        if length & 0x8000:
+            # extended dataset, the length is stored in the next bytes
+            size = length & 0x7fff
+            length = 0
+            for c in iptc[pos:pos + size]:
+                length = (length << 8) + ord(c)
+            pos += size
+        values.setdefault(key, []).append(iptc[pos:pos + length])
+        pos += length
+    return values
+
+
+def _read_xmp(xmp, keywords, region_rectangles, region_names):
+    """Adds keywords (subjects) and regions from an XMP packet to the lists,
+    and returns the rating found, or None."""
+    try:
+        root = cElementTree.fromstring(xmp.strip("\0 \r\n\t"))
+    except SyntaxError:
+        return None
+    rating = None
+    for element in root.getiterator():
+        # Values can be stored as elements, or as attributes of their parent.
+        for (name, value) in element.items():
+            if name == _XMP_RATING:
+                rating = value
+            elif name == _XMP_REGION_RECTANGLE:
+                region_rectangles.append(value)
+            elif name == _XMP_REGION_PERSON:
+                region_names.append(unicode(value))
+        if element.tag == _XMP_RATING:
+            rating = element.text
+        elif element.tag == _XMP_REGION_RECTANGLE:
+            region_rectangles.append(element.text)
+        elif element.tag == _XMP_REGION_PERSON:
+            region_names.append(unicode(element.text or u""))
+        elif element.tag == _XMP_SUBJECT:
+            for item in element.getiterator(_RDF_LI):
+                keywords.append(unicode(item.text or u""))
+    return rating
+
+
+def _get_iptc_data(meta_data, image_file):
+    """Converts the meta data of a file into the tuple returned by
+    exiftool.get_iptc_data()."""
+    keywords = []
+    caption = None
+    date_time_original = None
+    rating = 0
+    region_rectangles = []
+    region_names = []
+
+    if meta_data.iptc:
+        iim = _read_iim(meta_data.iptc)
+        if iim.get(_IPTC_CODED_CHARACTER_SET, [None])[-1] == _IPTC_UTF8:
+            encoding = "utf-8"
+        else:
+            encoding = "cp1252"
+        for keyword in iim.get(_IPTC_KEYWORDS, []):
+            keywords.append(keyword.decode(encoding, "replace"))
+        for value in iim.get(_IPTC_CAPTION, []):
+            caption = value.decode(encoding, "replace")
+
+    if meta_data.date_time_original:
+        try:
+            date = time.strptime(meta_data.date_time_original,
+                                 "%Y:%m:%d %H:%M:%S")
+            date_time_original = datetime.datetime(
+                date.tm_year, date.tm_mon, date.tm_mday, date.tm_hour,
+                date.tm_min, date.tm_sec)
+        except ValueError:
+            print >> sys.stderr, ("%s has an invalid date %s - ignoring.") % (
+                su.fsenc(image_file), meta_data.date_time_original)
+
+    if meta_data.xmp:
+        # Keywords can also be stored as Subject in the XMP data.
+        string_rectangles = []
+        xmp_rating = _read_xmp(meta_data.xmp, keywords, string_rectangles,
+                               region_names)
+        if xmp_rating:
+            rating = int(float(xmp_rating))
+        for string_rectangle in string_rectangles:
+            region_rectangles.append(
+                [float(c) for c in string_rectangle.split(',')])
+
+    return (keywords, caption, date_time_original, rating, meta_data.gps,
+            region_rectangles, region_names)
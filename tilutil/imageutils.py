@@ -17,15 +17,64 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import cStringIO
+import multiprocessing
+import os
+import struct
 import sys
 import systemutils as su
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None  # resize_image() falls back to ImageMagick or sips
+
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None  # CMYK images are converted without their profile
+
 # ImageMagick "convert" tool
 CONVERT_TOOL = "convert"
 
 # Image processing tool
 _SIPS_TOOL = "sips"
 
+# Resizing backends, in the order resize_image() tries them.
+PILLOW = "pillow"
+IMAGEMAGICK = "imagemagick"
+SIPS = "sips"
+
+# JPEG quality of resized images.
+JPEG_QUALITY = 90
+
+# JPEG start of frame markers, which hold the size of the image. 0xc4,
+# 0xc8, and 0xcc are other markers in the same range.
+_JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset([0xc4, 0xc8,
+                                                              0xcc])
+
+# Headers of the JPEG APP1 segment with XMP data, and of the APP13 segment
+# with IPTC data, which Pillow does not write.
+_JPEG_XMP_HEADER = "http://ns.adobe.com/xap/1.0/\0"
+_JPEG_PHOTOSHOP_HEADER = "Photoshop 3.0\0"
+
+# TIFF tags with IPTC and XMP data, and the PNG text chunk with XMP data.
+_TIFF_IPTC = 33723
+_TIFF_XMP = 700
+_PNG_XMP = "XML:com.adobe.xmp"
+
+# Photoshop image resource with IPTC data.
+_PHOTOSHOP_IPTC_RESOURCE = 0x0404
+
+# Largest data of a JPEG segment.
+_JPEG_MAX_SEGMENT_DATA = 65533
+
+# Image modes whose colors are in the color space of an RGB profile.
+_RGB_MODES = ("RGB", "RGBA", "RGBX", "P", "PA")
+
+# True if the convert tool is available, None if not known yet.
+_has_convert = None
+
 def check_convert():
     """Tests if ImageMagick convert tool is available. Prints error message
        to sys.stderr if there is a problem."""
@@ -72,8 +121,48 @@ def _get_integer(value):
     except ValueError:
         return 0
 
+def _read_jpeg_segments(image_file):
+    """Yields the marker and data length of each segment of a JPEG file
+    before the image data, with image_file positioned at the start of the
+    data. Yields nothing if the file is not a JPEG file."""
+    if image_file.read(2) != "\xff\xd8":
+        return
+    while True:
+        header = image_file.read(4)
+        if len(header) < 4 or header[0] != "\xff":
+            return
+        marker = ord(header[1])
+        if marker == 0xff:
+            # fill byte
+            image_file.seek(-3, os.SEEK_CUR)
+            continue
+        if marker in (0xd9, 0xda):
+            return
+        (length,) = struct.unpack(">H", header[2:4])
+        start = image_file.tell()
+        yield (marker, length - 2)
+        image_file.seek(start + length - 2)
+
+def _get_jpeg_width_height(file_name):
+    """Reads the width and height of a JPEG file from its start of frame
+    segment. Returns None if the file is not a JPEG file, or has no start of
+    frame before the image data."""
+    image_file = open(file_name, "rb")
+    try:
+        for (marker, length) in _read_jpeg_segments(image_file):
+            if marker in _JPEG_SOF_MARKERS:
+                data = image_file.read(5)
+                if len(data) < 5:
+                    return None
+                (height, width) = struct.unpack(">HH", data[1:5])
+                return (width, height)
+        return None
+    finally:
+        image_file.close()
+
 def get_image_width_height(file_name):
-    """Gets the width and height of an image file.
+    """Gets the width and height of an image file. JPEG headers are read
+    directly, other files with Pillow if it is installed, or with sips.
 
     Args:
         file_name: path to image file.
@@ -82,6 +171,17 @@ def get_image_width_height(file_name):
         Tuple with image width and height, or (0, 0) if dimensions could not be
         determined.
     """
+    try:
+        size = _get_jpeg_width_height(file_name)
+        if size:
+            return size
+        if Image:
+            # Only reads the header of the file.
+            return Image.open(file_name).size
+    except (IOError, struct.error):
+        pass
+    if not SIPS in get_resize_backends():
+        return (0, 0)
     result = su.execandcapture([_SIPS_TOOL, '-g', 'pixelWidth',
                                 '-g', 'pixelHeight', file_name])
     height = 0
@@ -93,26 +193,192 @@ def get_image_width_height(file_name):
             width = _get_integer(line[12:])
     return (width, height)
 
-def resize_image(input, output, height_width_max, format='jpeg',
-                 enlarge=False):
-    """Converts an image to a new format and resizes it.
+def get_resize_backends():
+    """Returns the resizing backends that are available on this system."""
+    global _has_convert
+    backends = []
+    if Image:
+        backends.append(PILLOW)
+    if _has_convert is None:
+        try:
+            output = su.execandcombine([CONVERT_TOOL, "-version"])
+            _has_convert = output.find("ImageMagick") >= 0
+        except OSError:
+            _has_convert = False
+    if _has_convert:
+        backends.append(IMAGEMAGICK)
+    if sys.platform == "darwin":
+        backends.append(SIPS)
+    return backends
 
-    Args:
-      input: path to input image file.
-      output: path to output image file.
-      height_width_max: resize image so height and width aren't greater
-          than this value.
-      format: output file format (like "jpeg")
-      enlarge: if set, enlarge images that are smaller than height_width_max.
+def _get_scaled_size(width, height, height_width_max):
+    """Returns the size of a width x height image scaled so that its larger
+    side is height_width_max."""
+    scale = float(height_width_max) / max(width, height)
+    return (max(1, int(round(width * scale))),
+            max(1, int(round(height * scale))))
 
-    Returns:
-        Output from running "sips" command if it failed, None on success.
-    """
-    # To use ImageMagick:
-    #result = su.execandcombine([imageutils.CONVERT_TOOL, input,
-    #                            '-delete',
-    #                            '1--1', '-quality', '90%', '-resize',
-    #                           "%dx%d^" % (height_width_max, height_width_max), output])
+def _make_jpeg_segment(marker, header, data):
+    """Returns a JPEG segment with header and data, or None if they don't
+    fit into one."""
+    data = header + data
+    if len(data) > _JPEG_MAX_SEGMENT_DATA:
+        return None
+    return struct.pack(">BBH", 0xff, marker, len(data) + 2) + data
+
+def _get_tiff_data(image, tag):
+    """Returns the value of a TIFF tag with IPTC or XMP data as a string, or
+    None. Pillow returns these values as a tuple with a string, or as a tuple
+    of numbers, e.g. for IPTC data stored as LONG values."""
+    value = image.tag_v2.get(tag)
+    if not value:
+        return None
+    if isinstance(value, str):
+        return value
+    if not isinstance(value, tuple):
+        return None
+    if all([isinstance(item, str) for item in value]):
+        return "".join(value)
+    if not all([isinstance(item, (int, long)) for item in value]):
+        return None
+    if image.tag_v2.tagtype.get(tag) == 4:
+        order = "<" if image.tag_v2.prefix == "II" else ">"
+        return struct.pack("%s%dL" % (order, len(value)), *value)
+    return "".join([chr(item) for item in value])
+
+def _get_meta_data_segments(input, image):
+    """Returns the JPEG segments with the IPTC and XMP data of the image
+    file input, which Pillow opened as image. They are copied from a JPEG
+    file, and made from the tags of a TIFF file, or the XMP chunk of a PNG
+    file."""
+    segments = []
+    if image.format == "JPEG":
+        image_file = open(input, "rb")
+        try:
+            for (marker, length) in _read_jpeg_segments(image_file):
+                if marker in (0xe1, 0xed):
+                    data = image_file.read(length)
+                    if ((marker == 0xe1 and
+                         data.startswith(_JPEG_XMP_HEADER)) or
+                        (marker == 0xed and
+                         data.startswith(_JPEG_PHOTOSHOP_HEADER))):
+                        segments.append(_make_jpeg_segment(marker, "", data))
+        finally:
+            image_file.close()
+        return segments
+    xmp = None
+    if image.format == "TIFF":
+        iptc = _get_tiff_data(image, _TIFF_IPTC)
+        if iptc:
+            if len(iptc) % 2:
+                iptc += "\0"
+            # A Photoshop image resource with an empty name.
+            resource = "8BIM" + struct.pack(">HHI", _PHOTOSHOP_IPTC_RESOURCE,
+                                            0, len(iptc)) + iptc
+            segments.append(_make_jpeg_segment(0xed, _JPEG_PHOTOSHOP_HEADER,
+                                               resource))
+        xmp = _get_tiff_data(image, _TIFF_XMP)
+    elif image.format == "PNG":
+        xmp = image.info.get(_PNG_XMP)
+    if isinstance(xmp, unicode):
+        xmp = xmp.encode("utf-8")
+    if xmp:
+        segments.append(_make_jpeg_segment(0xe1, _JPEG_XMP_HEADER, xmp))
+    return [segment for segment in segments if segment]
+
+def _insert_jpeg_segments(file_name, segments):
+    """Inserts segments into a JPEG file, after its leading APPn
+    segments."""
+    image_file = open(file_name, "r+b")
+    try:
+        position = 2
+        for (marker, length) in _read_jpeg_segments(image_file):
+            if not 0xe0 <= marker <= 0xef:
+                break
+            position = image_file.tell() + length
+        image_file.seek(position)
+        rest = image_file.read()
+        image_file.seek(position)
+        image_file.write("".join(segments))
+        image_file.write(rest)
+    finally:
+        image_file.close()
+
+def _convert_to_rgb(image, icc_profile):
+    """Converts image to RGB. If the image has a color profile, and ImageCms
+    is available, the colors are converted to sRGB with it. Returns the
+    image, and the color profile that still applies to it, if any."""
+    if image.mode in _RGB_MODES:
+        return (image.convert("RGB"), icc_profile)
+    if icc_profile and ImageCms:
+        try:
+            profile = ImageCms.ImageCmsProfile(cStringIO.StringIO(icc_profile))
+            return (ImageCms.profileToProfile(image, profile,
+                                              ImageCms.createProfile("sRGB"),
+                                              outputMode="RGB"), None)
+        except (ImageCms.PyCMSError, IOError, OSError):
+            pass
+    return (image.convert("RGB"), None)
+
+def _resize_with_pillow(input, output, height_width_max, format, enlarge):
+    """Resizes an image with Pillow. Keeps the EXIF, IPTC, and XMP data, and
+    the color profile, unless the colors are converted to another color
+    space. Returns an error message, or None on success."""
+    try:
+        image = Image.open(input)
+        exif = image.info.get("exif")
+        icc_profile = image.info.get("icc_profile")
+        segments = []
+        if format == "jpeg":
+            segments = _get_meta_data_segments(input, image)
+        (width, height) = image.size
+        if enlarge or height > height_width_max or width > height_width_max:
+            size = _get_scaled_size(width, height, height_width_max)
+            # Lets the JPEG decoder scale the image down by 1/2, 1/4, or 1/8
+            # while decoding it (DCT scaling), as long as the result is
+            # still larger than size. Much faster than decoding all pixels.
+            image.draft("RGB", size)
+            if not image.mode in ("RGB", "L"):
+                (image, icc_profile) = _convert_to_rgb(image, icc_profile)
+            image = image.resize(size, Image.ANTIALIAS)
+        elif not image.mode in ("RGB", "L", "CMYK"):
+            (image, icc_profile) = _convert_to_rgb(image, icc_profile)
+        save_options = {}
+        if format == "jpeg":
+            save_options["quality"] = JPEG_QUALITY
+        if exif:
+            save_options["exif"] = exif
+        if icc_profile:
+            save_options["icc_profile"] = icc_profile
+        image.save(output, format.upper(), **save_options)
+        if segments:
+            _insert_jpeg_segments(output, segments)
+    except StandardError, ex:
+        return "%s: %s" % (PILLOW, ex)
+    return None
+
+def _resize_with_convert(input, output, height_width_max, format, enlarge):
+    """Resizes an image with ImageMagick. Returns an error message, or None
+    on success."""
+    geometry = "%dx%d" % (height_width_max, height_width_max)
+    args = [CONVERT_TOOL,
+            # Allows the JPEG decoder to scale down while decoding.
+            '-define', 'jpeg:size=%dx%d' % (2 * height_width_max,
+                                            2 * height_width_max),
+            input + '[0]', '-quality', '%d' % (JPEG_QUALITY)]
+    if enlarge:
+        args.extend(['-resize', geometry])
+    else:
+        args.extend(['-resize', geometry + '>'])
+    args.append('%s:%s' % (format, output))
+    result = su.execandcombine(args)
+    if not os.path.exists(output) or result.find('error') != -1:
+        return result or "%s failed" % (CONVERT_TOOL)
+    return None
+
+def _resize_with_sips(input, output, height_width_max, format, enlarge):
+    """Resizes an image with sips. Returns the output of sips if it failed,
+    or None on success."""
     out_height_width_max = 0
     if enlarge:
         out_height_width_max = height_width_max
@@ -128,3 +394,68 @@ def resize_image(input, output, height_width_max, format='jpeg',
     if result.find('Error:') != -1 or result.find('Warning:') != -1:
         return result
     return None
+
+_RESIZE_FUNCTIONS = {
+    PILLOW: _resize_with_pillow,
+    IMAGEMAGICK: _resize_with_convert,
+    SIPS: _resize_with_sips,
+}
+
+def resize_image(input, output, height_width_max, format='jpeg',
+                 enlarge=False):
+    """Converts an image to a new format and resizes it. Uses Pillow if it
+    is installed, and falls back to ImageMagick "convert", and to "sips" on
+    Mac OS X, if it is not, or can't read the image.
+
+    Args:
+      input: path to input image file.
+      output: path to output image file.
+      height_width_max: resize image so height and width aren't greater
+          than this value.
+      format: output file format (like "jpeg")
+      enlarge: if set, enlarge images that are smaller than height_width_max.
+
+    Returns:
+        Error message of the last backend that was tried if all failed, None
+        on success.
+    """
+    backends = get_resize_backends()
+    if not backends:
+        return "Resizing images needs Pillow, ImageMagick, or sips."
+    for backend in backends:
+        result = _RESIZE_FUNCTIONS[backend](input, output, height_width_max,
+                                            format, enlarge)
+        if result is None:
+            return None
+        # Don't leave a partial file for the next backend.
+        if os.path.exists(output):
+            os.remove(output)
+    return result
+
+
+class ResizePool(object):
+    """Runs resize_image() in a pool of processes, one per core unless
+    another number is given, so images are converted in parallel without
+    sharing the interpreter lock. Can be shared by several threads, each
+    waiting for its own conversion."""
+
+    def __init__(self, processes=None):
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 1
+        self.size = processes
+        self._pool = multiprocessing.Pool(processes)
+
+    def resize_image(self, input, output, height_width_max, format='jpeg',
+                     enlarge=False):
+        """Like resize_image(), but runs in one of the processes."""
+        return self._pool.apply(resize_image, (input, output,
+                                               height_width_max, format,
+                                               enlarge))
+
+    def close(self):
+        """Stops the processes."""
+        self._pool.close()
+        self._pool.join()